@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+"""
+labファイルのIPA・X-SAMPA・panphon特徴量への一括変換
+
+ディレクトリ以下またはマニフェストに並べたlabファイルをチャンクに分け、
+複数のワーカープロセスで変換して、labファイルの順にタブ区切りで書き出す。
+特徴量はnpzに、未知ラベルを含んだファイルはレポートに書き出す。
+
+ワーカーは親プロセスで作ったEpitran・FeatureTable・XSampa・
+LabelFeatureEngineを使う（forkでは引き継ぎ、spawnではpickleで受け取る）。
+"""
+
+import argparse
+import contextlib
+import csv
+import functools
+import gc
+import multiprocessing
+import multiprocessing.pool
+import os
+import pickle
+import sys
+import threading
+import time
+from collections.abc import Iterator, Sequence
+
+import numpy as np
+
+from check_epitran_openjtalk import (
+    RuleProfile,
+    UnknownLabelLog,
+    get_default_epitran,
+    get_feature_table,
+    get_label_feature_engine,
+    get_xsampa,
+    install_instances,
+    phoneme_labels_to_ipa_corpus,
+    profile_postprocess_rules,
+    read_lab_file,
+)
+from lab_reader import list_lab_files
+
+# 一括変換で1つのワーカーにまとめて渡すlabファイル数の既定値
+_BATCH_CHUNK_SIZE = 256
+
+
+def read_lab_manifest(manifest_file: str) -> list[str]:
+    """
+    labファイルのパスを1行に1つ並べたマニフェストを読み込む
+
+    空行と#で始まる行は飛ばし、相対パスはマニフェストのディレクトリからのパスとする。
+
+    Args:
+        manifest_file: マニフェストのパス
+
+    Returns:
+        labファイルのパスのリスト（マニフェストの順）
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    files = []
+    with open(manifest_file, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                files.append(os.path.join(base_dir, line))
+    return files
+
+
+class BatchResult:
+    """labファイルの一括変換の結果（1チャンク分、またはそれを連結したもの）"""
+
+    def __init__(self):
+        # (labファイルのパス, 音素ラベル列, IPA, X-SAMPA)（変換できなかった
+        # ファイルのIPA・X-SAMPAは空文字列）
+        self.rows: list[tuple[str, str, str, str]] = []
+        self.features: list[np.ndarray] = []
+        self.error_log = UnknownLabelLog()
+        # postprocessorのルールごとの計測結果（計測しない場合はNone）
+        self.profile: RuleProfile | None = None
+
+    def extend(self, other: "BatchResult") -> None:
+        """otherの結果を後ろに連結する"""
+        self.rows += other.rows
+        self.features += other.features
+        self.error_log.extend(other.error_log)
+        if other.profile is not None:
+            if self.profile is None:
+                self.profile = RuleProfile(other.profile.descriptions)
+            self.profile.merge(other.profile)
+
+
+def convert_lab_chunk(
+    files: list[str], features: bool = False, profile_rules: bool = False
+) -> BatchResult:
+    """
+    labファイルを読み込み、IPA・X-SAMPA・panphon特徴量に変換する
+
+    読み込みや変換に失敗したファイルは、IPA・X-SAMPAを空文字列、特徴量を
+    0行としてerror_logに記録し、残りのファイルの変換を続ける。
+
+    Args:
+        files: labファイルのパスのリスト
+        features: Trueの場合、panphon特徴量も求める
+        profile_rules: Trueの場合、postprocessorのルールごとの計測結果を
+            profileに記録する
+
+    Returns:
+        filesの順の変換結果
+    """
+    if profile_rules:
+        with profile_postprocess_rules() as profile:
+            result = convert_lab_chunk(files, features)
+        result.profile = profile
+        return result
+
+    result = BatchResult()
+    error_log = result.error_log
+    if features:
+        engine = get_label_feature_engine()
+        empty = np.zeros((0, len(engine.feature_names)), dtype=np.int8)
+
+    # 時刻の列は使わないため、時刻が整数でないファイルも読めるread_lab_fileで読む
+    utterances = []
+    for lab_file in files:
+        try:
+            utterances.append((lab_file, read_lab_file(lab_file)))
+        except (OSError, UnicodeDecodeError) as e:
+            error_log.add_error(lab_file, f"{type(e).__name__}: {e}")
+            utterances.append((lab_file, None))
+    readable = [(f, labels) for f, labels in utterances if labels is not None]
+    ipas = dict(phoneme_labels_to_ipa_corpus(readable, error_log))
+    error_log.num_utterances += len(utterances) - len(readable)
+
+    # IPAに変換できたファイルの特徴量をチャンク全体でまとめて求める
+    file_features: dict[str, np.ndarray] = {}
+    if features:
+        converted = [
+            (f, labels.split()) for f, labels in readable if ipas[f] is not None
+        ]
+        try:
+            results = engine.features_many([labels for _, labels in converted])
+        except ValueError:
+            # どのファイルで失敗したかを記録するため1ファイルずつ求め直す
+            results = []
+            for lab_file, labels in converted:
+                try:
+                    results.append(engine.features(labels))
+                except ValueError as e:
+                    error_log.add_error(lab_file, f"{type(e).__name__}: {e}")
+                    results.append(None)
+        for (lab_file, _), row_features in zip(converted, results):
+            if row_features is None:
+                ipas[lab_file] = None
+            else:
+                file_features[lab_file] = row_features
+
+    for lab_file, phoneme_labels in utterances:
+        ipa = ipas.get(lab_file)
+        row_features = file_features.get(lab_file)
+        if ipa is None:
+            result.rows.append((lab_file, phoneme_labels or "", "", ""))
+        else:
+            xsampa = get_xsampa().ipa2xs(ipa)
+            result.rows.append((lab_file, phoneme_labels, ipa, xsampa))
+        if features:
+            result.features.append(empty if row_features is None else row_features)
+    return result
+
+
+def _default_batch_processes(num_chunks: int) -> int:
+    """
+    一括変換のワーカープロセス数の既定値
+
+    このプロセスが使えるCPU数（CPUアフィニティで制限されている場合はその数）を、
+    チャンク数を上限として返す。ワーカーはそれぞれEpitran・FeatureTable・
+    LabelFeatureEngineを持ち、spawnの場合は起動ごとにモジュールの読み込みと
+    スナップショットの読み込みで1秒前後、1つあたり百数十MBのメモリを使うため、
+    チャンクのないワーカーは起動しない。
+
+    Args:
+        num_chunks: チャンク数
+
+    Returns:
+        ワーカープロセス数（1以上）
+    """
+    if hasattr(os, "sched_getaffinity"):
+        num_cpus = len(os.sched_getaffinity(0))
+    else:
+        num_cpus = os.cpu_count() or 1
+    return max(1, min(num_cpus, num_chunks))
+
+
+def convert_lab_files(
+    files: Sequence[str],
+    features: bool = False,
+    processes: int | None = None,
+    chunk_size: int = _BATCH_CHUNK_SIZE,
+    profile_rules: bool = False,
+) -> Iterator[BatchResult]:
+    """
+    labファイルをチャンクに分け、複数のワーカープロセスで変換する
+
+    結果はワーカー数やチャンクの処理順によらず、filesの順に返す。
+
+    Args:
+        files: labファイルのパス
+        features: Trueの場合、panphon特徴量も求める
+        processes: ワーカープロセス数（1の場合はこのプロセスで変換する。
+            省略時は使えるCPU数とチャンク数の小さい方）
+        chunk_size: 1つのワーカーにまとめて渡すファイル数
+        profile_rules: Trueの場合、チャンクごとのpostprocessorのルールごとの
+            計測結果をprofileに記録する
+
+    Yields:
+        チャンクごとの変換結果（filesの順）
+    """
+    chunks = [list(files[i : i + chunk_size]) for i in range(0, len(files), chunk_size)]
+    convert = functools.partial(
+        convert_lab_chunk, features=features, profile_rules=profile_rules
+    )
+    if processes is None:
+        processes = _default_batch_processes(len(chunks))
+    if processes <= 1:
+        yield from map(convert, chunks)
+        return
+
+    with _open_batch_pool(processes, features) as pool:
+        yield from pool.imap(convert, chunks)
+
+
+def _open_batch_pool(processes: int, features: bool) -> multiprocessing.pool.Pool:
+    """
+    一括変換のワーカープロセスのプールを作る
+
+    親で作ったインスタンスはforkでそのまま引き継ぐ。ただし他のスレッド
+    （EpitranReloaderなど）が動いている場合は、そのスレッドが持つロックや
+    差し替え途中の状態を子に引き継がないよう、forkせずにspawnした
+    ワーカーへスナップショットを渡す。forkできない環境でも同様にspawnする。
+
+    Args:
+        processes: ワーカープロセス数
+        features: Trueの場合、LabelFeatureEngineも作って渡す
+
+    Returns:
+        ワーカープロセスのプール
+    """
+    state = _batch_worker_state(features)
+    if (
+        "fork" in multiprocessing.get_all_start_methods()
+        and threading.active_count() == 1
+    ):
+        # GCの走査で参照先のページが書き換わって子にコピーされないよう、
+        # fork（Poolの作成）の間だけ走査の対象から外す
+        gc.freeze()
+        try:
+            return multiprocessing.get_context("fork").Pool(processes)
+        finally:
+            gc.unfreeze()
+
+    initargs = tuple(
+        pickle.dumps(part, protocol=pickle.HIGHEST_PROTOCOL) for part in state
+    )
+    return multiprocessing.get_context("spawn").Pool(
+        processes, _init_batch_worker, initargs
+    )
+
+
+def _batch_worker_state(features: bool) -> tuple[tuple, tuple]:
+    """
+    一括変換のワーカーが使うインスタンスを親プロセスで作る
+
+    FeatureTable・XSampaはpickleから読み込む方が作り直すより十数倍速く、
+    Epitran・LabelFeatureEngineはFeatureTableを使うときまで作らないため、
+    spawnしたワーカーでもどれも構築し直さずに済む。
+
+    Returns:
+        ((FeatureTable, XSampa), (Epitran, LabelFeatureEngine（featuresが
+        Falseの場合はNone）))
+    """
+    epi = get_default_epitran()
+    engine = get_label_feature_engine(epi) if features else None
+    return (get_feature_table(), get_xsampa()), (epi, engine)
+
+
+def _init_batch_worker(resources: bytes, converters: bytes) -> None:
+    """spawnしたワーカーに、親プロセスで作ったインスタンスを読み込む"""
+    install_instances(*pickle.loads(resources), *pickle.loads(converters))
+
+
+def run_batch(
+    files: Sequence[str],
+    output: str,
+    features_file: str | None = None,
+    report_file: str | None = None,
+    processes: int | None = None,
+    chunk_size: int = _BATCH_CHUNK_SIZE,
+    profile_file: str | None = None,
+) -> UnknownLabelLog:
+    """
+    labファイルを一括変換し、結果をタブ区切りで書き出す
+
+    出力の列はlabファイルのパス・音素ラベル列・IPA・X-SAMPA。特徴量は
+    全ファイル分を連結したfeaturesと、ファイルごとの先頭行offsets
+    （長さはファイル数+1）をnpzに書き出す。
+
+    Args:
+        files: labファイルのパス
+        output: 出力先のパス（「-」の場合は標準出力）
+        features_file: panphon特徴量の出力先のnpzのパス（省略時は求めない）
+        report_file: 未知ラベルのレポートの出力先のパス（省略時は書き出さない）
+        processes: ワーカープロセス数（省略時は使えるCPU数とチャンク数の小さい方）
+        chunk_size: 1つのワーカーにまとめて渡すファイル数
+        profile_file: postprocessorのルールごとの計測レポートの出力先のパス
+            （省略時は計測しない。全ワーカーの計測結果を合計して書き出す）
+
+    Returns:
+        未知ラベルを含んだ発話の記録
+    """
+    total = BatchResult()
+    with contextlib.ExitStack() as stack:
+        if output == "-":
+            f = sys.stdout
+        else:
+            f = stack.enter_context(open(output, "w", encoding="utf-8"))
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(["lab_file", "phoneme_labels", "ipa", "xsampa"])
+        for result in convert_lab_files(
+            files,
+            features_file is not None,
+            processes,
+            chunk_size,
+            profile_rules=profile_file is not None,
+        ):
+            writer.writerows(result.rows)
+            total.extend(result)
+            total.rows.clear()
+
+    if features_file is not None:
+        num_features = len(get_label_feature_engine().feature_names)
+        lengths = [len(x) for x in total.features]
+        np.savez(
+            features_file,
+            features=np.concatenate(total.features)
+            if total.features
+            else np.zeros((0, num_features), dtype=np.int8),
+            offsets=np.concatenate(([0], np.cumsum(lengths))).astype(np.int64),
+            files=np.array(files, dtype=str),
+        )
+    if report_file is not None:
+        total.error_log.write_report(report_file)
+    if profile_file is not None:
+        profile = total.profile
+        if profile is None:
+            profile = RuleProfile(
+                get_default_epitran().postprocessor.rules.descriptions
+            )
+        profile.write_report(profile_file)
+    return total.error_log
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="labファイルをIPA・X-SAMPAに一括変換してタブ区切りで書き出す"
+    )
+    source_group = parser.add_mutually_exclusive_group(required=True)
+    source_group.add_argument(
+        "--lab-dir",
+        type=str,
+        help="変換するlabファイルのディレクトリ（サブディレクトリも含む）",
+    )
+    source_group.add_argument(
+        "--manifest",
+        type=str,
+        help="変換するlabファイルのパスを1行に1つ並べたファイル",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="-",
+        help="出力先（省略時は標準出力）",
+    )
+    parser.add_argument(
+        "--features",
+        type=str,
+        help="panphon特徴量の出力先のnpzファイル（省略時は求めない）",
+    )
+    parser.add_argument(
+        "--unknown-report",
+        type=str,
+        help="未知ラベルのレポートの出力先",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help="ワーカープロセス数（省略時は使えるCPU数とチャンク数の小さい方。"
+        "spawnの場合、ワーカーごとに起動で1秒前後、メモリを百数十MB使う）",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=_BATCH_CHUNK_SIZE,
+        help="1つのワーカーにまとめて渡すlabファイル数",
+    )
+    parser.add_argument(
+        "--profile-rules",
+        type=str,
+        help="postprocessorのルールごとの計測レポートの出力先"
+        "（計測中はセグメントキャッシュを使わない）",
+    )
+
+    args = parser.parse_args()
+
+    if args.lab_dir and not os.path.isdir(args.lab_dir):
+        parser.error(f"--lab-dirがディレクトリではありません: {args.lab_dir}")
+    if args.processes is not None and args.processes < 1:
+        parser.error("--processesは1以上を指定してください")
+    if args.chunk_size < 1:
+        parser.error("--chunk-sizeは1以上を指定してください")
+    if args.lab_dir:
+        files = list_lab_files(args.lab_dir)
+    else:
+        files = read_lab_manifest(args.manifest)
+    start = time.perf_counter()
+    error_log = run_batch(
+        files,
+        args.output,
+        args.features,
+        args.unknown_report,
+        args.processes,
+        args.chunk_size,
+        args.profile_rules,
+    )
+    print(
+        f"{len(files)}ファイルを変換しました"
+        f"（未知ラベルを含むファイル: {len(error_log.failures)}、"
+        f"読み込み・変換に失敗したファイル: {len(error_log.errors)}、"
+        f"{time.perf_counter() - start:.1f}秒）",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
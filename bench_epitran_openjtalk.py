@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+"""
+OpenJTalkLabelEpitranのベンチマーク
+
+check_epitran_openjtalk.pyの変換処理について、入力長ごとの処理時間を計測する。
+
+計測項目:
+- scaling: 音素ラベル数を10〜10,000まで増やしたときの1ラベルあたりの変換時間
+  （線形時間で変換できていれば、ラベル数によらずほぼ一定になる）
+- matcher: 長さ降順の選択の正規表現とGraphemeTrieによる最長一致の走査時間
+- labels: 結合文字列の変換（transliterate）とラベルリストの変換
+  （transliterate_labels）の比較
+- batch: 短い発話を1件ずつ変換した場合とtransliterate_manyでまとめて変換した場合の比較
+- threads: 1つのインスタンスを複数スレッドで共有したときのスループット
+  （free-threaded CPythonではスレッド数に応じてスケールする）
+- postprocess: epitranのRules.applyと書き換え対象を含まないルールを飛ばす
+  postprocessorの比較（出力の一致も検証する）
+- features: IPA音声記号列を経由するpanphon特徴量（参照実装）と
+  LabelFeatureEngineのテーブル参照（1発話ずつのfeaturesとまとめて求める
+  features_many）の比較（特徴量の一致も検証する）
+- lab: read_lab_fileで1ファイルずつ読む場合とread_lab_filesでまとめて読む場合の比較
+  （--lab-dirを指定した場合のみ。読み込んだラベルの一致も検証する）
+- startup: 新しいプロセスで_get_epitran()を呼んだときの時間
+  （スナップショットなしで構築する場合と、スナップショットを読み込む場合）
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+
+import regex
+from epitran.rules import Rules
+
+from check_epitran_openjtalk import (
+    _POST_FILE,
+    _SEGMENT_CACHE_SIZE,
+    LabelFeatureEngine,
+    _get_epitran,
+    configure_segment_cache,
+    get_feature_table,
+    phoneme_labels_to_features_reference,
+    read_lab_file,
+)
+from grapheme_trie import GraphemeTrie
+from lab_reader import list_lab_files, read_lab_files
+
+# 計測に使う基本の音素ラベル列（「今日は晴れ」、10ラベル）
+_BASE_LABELS = ["ky", "o", "o", "w", "a", "h", "a", "r", "e", "N"]
+
+
+def make_labels(num_labels: int) -> list[str]:
+    """
+    基本の音素ラベル列を繰り返して指定数の音素ラベルのリストを作る
+
+    Args:
+        num_labels: 音素ラベル数（_BASE_LABELSの長さの倍数）
+
+    Returns:
+        音素ラベルのリスト
+    """
+    if num_labels % len(_BASE_LABELS) != 0:
+        raise ValueError(
+            f"num_labels must be a multiple of {len(_BASE_LABELS)}: {num_labels}"
+        )
+    return _BASE_LABELS * (num_labels // len(_BASE_LABELS))
+
+
+def _measure(func, repeat: int) -> float:
+    """funcをrepeat回実行し、最短の実行時間（秒）を返す"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_scaling(sizes: list[int], repeat: int) -> None:
+    """
+    音素ラベル数ごとの1ラベルあたりの変換時間を表示する
+
+    Args:
+        sizes: 計測する音素ラベル数のリスト
+        repeat: 各サイズの計測回数（最短時間を採用）
+    """
+    print("=" * 70)
+    print("scaling: 音素ラベル数と1ラベルあたりの変換時間")
+    print("=" * 70)
+
+    epi = _get_epitran()
+
+    print(f"{'ラベル数':>10} {'合計[ms]':>12} {'1ラベルあたり[us]':>20}")
+    print("-" * 70)
+    for size in sizes:
+        text = "".join(make_labels(size))
+        elapsed = _measure(lambda text=text: epi.transliterate(text), repeat)
+        print(f"{size:>10} {elapsed * 1e3:>12.3f} {elapsed / size * 1e6:>20.3f}")
+    print()
+
+
+def _scan(matcher, text: str) -> int:
+    """matcherで先頭から最長一致を繰り返し、マッチ数を返す"""
+    count = 0
+    pos = 0
+    length = len(text)
+    while pos < length:
+        m = matcher.match(text, pos)
+        pos = m.end() if m else pos + 1
+        count += 1
+    return count
+
+
+def bench_matcher(num_labels: int, repeat: int) -> None:
+    """
+    正規表現とGraphemeTrieの走査時間を比較して表示する
+
+    Args:
+        num_labels: 走査する音素ラベル数
+        repeat: 計測回数（最短時間を採用）
+    """
+    print("=" * 70)
+    print("matcher: 正規表現（選択）とGraphemeTrieの比較")
+    print("=" * 70)
+
+    epi = _get_epitran()
+    graphemes = sorted(epi.g2p.keys(), key=len, reverse=True)
+    matchers = {
+        "regex": regex.compile(f"({'|'.join(regex.escape(g) for g in graphemes)})"),
+        "trie": GraphemeTrie(graphemes),
+    }
+
+    text = "".join(make_labels(num_labels))
+    counts = {name: _scan(matcher, text) for name, matcher in matchers.items()}
+    if len(set(counts.values())) != 1:
+        raise ValueError(f"Match count mismatch: {counts}")
+
+    print(f"マッピング数: {len(graphemes)}, ラベル数: {num_labels}")
+    print(f"{'matcher':>10} {'合計[ms]':>12} {'1マッチあたり[us]':>20}")
+    print("-" * 70)
+    for name, matcher in matchers.items():
+        elapsed = _measure(lambda matcher=matcher: _scan(matcher, text), repeat)
+        print(
+            f"{name:>10} {elapsed * 1e3:>12.3f} {elapsed / counts[name] * 1e6:>20.3f}"
+        )
+    print()
+
+
+def bench_labels(num_labels: int, repeat: int) -> None:
+    """
+    結合文字列の変換とラベルリストの変換の時間を比較して表示する
+
+    Args:
+        num_labels: 変換する音素ラベル数
+        repeat: 計測回数（最短時間を採用）
+    """
+    print("=" * 70)
+    print("labels: transliterateとtransliterate_labelsの比較")
+    print("=" * 70)
+
+    epi = _get_epitran()
+    labels = make_labels(num_labels)
+    funcs = {
+        "transliterate": lambda: epi.transliterate(" ".join(labels).replace(" ", "")),
+        "transliterate_labels": lambda: epi.transliterate_labels(labels),
+    }
+
+    results = {name: func() for name, func in funcs.items()}
+    if len(set(results.values())) != 1:
+        raise ValueError("IPA mismatch between transliterate and transliterate_labels")
+
+    print(f"ラベル数: {num_labels}")
+    print(f"{'method':>22} {'合計[ms]':>12} {'1ラベルあたり[us]':>20}")
+    print("-" * 70)
+    for name, func in funcs.items():
+        elapsed = _measure(func, repeat)
+        print(f"{name:>22} {elapsed * 1e3:>12.3f} {elapsed / num_labels * 1e6:>20.3f}")
+    print()
+
+
+def bench_batch(num_items: int, repeat: int) -> None:
+    """
+    1件ずつの変換とtransliterate_manyによる一括変換の時間を比較して表示する
+
+    Args:
+        num_items: 発話数（各発話は_BASE_LABELSの10ラベル）
+        repeat: 計測回数（最短時間を採用）
+    """
+    print("=" * 70)
+    print("batch: transliterate_labelsの繰り返しとtransliterate_manyの比較")
+    print("=" * 70)
+
+    epi = _get_epitran()
+    items = [make_labels(len(_BASE_LABELS)) for _ in range(num_items)]
+    funcs = {
+        "transliterate_labels": lambda: [epi.transliterate_labels(x) for x in items],
+        "transliterate_many": lambda: epi.transliterate_many(items)[0],
+    }
+
+    results = {name: func() for name, func in funcs.items()}
+    if results["transliterate_labels"] != results["transliterate_many"]:
+        raise ValueError("IPA mismatch between per-item and batch conversion")
+
+    print(f"発話数: {num_items}")
+    print(f"{'method':>22} {'合計[ms]':>12} {'1発話あたり[us]':>20}")
+    print("-" * 70)
+    for name, func in funcs.items():
+        elapsed = _measure(func, repeat)
+        print(f"{name:>22} {elapsed * 1e3:>12.3f} {elapsed / num_items * 1e6:>20.3f}")
+    print()
+
+
+def bench_threads(num_items: int, thread_counts: list[int], repeat: int) -> None:
+    """
+    スレッド数ごとの変換スループットを表示する
+
+    Args:
+        num_items: 発話数（各発話は_BASE_LABELSの10ラベル）
+        thread_counts: 計測するスレッド数のリスト
+        repeat: 計測回数（最短時間を採用）
+    """
+    print("=" * 70)
+    print("threads: 1インスタンスを共有したマルチスレッド変換")
+    print("=" * 70)
+
+    epi = _get_epitran()
+    items = [make_labels(len(_BASE_LABELS)) for _ in range(num_items)]
+    expected = [epi.transliterate_labels(x) for x in items]
+
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(f"発話数: {num_items}, GIL: {'有効' if is_gil_enabled else '無効'}")
+    print(f"{'スレッド数':>10} {'合計[ms]':>12} {'発話/秒':>14} {'スケール':>10}")
+    print("-" * 70)
+    base = None
+    for num_threads in thread_counts:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+
+            def run():
+                return list(executor.map(epi.transliterate_labels, items))
+
+            if run() != expected:
+                raise ValueError(f"IPA mismatch with {num_threads} threads")
+            elapsed = _measure(run, repeat)
+        base = base or elapsed
+        print(
+            f"{num_threads:>10} {elapsed * 1e3:>12.3f} "
+            f"{num_items / elapsed:>14.0f} {base / elapsed:>10.2f}"
+        )
+    print()
+
+
+def bench_postprocess(num_items: int, repeat: int) -> None:
+    """
+    Rules.applyとpostprocessorの時間を比較して表示する
+
+    各モーラキーのIPAを組み合わせたマッピング直後の文字列を入力とし、
+    両者の出力が一致することも確認する。
+
+    Args:
+        num_items: 入力の文字列数（各文字列は1〜20モーラ）
+        repeat: 計測回数（最短時間を採用）
+    """
+    print("=" * 70)
+    print("postprocess: Rules.applyとpostprocessorの比較")
+    print("=" * 70)
+
+    epi = _get_epitran()
+    rules = Rules([_POST_FILE])
+    ipas = sorted(epi._ipa_map.values())
+    texts = [
+        "".join(ipas[(i * 7 + j * 13) % len(ipas)] for j in range(1 + i % 20))
+        for i in range(num_items)
+    ]
+    funcs = {
+        "Rules.apply": lambda: [rules.apply(t) for t in texts],
+        "postprocessor": lambda: [epi.postprocessor.process(t) for t in texts],
+    }
+
+    if funcs["Rules.apply"]() != funcs["postprocessor"]():
+        raise ValueError("Output mismatch between Rules.apply and postprocessor")
+
+    print(f"文字列数: {num_items}, ルール数: {len(rules.rules)}")
+    print(f"{'method':>22} {'合計[ms]':>12} {'1文字列あたり[us]':>20}")
+    print("-" * 70)
+    for name, func in funcs.items():
+        elapsed = _measure(func, repeat)
+        print(f"{name:>22} {elapsed * 1e3:>12.3f} {elapsed / num_items * 1e6:>20.3f}")
+    print()
+
+
+def _key_labels(key: str, labels: Iterable[str]) -> list[str]:
+    """マッピングのキーを音素ラベル（子音ラベルと後続ラベル）に分ける"""
+    for i in range(1, len(key)):
+        if key[:i] in labels and key[i:] in labels:
+            return [key[:i], key[i:]]
+    return [key]
+
+
+def bench_features(num_items: int, repeat: int) -> None:
+    """
+    参照実装とLabelFeatureEngineの特徴量の計算時間を比較して表示する
+
+    各モーラキーをラベルに分けて並べた発話（ところどころpau・N・clを含む）を
+    入力とし、両者の特徴量が一致することも確認する。参照実装の計測では
+    セグメントキャッシュを無効にする。LabelFeatureEngineは1発話ずつの
+    featuresと、全発話をまとめたfeatures_manyを計測する。テーブルは
+    使われた組み合わせを最初の参照時に埋めるため、構築時間とは別に
+    最初の呼び出しの時間を表示する。
+
+    Args:
+        num_items: 発話数（各発話は1〜20モーラ）
+        repeat: 計測回数（最短時間を採用）
+    """
+    print("=" * 70)
+    print("features: 参照実装とLabelFeatureEngineの比較")
+    print("=" * 70)
+
+    epi = _get_epitran()
+    get_feature_table()  # FeatureTableの構築（1回だけ）は含めない
+    start = time.perf_counter()
+    engine = LabelFeatureEngine(epi)
+    build = time.perf_counter() - start
+
+    morae = [_key_labels(key, engine.ids) for key in sorted(epi._ipa_map)]
+    extras = [["pau"], ["N"], ["cl"]]
+    utterances = []
+    for i in range(num_items):
+        labels = []
+        for j in range(1 + i % 20):
+            k = i * 7 + j * 13
+            labels += extras[k % 3] if k % 5 == 0 else morae[k % len(morae)]
+        utterances.append(" ".join(labels))
+
+    sequences = [u.split() for u in utterances]
+    funcs = {
+        "reference": lambda: [
+            phoneme_labels_to_features_reference(u) for u in utterances
+        ],
+        "features": lambda: [engine.features(labels) for labels in sequences],
+        "features_many": lambda: engine.features_many(sequences),
+    }
+
+    configure_segment_cache(0)
+    try:
+        expected = funcs["reference"]()
+        start = time.perf_counter()
+        funcs["features_many"]()
+        fill = time.perf_counter() - start
+        for name in ("features", "features_many"):
+            for u, e, a in zip(utterances, expected, funcs[name]()):
+                if e.shape != a.shape or (e != a).any():
+                    raise ValueError(f"Feature mismatch ({name}): {u}")
+
+        print(
+            f"発話数: {num_items}, 構築: {build * 1e3:.3f} ms, "
+            f"最初の呼び出し（テーブルを埋める）: {fill * 1e3:.3f} ms"
+        )
+        print(f"{'method':>22} {'合計[ms]':>12} {'1発話あたり[us]':>20}")
+        print("-" * 70)
+        for name, func in funcs.items():
+            elapsed = _measure(func, repeat)
+            print(
+                f"{name:>22} {elapsed * 1e3:>12.3f} {elapsed / num_items * 1e6:>20.3f}"
+            )
+    finally:
+        configure_segment_cache(_SEGMENT_CACHE_SIZE)
+    print()
+
+
+def bench_lab(lab_dir: str, repeat: int) -> None:
+    """
+    labファイルを1ファイルずつ読む場合とまとめて読む場合の時間を比較して表示する
+
+    Args:
+        lab_dir: labファイルのディレクトリ
+        repeat: 計測回数（最短時間を採用）
+    """
+    print("=" * 70)
+    print("lab: read_lab_fileとread_lab_filesの比較")
+    print("=" * 70)
+
+    files = list_lab_files(lab_dir)
+    corpus = read_lab_files(files)
+    for i, lab_file in enumerate(files):
+        if corpus.phoneme_labels(i) != read_lab_file(lab_file):
+            raise ValueError(f"Label mismatch: {lab_file}")
+
+    funcs = {
+        "read_lab_file": lambda: [read_lab_file(f) for f in files],
+        "read_lab_files": lambda: read_lab_files(files),
+    }
+    num_labels = len(corpus.label_ids)
+    print(f"ファイル数: {len(files)}, ラベル数: {num_labels}")
+    print(f"{'method':>22} {'合計[ms]':>12} {'1ファイルあたり[us]':>20}")
+    print("-" * 70)
+    for name, func in funcs.items():
+        elapsed = _measure(func, repeat)
+        print(
+            f"{name:>22} {elapsed * 1e3:>12.3f} "
+            f"{elapsed / max(len(files), 1) * 1e6:>20.3f}"
+        )
+    print()
+
+
+# 新しいプロセスで_get_epitran()の時間を計測するスクリプト
+_STARTUP_SCRIPT = """
+import sys, time
+import check_epitran_openjtalk as c
+c._SNAPSHOT_DIR = sys.argv[1]
+start = time.perf_counter()
+c._get_epitran()
+print(time.perf_counter() - start)
+"""
+
+
+def bench_startup(repeat: int) -> None:
+    """
+    スナップショットの有無による_get_epitran()の時間を表示する
+
+    Args:
+        repeat: スナップショットを読み込む場合の計測回数（最短時間を採用）
+    """
+    print("=" * 70)
+    print("startup: 新しいプロセスでの_get_epitran()")
+    print("=" * 70)
+
+    # -cのスクリプトはカレントディレクトリからimportするため、呼び出し元の
+    # ディレクトリによらずこのスクリプトのディレクトリのモジュールを計測する
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def run(snapshot_dir: str) -> float:
+        output = subprocess.run(
+            [sys.executable, "-c", _STARTUP_SCRIPT, snapshot_dir],
+            check=True,
+            cwd=script_dir,
+            capture_output=True,
+            text=True,
+        ).stdout
+        return float(output.strip().splitlines()[-1])
+
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        cold = run(snapshot_dir)
+        warm = min(run(snapshot_dir) for _ in range(repeat))
+
+    print(f"{'状態':>22} {'_get_epitran()[ms]':>20}")
+    print("-" * 70)
+    print(f"{'スナップショットなし':>22} {cold * 1e3:>20.3f}")
+    print(f"{'スナップショットあり':>22} {warm * 1e3:>20.3f}")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenJTalkLabelEpitranのベンチマーク")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000, 10000],
+        help="計測する音素ラベル数（10の倍数）",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="各計測の繰り返し回数（最短時間を採用）",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8],
+        help="threadsで計測するスレッド数",
+    )
+    parser.add_argument(
+        "--lab-dir",
+        type=str,
+        help="labで読み込むlabファイルのディレクトリ（省略時はlabを計測しない）",
+    )
+    args = parser.parse_args()
+
+    bench_scaling(args.sizes, args.repeat)
+    bench_matcher(max(args.sizes), args.repeat)
+    bench_labels(max(args.sizes), args.repeat)
+    bench_batch(max(args.sizes), args.repeat)
+    bench_threads(max(args.sizes), args.threads, args.repeat)
+    bench_postprocess(max(args.sizes), args.repeat)
+    bench_features(max(args.sizes), args.repeat)
+    if args.lab_dir:
+        bench_lab(args.lab_dir, args.repeat)
+    bench_startup(args.repeat)
+
+
+if __name__ == "__main__":
+    main()
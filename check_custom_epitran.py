@@ -15,6 +15,8 @@ import regex
 from epitran.rules import Rules
 from epitran.simple import SimpleEpitran
 
+from grapheme_trie import GraphemeTrie
+
 # =============================================================================
 # CustomEpitranクラスの実装
 # =============================================================================
@@ -58,6 +60,10 @@ class CustomEpitran(SimpleEpitran):
                 g2p[graph].append(phon)
         return g2p
 
+    def _construct_regex(self, g2p_keys):
+        """最長一致のマッチャーを構築（親クラスと同じく大文字小文字を区別しない）"""
+        return GraphemeTrie(g2p_keys, ignore_case=True)
+
 
 class _CustomProcessor:
     """カスタムルールファイル用プロセッサ"""
@@ -14,308 +14,2655 @@ OpenJTalkの音素ラベル:
 """
 
 import argparse
+import contextlib
 import csv
+import glob
+import hashlib
+import importlib.metadata
+import io
 import os
+import pickle
+import threading
+import time
 import unicodedata
-from collections import defaultdict
+import warnings
+from collections import Counter, OrderedDict, defaultdict
+from collections.abc import Iterable, Iterator, Mapping, Sequence
+from pathlib import Path
+from types import MappingProxyType
 
+import numpy as np
 import panphon
 import pyopenjtalk
 import regex
-from epitran.rules import Rules
+from epitran.exceptions import DatafileError
+from epitran.ppprocessor import PrePostProcessor
+from epitran.puncnorm import PuncNorm
+from epitran.rules import RuleFileError, Rules
 from epitran.simple import SimpleEpitran
+from epitran.stripdiacritics import StripDiacritics
 from epitran.xsampa import XSampa
 
+from grapheme_trie import GraphemeTrie
+from lab_reader import LabTiming
+
 # =============================================================================
 # OpenJTalk音素ラベル用Epitranクラス
 # =============================================================================
 
 
-class OpenJTalkLabelEpitran(SimpleEpitran):
+class OpenJTalkLabelEpitran(SimpleEpitran):
+    """
+    OpenJTalk音素ラベルからIPAへ変換するEpitran
+
+    SimpleEpitranを継承し、以下を修正:
+    - 大文字小文字を区別（regex.Iフラグ削除、.lower()削除）
+    - カスタムCSVファイルを使用
+    - 正規表現の代わりにトライで最長一致マッチング
+    - transliterate系は未知文字を呼び出しごとに集計（スレッドセーフ）
+    """
+
+    def __init__(self, map_file: str, post_file: str | None = None, **kwargs):
+        """
+        Args:
+            map_file: マッピングCSVファイルのパス（必須）
+            post_file: ポストプロセッサルールファイルのパス（任意）
+
+        Raises:
+            OSError: 指定したファイルが存在しない・読めない
+        """
+        self._custom_map_file = map_file
+        self._custom_post_file = post_file
+
+        # ファイルは1回だけ読み、解析する内容とハッシュを取る内容を一致させる
+        # （書き込み途中のファイルを読んでも、その内容のversionになる）
+        contents = [_read_file_bytes(file) for file in (map_file, post_file)]
+        self._custom_map_data = contents[0]
+
+        # 親のコンストラクタ呼び出し
+        # 'dummy-Latn'は存在しないが、後でg2pを上書きするので問題ない
+        super().__init__("dummy-Latn", preproc=False, postproc=False, **kwargs)
+        del self._custom_map_data
+
+        # カスタムpostprocessorを設定
+        if post_file:
+            self.postprocessor = _CustomProcessor(_RuleSource(contents[1]))
+            self.postproc = True
+
+        # マッピング・ルールファイルの内容のハッシュ（キャッシュの無効化に使う）
+        self.version = _bytes_hash(contents)
+
+        # 変換に使うグラフィーム→IPAの読み取り専用マップ
+        # （defaultdictのg2pは存在しないキーの参照で要素が増えるため使わない）
+        self._ipa_map = MappingProxyType(
+            {graph: phons[0] for graph, phons in self.g2p.items() if phons}
+        )
+
+    @property
+    def ft(self) -> panphon.FeatureTable:
+        """
+        panphonのFeatureTable
+
+        スナップショットから読み込んだインスタンスでは、構築に1秒以上かかる
+        FeatureTableを使うときまで作らない（作る場合もモジュールのものを共有する）。
+        """
+        ft = self.__dict__.get("_ft")
+        if ft is None:
+            ft = self._ft = get_feature_table()
+        return ft
+
+    @ft.setter
+    def ft(self, value: panphon.FeatureTable) -> None:
+        self._ft = value
+
+    def __getstate__(self):
+        """スナップショット用の状態（読み込み時に安価に作り直せるものは除く）"""
+        state = self.__dict__.copy()
+        state["_ipa_map"] = dict(self._ipa_map)
+        for name in ("_ft", "puncnorm", "preprocessor", "strip_diacritics"):
+            state.pop(name, None)
+        if not isinstance(self.postprocessor, _CustomProcessor):
+            del state["postprocessor"]
+        return state
+
+    def __setstate__(self, state):
+        state = state.copy()
+        state["_ipa_map"] = MappingProxyType(state["_ipa_map"])
+        self.__dict__.update(state)
+        self.puncnorm = PuncNorm()
+        self.preprocessor = PrePostProcessor("dummy-Latn", "pre", False)
+        self.strip_diacritics = StripDiacritics("dummy-Latn")
+        if "postprocessor" not in state:
+            self.postprocessor = PrePostProcessor("dummy-Latn", "post", False)
+
+    def _load_g2p_map(self, code: str, rev: bool):
+        """カスタムファイルからマッピングを読み込む（大文字小文字を区別）"""
+        g2p = defaultdict(list)
+        with io.StringIO(self._custom_map_data.decode("utf-8"), newline=None) as f:
+            reader = csv.reader(f)
+            next(reader, None)  # ヘッダー(Orth,Phon)をスキップ
+            for row in reader:
+                if len(row) < 2:
+                    continue
+                graph, phon = row[0], row[1]
+                graph = unicodedata.normalize("NFD", graph)
+                phon = unicodedata.normalize("NFD", phon)
+                if not self.tones:
+                    phon = regex.sub("[˩˨˧˦˥]", "", phon)
+                g2p[graph].append(phon)
+        return g2p
+
+    def _construct_regex(self, g2p_keys):
+        """
+        最長一致のマッチャーを構築（大文字小文字を区別）
+
+        正規表現の選択の代わりにトライを使い、マッピング行数によらず
+        1ステップあたりO(最長グラフィーム長)でマッチングする。
+        """
+        graphemes = list(g2p_keys)
+        if not graphemes:
+            return regex.compile(r"(.)")  # フォールバック
+        return GraphemeTrie(graphemes)
+
+    def general_trans(
+        self, text: str, filter_func, normpunc: bool = False, ligatures: bool = False
+    ) -> str:
+        """
+        変換処理（大文字小文字を区別、.lower()なし）
+
+        親クラスのgeneral_transをオーバーライドし、
+        text.lower()を削除して大文字小文字を区別する。
+        また、入力を位置ベースで走査し、入力長に対して線形時間で変換する。
+        """
+        # .lower()を削除（これが重要な変更点）
+        text = unicodedata.normalize("NFD", text)
+
+        # strip_diacriticsはダミー言語なのでスキップ可能
+        # text = self.strip_diacritics.process(text)
+
+        if self.preproc:
+            text = self.preprocessor.process(text)
+
+        tr_list = self._map_text(text, self.nils)
+        text = "".join([s for (s, _) in filter(filter_func, tr_list)])
+        return self._finish_trans(text, normpunc, ligatures)
+
+    def _map_text(self, text: str, nils: dict[str, int]) -> list[tuple[str, bool]]:
+        """
+        文字列を最長一致でマッピングし、(変換結果, 変換できたか)のリストを返す
+
+        未知の文字はnilsに数える。
+        """
+        # 残りの文字列をスライスで切り出すと入力長の2乗のコストになるため、
+        # 位置を進めながらマッチングする
+        ipa_map = self._ipa_map
+        tr_list = []
+        pos = 0
+        length = len(text)
+        while pos < length:
+            m = self.regexp.match(text, pos)
+            if m:
+                source = m.group(0)
+                tr_list.append((ipa_map.get(source, source), True))
+                pos = m.end()
+            else:
+                tr_list.append((text[pos], False))
+                nils[text[pos]] = nils.get(text[pos], 0) + 1
+                pos += 1
+        return tr_list
+
+    def _map_labels(
+        self,
+        labels: Sequence[str],
+        nils: dict[str, int],
+        positions: list[tuple[int, str]] | None = None,
+    ) -> str:
+        """
+        音素ラベルのリストをモーラ単位でマッピングした文字列を返す
+
+        未知のラベルはそのまま出力し、nilsに数える。positionsが指定された
+        場合は(未知ラベルの位置, ラベル)も追加する。
+        """
+        ipa_map = self._ipa_map
+        tr_list = []
+        i = 0
+        length = len(labels)
+        while i < length:
+            label = labels[i]
+            if label not in ipa_map and i + 1 < length:
+                mora = label + labels[i + 1]
+                if mora in ipa_map:
+                    tr_list.append(ipa_map[mora])
+                    i += 2
+                    continue
+            if label in ipa_map:
+                tr_list.append(ipa_map[label])
+            else:
+                tr_list.append(label)
+                nils[label] = nils.get(label, 0) + 1
+                if positions is not None:
+                    positions.append((i, label))
+            i += 1
+        return "".join(tr_list)
+
+    def _finish_trans(self, text: str, normpunc: bool, ligatures: bool) -> str:
+        """マッピング後の文字列にpostprocessor等を適用する"""
+        if self.postproc:
+            text = self.postprocessor.process(text)
+        return self._finish_postprocessed(text, normpunc, ligatures)
+
+    def _finish_postprocessed(self, text: str, normpunc: bool, ligatures: bool) -> str:
+        """postprocessor適用後の文字列に合字化・句読点の正規化・NFCを適用する"""
+        if ligatures or self.ligatures:
+            from epitran.ligaturize import ligaturize
+
+            text = ligaturize(text)
+
+        if normpunc:
+            text = self.puncnorm.norm(text)
+
+        return unicodedata.normalize("NFC", text)
+
+    def transliterate(
+        self, text: str, normpunc: bool = False, ligatures: bool = False
+    ) -> str:
+        """
+        音素ラベル列をIPAに変換（未知文字の検証付き）
+
+        未知文字は呼び出しごとに集計し、self.nilsは使わないため、
+        1つのインスタンスを複数スレッドから同時に呼び出せる。
+        """
+        nils: dict[str, int] = {}
+        mapped = self._map_item(text, nils)
+        self._raise_unknown(nils, text)
+        return self._finish_trans(mapped, normpunc, ligatures)
+
+    def transliterate_labels(
+        self, labels: Sequence[str], normpunc: bool = False, ligatures: bool = False
+    ) -> str:
+        """
+        音素ラベルのリストをIPAに変換（未知ラベルの検証付き）
+
+        transliterateと同様に、複数スレッドから同時に呼び出せる。
+        """
+        nils: dict[str, int] = {}
+        mapped = self._map_item(labels, nils)
+        self._raise_unknown(nils, " ".join(labels))
+        return self._finish_trans(mapped, normpunc, ligatures)
+
+    def transliterate_many(
+        self,
+        items: Iterable[str | Sequence[str]],
+        normpunc: bool = False,
+        ligatures: bool = False,
+    ) -> tuple[list[str | None], dict[int, ValueError]]:
+        """
+        複数の発話をまとめてIPAに変換する
+
+        各要素はtransliterateと同じ音素ラベル列の文字列、または
+        transliterate_labelsと同じ音素ラベルのリスト。未知ラベルを含む要素が
+        あっても残りの要素の変換は続ける。postprocessorは変換できた要素を
+        まとめて1回適用する。
+
+        Returns:
+            (入力順の変換結果のリスト（失敗した要素はNone）,
+             失敗した要素のインデックス → ValueError)
+        """
+        results: list[str | None] = []
+        errors: dict[int, ValueError] = {}
+        mapped: list[str] = []
+        for index, item in enumerate(items):
+            nils: dict[str, int] = {}
+            text = self._map_item(item, nils)
+            if nils:
+                source = item if isinstance(item, str) else " ".join(item)
+                error = self._unknown_error(nils, source)
+                if error is not None:
+                    results.append(None)
+                    errors[index] = error
+                    continue
+
+            results.append(text)
+            mapped.append(text)
+
+        if self.postproc:
+            mapped = self.postprocessor.process_many(mapped)
+        finished = iter(
+            self._finish_postprocessed(text, normpunc, ligatures) for text in mapped
+        )
+        results = [None if result is None else next(finished) for result in results]
+        return results, errors
+
+    def _map_item(self, item: str | Sequence[str], nils: dict[str, int]) -> str:
+        """音素ラベル列の文字列またはラベルのリストをマッピングした文字列を返す"""
+        if isinstance(item, str):
+            text = unicodedata.normalize("NFD", item)
+            if self.preproc:
+                text = self.preprocessor.process(text)
+            return "".join(s for (s, _) in self._map_text(text, nils))
+        return self._map_labels(item, nils)
+
+    def _raise_unknown(self, nils: dict[str, int], text: str) -> None:
+        """未知の文字・ラベルがあればValueErrorを送出する"""
+        error = self._unknown_error(nils, text)
+        if error is not None:
+            raise error
+
+    def _unknown_error(self, nils: dict[str, int], text: str) -> ValueError | None:
+        """未知の文字・ラベルの集計からエラーを作る（なければNone）"""
+        unknown_chars = {
+            char: count for char, count in nils.items() if char not in (" ",)
+        }
+        if not unknown_chars:
+            return None
+        char_list = ", ".join(
+            f"'{char}' ({count}回)" for char, count in unknown_chars.items()
+        )
+        return ValueError(
+            f"Unknown phoneme label(s) detected: {char_list}\n"
+            f"Input: {text}\n"
+            f"Mapping file: {self._custom_map_file}"
+        )
+
+
+def _read_file_bytes(file: str | None) -> bytes:
+    """
+    ファイルの内容（ファイルを指定しない場合は空）
+
+    Raises:
+        OSError: 指定したファイルが存在しない・読めない
+    """
+    if not file:
+        return b""
+    with open(file, "rb") as f:
+        return f.read()
+
+
+def _bytes_hash(contents: Sequence[bytes]) -> str:
+    """ファイル内容の列のSHA-256ハッシュ"""
+    h = hashlib.sha256()
+    for data in contents:
+        h.update(b"\0")
+        h.update(data)
+    return h.hexdigest()
+
+
+def _content_hash(files: Sequence[str | None]) -> str:
+    """ファイル内容のSHA-256ハッシュ（指定しないファイルは空として扱う）"""
+    return _bytes_hash([_read_file_bytes(file) for file in files])
+
+
+class _RuleSource:
+    """
+    読み込み済みのルールファイルの内容
+
+    Rulesはopenメソッドを持つオブジェクトをファイルの代わりに読むため、
+    ファイルを読み直さずに同じ内容を解析させるのに使う。
+    """
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def open(self, mode: str = "r", encoding: str = "utf-8") -> io.StringIO:
+        return io.StringIO(self.data.decode(encoding), newline=None)
+
+
+def _is_literal(pattern: str) -> bool:
+    """正規表現の特殊文字を含まない文字列か"""
+    return regex.escape(pattern) == pattern
+
+
+def _is_line_local(pattern: str) -> bool:
+    """
+    改行をまたいでマッチしえない正規表現か
+
+    リテラル・グループ・選択・量指定子・^・$だけからなるパターンを対象にし、
+    文字クラスや"."、エスケープを含むものは改行にマッチしうるとみなす。
+    """
+    return not any(char in pattern for char in "[.\\")
+
+
+class _CompiledRules(Rules):
+    """
+    書き換え対象を含まないルールを飛ばすRules
+
+    Rules.applyは全ルールを記述順に1つずつ正規表現置換するため、
+    どのセグメントも全ルール分のコストを払う。ここでは各ルールがマッチする
+    ために必ず含まれるリテラル（"ɴ -> m / _ (p|b|m)"なら"ɴ"、
+    "ʔ -> k / _ k"なら"ʔk"）を記録しておき、適用時点の文字列に
+    含まれないルールは置換を呼ばずに飛ばす。
+    含まれるルールは元と同じ関数で同じ順に適用するため、出力はRules.applyと
+    一致する（前のルールの出力を次のルールが見る挙動や、置換回数の上限も同じ）。
+    """
+
+    def __init__(self, rule_files: list[str | _RuleSource]):
+        self._reset_compiled()
+        super().__init__(rule_files)
+        # ルールと書き換え対象（空文字列は常に適用）の組
+        self._triggered_rules = list(zip(self._triggers, self.rules, strict=True))
+
+    def _reset_compiled(self) -> None:
+        self._triggers: list[str] = []
+        self.descriptions: list[str] = []
+        # マッチ数の計測用パターン（メタセシスのルールはNone）
+        self._patterns: list[regex.Pattern | None] = []
+        # スナップショットからルールを作り直すための引数
+        self._fields: list[tuple[str, ...]] = []
+        # apply_manyで連結した文字列にまとめて適用するためのパターンと置換後の
+        # 文字列（改行をまたいでマッチしうるルールはNone）
+        self._batch_rules: list[tuple[regex.Pattern, str] | None] = []
+
+    def __getstate__(self):
+        # ルールの関数はpickleできないため、作成時の引数を保存する
+        return {"symbols": self.symbols, "fields": self._fields}
+
+    def __setstate__(self, state):
+        self._reset_compiled()
+        self.symbols = state["symbols"]
+        self.rules = [
+            self._fields_to_function(*fields[1:])
+            if fields[0] == "sub"
+            else self._fields_to_function_metathesis(*fields[1:])
+            for fields in state["fields"]
+        ]
+        self._triggered_rules = list(zip(self._triggers, self.rules, strict=True))
+
+    def _fields_to_function(self, a, b, X, Y):
+        if not _is_literal(a):
+            self._triggers.append("")
+        elif _is_literal(X) and _is_literal(Y):
+            # 前後の文脈もリテラルなら、それを含めた文字列を条件にする
+            self._triggers.append(X + a + Y)
+        else:
+            self._triggers.append(a)
+        function = super()._fields_to_function(a, b, X, Y)
+        self._fields.append(("sub", a, b, X, Y))
+        self.descriptions.append(
+            f"{a or 0} -> {b or 0} / {X.replace('^', '#')} _ {Y.replace('$', '#')}"
+        )
+        # Rules._fields_to_functionと同じパターン
+        self._patterns.append(regex.compile(f"(?P<X>{X})(?P<a>{a})(?P<Y>{Y})"))
+        self._batch_rules.append(
+            (
+                regex.compile(f"(?P<X>{X})(?P<a>{a})(?P<Y>{Y})", regex.MULTILINE),
+                b,
+            )
+            if a and _is_line_local(X + a + Y)
+            else None
+        )
+        return function
+
+    def _fields_to_function_metathesis(self, a, X, Y):
+        self._triggers.append("")
+        function = super()._fields_to_function_metathesis(a, X, Y)
+        self._fields.append(("metathesis", a, X, Y))
+        self.descriptions.append(f"{a} / {X} _ {Y}")
+        self._patterns.append(None)
+        self._batch_rules.append(None)
+        return function
+
+    def apply(self, text: str) -> str:
+        for trigger, rule in self._triggered_rules:
+            if trigger in text:
+                text = rule(text)
+        return text
+
+    def apply_many(self, texts: Sequence[str]) -> list[str]:
+        """
+        複数の文字列にapplyと同じ変換を行う
+
+        文字列を改行で連結し、書き換え対象の有無の確認と置換をまとめて行う。
+        連結した文字列には"#"（^と$）が各文字列の先頭・末尾でマッチする
+        MULTILINEのパターンを使う。文字クラス等を含み改行をまたいでマッチ
+        しうるルールや、1つの文字列での置換回数が上限（regex.U）を超えうる
+        場合は、そのルールだけ1文字列ずつ適用する。
+        """
+        if not texts:
+            return []
+        if any("\n" in text for text in texts):
+            return [self.apply(text) for text in texts]
+
+        joined = "\n".join(texts)
+        for (trigger, rule), batch_rule in zip(
+            self._triggered_rules, self._batch_rules, strict=True
+        ):
+            if trigger not in joined:
+                continue
+            if batch_rule is not None:
+                pattern, b = batch_rule
+                new_joined, count = pattern.subn(
+                    lambda m, b=b: m["X"] + b + m["Y"], joined
+                )
+                # マッチは1文字以上を消費するため、上限を超えうるのは
+                # 上限より長い文字列だけ
+                if count <= regex.U or all(
+                    len(text) <= regex.U for text in joined.split("\n")
+                ):
+                    joined = new_joined
+                    continue
+            joined = "\n".join(rule(text) for text in joined.split("\n"))
+        return joined.split("\n")
+
+    def apply_profiled(self, text: str, profile: "RuleProfile") -> str:
+        """applyと同じ変換を行い、ルールごとの適用回数・マッチ数・時間を記録する"""
+        for i, (trigger, rule) in enumerate(self._triggered_rules):
+            if trigger not in text:
+                continue
+            start = time.perf_counter()
+            new_text = rule(text)
+            profile.seconds[i] += time.perf_counter() - start
+            profile.calls[i] += 1
+            if new_text != text:
+                profile.fires[i] += 1
+                pattern = self._patterns[i]
+                # Rules._fields_to_functionはsubの置換回数にregex.Uを渡している
+                profile.matches[i] += (
+                    min(len(pattern.findall(text)), regex.U) if pattern else 1
+                )
+            text = new_text
+        return text
+
+
+class RuleProfile:
+    """
+    postprocessorのルールごとの計測結果
+
+    calls: 書き換え対象を含み置換を実行した回数
+    fires: 置換で文字列が変化した回数
+    matches: 置換されたマッチの数
+    seconds: 置換にかかった累積時間
+    """
+
+    def __init__(self, descriptions: list[str]):
+        self.descriptions = descriptions
+        self.calls = [0] * len(descriptions)
+        self.fires = [0] * len(descriptions)
+        self.matches = [0] * len(descriptions)
+        self.seconds = [0.0] * len(descriptions)
+
+    def report(self) -> str:
+        """累積時間の降順に並べたタブ区切りのレポート"""
+        lines = ["rank\trule\tcalls\tfires\tmatches\ttotal_ms\tper_call_us"]
+        order = sorted(
+            range(len(self.descriptions)), key=lambda i: self.seconds[i], reverse=True
+        )
+        for rank, i in enumerate(order, start=1):
+            per_call = self.seconds[i] / self.calls[i] if self.calls[i] else 0.0
+            lines.append(
+                f"{rank}\t{self.descriptions[i]}\t{self.calls[i]}\t{self.fires[i]}\t"
+                f"{self.matches[i]}\t{self.seconds[i] * 1e3:.3f}\t{per_call * 1e6:.3f}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def merge(self, other: "RuleProfile") -> None:
+        """同じルールファイルのotherの計測結果を足し合わせる"""
+        if other.descriptions != self.descriptions:
+            raise ValueError("Cannot merge profiles of different rule files")
+        for name in ("calls", "fires", "matches", "seconds"):
+            values = getattr(self, name)
+            for i, value in enumerate(getattr(other, name)):
+                values[i] += value
+
+    def write_report(self, report_file: str) -> None:
+        """reportの内容をファイルに書き出す"""
+        with open(report_file, "w", encoding="utf-8") as f:
+            f.write(self.report())
+
+
+class _CustomProcessor:
+    """カスタムルールファイル用プロセッサ"""
+
+    def __init__(self, rule_file: str | _RuleSource):
+        self.rules = _CompiledRules([rule_file])
+        self.profile: RuleProfile | None = None
+
+    def __getstate__(self):
+        # 計測中に差し替えたprocessや計測結果はスナップショットに含めない
+        return {"rules": self.rules}
+
+    def __setstate__(self, state):
+        self.rules = state["rules"]
+        self.profile = None
+
+    def process(self, word: str) -> str:
+        return self.rules.apply(word)
+
+    def process_many(self, words: Sequence[str]) -> list[str]:
+        """複数の文字列をprocessと同じ結果に変換する"""
+        if self.profile is not None:
+            return [self.process(word) for word in words]
+        return self.rules.apply_many(words)
+
+    def enable_profiling(self) -> RuleProfile:
+        """
+        ルールごとの計測を開始する
+
+        インスタンスのprocessを計測付きのものに差し替えるため、無効時の
+        processには計測のコストがかからない。計測結果の更新はスレッドセーフ
+        ではないので、計測は1スレッドで行う。
+
+        Returns:
+            計測結果（コーパスの変換後にreportで確認する）
+        """
+        self.profile = RuleProfile(self.rules.descriptions)
+        profile = self.profile
+        self.process = lambda word: self.rules.apply_profiled(word, profile)
+        return profile
+
+    def disable_profiling(self) -> RuleProfile | None:
+        """ルールごとの計測を終了し、計測結果を返す"""
+        self.__dict__.pop("process", None)
+        profile, self.profile = self.profile, None
+        return profile
+
+    @contextlib.contextmanager
+    def pause_profiling(self) -> Iterator[None]:
+        """with文の中の変換を計測から除く（計測中でなければ何もしない）"""
+        process = self.__dict__.pop("process", None)
+        profile, self.profile = self.profile, None
+        try:
+            yield
+        finally:
+            if process is not None:
+                self.process = process
+            self.profile = profile
+
+
+# =============================================================================
+# 変換関数
+# =============================================================================
+
+# デフォルトのファイルパス
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+_MAP_FILE = os.path.join(_BASE_DIR, "hiho_data", "openjtalk_to_ipa.csv")
+_POST_FILE = os.path.join(_BASE_DIR, "hiho_data", "openjtalk_postprocess.txt")
+
+# 構築済みEpitranのスナップショットの保存先（Noneで使わない）
+_SNAPSHOT_DIR: str | None = os.path.join(_BASE_DIR, ".cache")
+
+# スナップショットの形式のバージョン（OpenJTalkLabelEpitranの状態を変えたら上げる）
+_SNAPSHOT_FORMAT = 2
+
+# 残しておくスナップショットの数（マッピング・ルールファイルを編集するたびに
+# 増えるため、最近使ったものから数えてこれを超えた分は削除する）
+_SNAPSHOT_KEEP = 4
+
+# グローバルインスタンス（遅延初期化）
+_epitran_instance: OpenJTalkLabelEpitran | None = None
+_epitran_lock = threading.Lock()
+
+# マッピング・ルールファイルの組ごとに保持するEpitranインスタンス数の既定値
+_EPITRAN_POOL_SIZE = 4
+
+# セグメント単位の変換結果キャッシュの既定サイズ
+_SEGMENT_CACHE_SIZE = 4096
+
+# 無音ラベル（発話をセグメントに区切る。特徴量の行は持たない）
+_SILENCE_LABELS = ("pau", "sil")
+
+# panphonのFeatureTable（特徴量ベクトル取得用）とXSampa（IPA→X-SAMPA変換用）の
+# インスタンス（遅延初期化。どちらも構築に1秒以上かかる）
+_feature_table: panphon.FeatureTable | None = None
+_xsampa: XSampa | None = None
+_resource_lock = threading.Lock()
+
+
+def _get_epitran() -> OpenJTalkLabelEpitran:
+    """Epitranインスタンスを取得（シングルトン、スレッドセーフ）"""
+    global _epitran_instance
+    if _epitran_instance is None:
+        with _epitran_lock:
+            if _epitran_instance is None:
+                _epitran_instance = get_epitran(_MAP_FILE, _POST_FILE)
+    return _epitran_instance
+
+
+def get_default_epitran() -> OpenJTalkLabelEpitran:
+    """
+    デフォルトのマッピング・ルールファイルのEpitranインスタンスを取得する
+
+    reload_epitranで差し替えた後は新しいインスタンスを返す。
+
+    Returns:
+        Epitranインスタンス
+    """
+    return _get_epitran()
+
+
+def get_feature_table() -> panphon.FeatureTable:
+    """panphonのFeatureTableを取得（シングルトン、スレッドセーフ）"""
+    global _feature_table
+    if _feature_table is None:
+        with _resource_lock:
+            if _feature_table is None:
+                _feature_table = panphon.FeatureTable()
+    return _feature_table
+
+
+def get_xsampa() -> XSampa:
+    """XSampaインスタンスを取得（シングルトン、スレッドセーフ）"""
+    global _xsampa
+    if _xsampa is None:
+        with _resource_lock:
+            if _xsampa is None:
+                _xsampa = XSampa()
+    return _xsampa
+
+
+def get_epitran(map_file: str, post_file: str | None) -> OpenJTalkLabelEpitran:
+    """
+    マッピング・ルールファイルの組に対応するEpitranインスタンスを取得する
+
+    ファイルの内容ごとにインスタンスをプールしておき、同じ内容なら
+    構築し直さずに返す（スレッドセーフ）。
+
+    Args:
+        map_file: マッピングCSVファイルのパス
+        post_file: ポストプロセッサルールファイルのパス
+
+    Returns:
+        Epitranインスタンス
+    """
+    return _epitran_pool.get(map_file, post_file)
+
+
+def configure_epitran_pool(maxsize: int) -> "EpitranPool":
+    """
+    get_epitranが保持するEpitranインスタンス数の上限を設定する
+
+    Args:
+        maxsize: 保持するインスタンス数の上限
+
+    Returns:
+        Epitranのプール
+    """
+    _epitran_pool.resize(maxsize)
+    return _epitran_pool
+
+
+def _file_stat_key(files: Sequence[str | None]) -> tuple:
+    """ファイルのパス・更新時刻・サイズの組（存在しないファイルはNone）"""
+    key = []
+    for file in files:
+        try:
+            st = os.stat(file) if file else None
+        except FileNotFoundError:
+            st = None
+        key.append((file, st.st_mtime_ns, st.st_size) if st else (file, None))
+    return tuple(key)
+
+
+class EpitranPool:
+    """
+    マッピング・ルールファイルの内容ごとのEpitranインスタンスのLRUプール
+
+    インスタンスは初めて要求されたときにload_epitranで作る。ファイルの
+    内容のハッシュはパス・更新時刻・サイズが変わったときだけ計算し直す。
+    上限を超えたら最も長く使われていないインスタンスを破棄し、
+    セグメントキャッシュからもその変換結果を破棄する（デフォルトの
+    インスタンスとして使われているものの変換結果は残す）。
+    """
+
+    def __init__(self, maxsize: int):
+        """
+        Args:
+            maxsize: 保持するインスタンス数の上限（1未満は1として扱う）
+        """
+        self.maxsize = maxsize
+        self._engines: OrderedDict[str, OpenJTalkLabelEpitran] = OrderedDict()
+        self._versions: dict[tuple, str] = {}
+        # 構築中のversionごとのロック
+        self._build_locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, map_file: str, post_file: str | None) -> OpenJTalkLabelEpitran:
+        """
+        ファイルの組に対応するインスタンスを返す（なければ作る）
+
+        構築はプールのロックを離して行うため、構築中も他のversionの
+        インスタンスは待たずに返せる。同じversionの構築は1回にまとめる。
+        """
+        stat_key = _file_stat_key([map_file, post_file])
+        with self._lock:
+            version = self._versions.get(stat_key)
+        if version is None:
+            version = _content_hash([map_file, post_file])
+            with self._lock:
+                self._versions[stat_key] = version
+
+        with self._lock:
+            epi = self._get_cached(version)
+            if epi is not None:
+                return epi
+            build_lock = self._build_locks.setdefault(version, threading.Lock())
+
+        with build_lock:
+            with self._lock:
+                epi = self._get_cached(version)
+            if epi is not None:
+                return epi
+
+            epi = load_epitran(map_file, post_file)
+            with self._lock:
+                if epi.version != version:
+                    # ハッシュを取った後にファイルが書き換えられた。次の呼び出しで
+                    # 読み込んだ内容のversionとして引けるように登録し、
+                    # ハッシュは計算し直す
+                    self._versions.pop(stat_key, None)
+                self._engines[epi.version] = epi
+                self._build_locks.pop(version, None)
+                _segment_cache.restore_version(epi.version)
+                self._evict(self.maxsize)
+            return epi
+
+    def _get_cached(self, version: str) -> OpenJTalkLabelEpitran | None:
+        """保持しているインスタンスを返す（ロックを取って呼ぶ）"""
+        epi = self._engines.get(version)
+        if epi is not None:
+            self._engines.move_to_end(version)
+        return epi
+
+    def resize(self, maxsize: int) -> None:
+        """上限を変更する（超過分は古いものから破棄する）"""
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict(maxsize)
+
+    def versions(self) -> list[str]:
+        """保持しているインスタンスのversion（古い順）"""
+        with self._lock:
+            return list(self._engines)
+
+    def _evict(self, maxsize: int) -> None:
+        while len(self._engines) > max(maxsize, 1):
+            version, _ = self._engines.popitem(last=False)
+            self._versions = {k: v for k, v in self._versions.items() if v != version}
+            # デフォルトのインスタンスはプールから外れても使われ続ける
+            live = _epitran_instance
+            if live is None or live.version != version:
+                _segment_cache.discard_version(version)
+
+
+def reload_epitran() -> bool:
+    """
+    デフォルトのマッピング・ルールファイルが変更されていればEpitranを差し替える
+
+    新しいインスタンスを構築してから参照を差し替えるため、変換中の呼び出しは
+    古いインスタンスのまま完了する。古いインスタンスによるセグメント
+    キャッシュの変換結果は破棄する。特徴量を求めるLabelFeatureEngineを
+    使っていた場合は、差し替え後の最初の呼び出しで構築しないように、
+    新しいインスタンスのものも構築して差し替えと同時に登録する。
+
+    Returns:
+        差し替えた場合True
+    """
+    global _epitran_instance
+    old = _get_epitran()
+    if _content_hash([_MAP_FILE, _POST_FILE]) == old.version:
+        return False
+
+    new = get_epitran(_MAP_FILE, _POST_FILE)
+    engine = None
+    if old.version in _label_feature_engines:
+        engine = _label_feature_engines.get(new.version) or LabelFeatureEngine(new)
+    with _epitran_lock, _label_feature_lock:
+        _epitran_instance = new
+        if engine is not None:
+            _label_feature_engines[new.version] = engine
+    # 以前に破棄したversionのファイルに戻した場合も結果をキャッシュする
+    _segment_cache.restore_version(new.version)
+    _segment_cache.discard_version(old.version)
+    return True
+
+
+# 監視中の再読み込みで捕捉する例外（編集途中のファイルの読み込み・解析の失敗）
+_RELOAD_ERRORS = (OSError, ValueError, csv.Error, DatafileError, RuleFileError)
+
+
+class EpitranReloader:
+    """
+    デフォルトのマッピング・ルールファイルを監視し、変更されたら
+    バックグラウンドでEpitranを差し替える
+
+    ファイルの更新時刻・サイズをinterval秒ごとに確認し、変わっていれば
+    reload_epitranを呼ぶ。編集途中のファイルなどで読み込み・解析に
+    失敗した場合（_RELOAD_ERRORS）は警告を出して古いインスタンスを
+    使い続け、次の変更を待つ。
+    """
+
+    def __init__(self, interval: float = 1.0):
+        """
+        Args:
+            interval: ファイルを確認する間隔（秒）
+        """
+        self.interval = interval
+        self.reload_count = 0
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="EpitranReloader", daemon=True
+        )
+
+    def start(self) -> "EpitranReloader":
+        """監視を開始する（呼び出した時点のファイルから変更を検出する）"""
+        self._stat_key = _file_stat_key([_MAP_FILE, _POST_FILE])
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """監視を終了する"""
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        stat_key = self._stat_key
+        while not self._stop_event.wait(self.interval):
+            new_stat_key = _file_stat_key([_MAP_FILE, _POST_FILE])
+            if new_stat_key == stat_key:
+                continue
+            stat_key = new_stat_key
+            try:
+                if reload_epitran():
+                    self.reload_count += 1
+            except _RELOAD_ERRORS as e:
+                warnings.warn(f"Failed to reload Epitran: {e!r}", stacklevel=1)
+
+
+def start_epitran_reloader(interval: float = 1.0) -> EpitranReloader:
+    """
+    デフォルトのマッピング・ルールファイルの監視を開始する
+
+    Args:
+        interval: ファイルを確認する間隔（秒）
+
+    Returns:
+        監視スレッド（stopで終了する）
+    """
+    return EpitranReloader(interval).start()
+
+
+def _snapshot_pattern() -> str:
+    """全てのスナップショットにマッチするglobパターン"""
+    return os.path.join(_SNAPSHOT_DIR, "openjtalk_epitran_v*.pickle")
+
+
+def _prune_snapshots() -> None:
+    """最近使った_SNAPSHOT_KEEP個より古いスナップショットを削除する"""
+    snapshots = []
+    for snapshot_file in glob.glob(_snapshot_pattern()):
+        try:
+            snapshots.append((os.path.getmtime(snapshot_file), snapshot_file))
+        except OSError:
+            continue  # 他のプロセスが削除した
+    snapshots.sort(reverse=True)
+    for _, snapshot_file in snapshots[_SNAPSHOT_KEEP:]:
+        try:
+            os.remove(snapshot_file)
+        except OSError:
+            pass
+
+
+def _snapshot_file(version: str) -> str | None:
+    """スナップショットのパス（形式・epitranのバージョン・ファイル内容で決まる）"""
+    if _SNAPSHOT_DIR is None:
+        return None
+    epitran_version = importlib.metadata.version("epitran")
+    return os.path.join(
+        _SNAPSHOT_DIR,
+        f"openjtalk_epitran_v{_SNAPSHOT_FORMAT}_{epitran_version}_{version[:16]}.pickle",
+    )
+
+
+def load_epitran(map_file: str, post_file: str | None) -> OpenJTalkLabelEpitran:
+    """
+    Epitranインスタンスをスナップショットから読み込む
+
+    マッピング・ルールファイルの内容に対応するスナップショットがなければ
+    構築し、次回のためにスナップショットとして保存する。
+
+    Args:
+        map_file: マッピングCSVファイルのパス
+        post_file: ポストプロセッサルールファイルのパス
+
+    Returns:
+        Epitranインスタンス
+    """
+    version = _content_hash([map_file, post_file])
+    snapshot_file = _snapshot_file(version)
+
+    if snapshot_file is not None and os.path.exists(snapshot_file):
+        try:
+            with open(snapshot_file, "rb") as f:
+                epi = pickle.load(f)
+        except (
+            OSError,
+            EOFError,
+            pickle.UnpicklingError,
+            AttributeError,
+            ImportError,
+            TypeError,
+        ):
+            epi = None  # 壊れた・古いスナップショットは作り直す
+        if isinstance(epi, OpenJTalkLabelEpitran) and epi.version == version:
+            epi._custom_map_file = map_file
+            epi._custom_post_file = post_file
+            try:
+                os.utime(snapshot_file)  # 削除の順番を決める最終使用時刻
+            except OSError:
+                pass
+            return epi
+
+    epi = OpenJTalkLabelEpitran(map_file, post_file=post_file)
+    # ハッシュを取った後にファイルが書き換えられた場合も、読み込んだ内容の
+    # versionのスナップショットとして保存する
+    snapshot_file = _snapshot_file(epi.version)
+    if snapshot_file is not None:
+        try:
+            os.makedirs(os.path.dirname(snapshot_file), exist_ok=True)
+            # 書き込み途中のファイルを他のプロセスが読まないように置き換える
+            tmp_file = f"{snapshot_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "wb") as f:
+                pickle.dump(epi, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, snapshot_file)
+            _prune_snapshots()
+        except OSError:
+            pass  # 保存できなくても変換には影響しない
+    return epi
+
+
+class SegmentIPACache:
+    """
+    pau/silで区切られたセグメントのIPA変換結果のLRUキャッシュ
+
+    「はい」やフィラー、文末の「です」など、コーパス中で繰り返し現れる
+    短いセグメントの再変換を省く。キーはEpitranインスタンスのversion
+    （マッピング・ルールファイルの内容のハッシュ）とセグメントの音素ラベルの
+    タプルの組で、versionの異なるインスタンスの結果は混ざらない。
+    インスタンスを破棄したときはdiscard_versionでその結果を破棄し、
+    破棄した後に古いインスタンスで変換を終えた呼び出しのputも無視する。
+    """
+
+    def __init__(self, maxsize: int):
+        """
+        Args:
+            maxsize: 保持するセグメント数の上限（0でキャッシュしない）
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: OrderedDict[tuple[str, tuple[str, ...]], str] = OrderedDict()
+        # discard_versionで破棄したversion（putを受け付けない）
+        self._discarded: set[str] = set()
+        self._lock = threading.Lock()
+
+    def get(self, version: str, segment: tuple[str, ...]) -> str | None:
+        """キャッシュされたIPAを返す（なければNone）"""
+        key = (version, segment)
+        with self._lock:
+            ipa = self._data.get(key)
+            if ipa is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return ipa
+
+    def put(self, version: str, segment: tuple[str, ...], ipa: str) -> None:
+        """IPAをキャッシュし、上限を超えたら最も古いものを捨てる"""
+        if self.maxsize <= 0:
+            return
+        key = (version, segment)
+        with self._lock:
+            if version in self._discarded:
+                return
+            self._data[key] = ipa
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def discard_version(self, version: str) -> None:
+        """versionのインスタンスによる変換結果を全て破棄し、以降のputを無視する"""
+        with self._lock:
+            self._discarded.add(version)
+            for key in [key for key in self._data if key[0] == version]:
+                del self._data[key]
+
+    def restore_version(self, version: str) -> None:
+        """discard_versionで破棄したversionのputを再び受け付ける"""
+        with self._lock:
+            self._discarded.discard(version)
+
+    def resize(self, maxsize: int) -> None:
+        """上限を変更する（超過分は古いものから捨てる）"""
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._data) > max(maxsize, 0):
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict[str, int]:
+        """ヒット数・ミス数・追い出し数・現在のサイズ"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+        }
+
+
+_segment_cache = SegmentIPACache(_SEGMENT_CACHE_SIZE)
+_epitran_pool = EpitranPool(_EPITRAN_POOL_SIZE)
+
+
+def configure_segment_cache(maxsize: int) -> SegmentIPACache:
+    """
+    phoneme_labels_to_ipaが使うセグメントキャッシュの上限を設定する
+
+    Args:
+        maxsize: 保持するセグメント数の上限（0でキャッシュしない）
+
+    Returns:
+        セグメントキャッシュ（統計の取得用）
+    """
+    _segment_cache.resize(maxsize)
+    return _segment_cache
+
+
+@contextlib.contextmanager
+def profile_postprocess_rules(
+    epi: OpenJTalkLabelEpitran | None = None,
+) -> Iterator[RuleProfile]:
+    """
+    with文の中の変換についてpostprocessorのルールごとの計測を行う
+
+    セグメントキャッシュにヒットしたセグメントはpostprocessorを通らず
+    計測から漏れるため、計測中はキャッシュを無効にする（終了時に元の上限に
+    戻すが、キャッシュの内容は空になる）。LabelFeatureEngineが特徴量テーブルを
+    埋めるための変換は、コーパスの変換ではないため計測しない。計測は1スレッドで行う。
+
+    Args:
+        epi: 計測するEpitran（省略時はデフォルトのマッピング）
+
+    Yields:
+        計測結果（with文を抜けた後にreportで確認する）
+
+    Raises:
+        TypeError: Epitranにカスタムpostprocessorがない場合
+    """
+    if epi is None:
+        epi = _get_epitran()
+    if not isinstance(epi.postprocessor, _CustomProcessor):
+        raise TypeError("Epitran has no custom postprocessor to profile")
+
+    maxsize = _segment_cache.maxsize
+    _segment_cache.resize(0)
+    profile = epi.postprocessor.enable_profiling()
+    try:
+        yield profile
+    finally:
+        epi.postprocessor.disable_profiling()
+        _segment_cache.resize(maxsize)
+
+
+def read_lab_file(lab_file: str) -> str:
+    """
+    labファイルから音素ラベル列を読み込む
+
+    Args:
+        lab_file: labファイルのパス
+
+    Returns:
+        スペース区切りの音素ラベル列
+    """
+    labels = []
+    with Path(lab_file).open(encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            parts = line.split()
+            if len(parts) >= 3:
+                label = parts[2]
+                labels.append(label)
+    return " ".join(labels)
+
+
+def text_to_phoneme_labels(text: str) -> str:
+    """
+    日本語テキストをOpenJTalk音素ラベル列に変換する
+
+    Args:
+        text: 日本語テキスト
+
+    Returns:
+        スペース区切りの音素ラベル列
+    """
+    return pyopenjtalk.g2p(text)
+
+
+def text_to_phoneme_list(text: str) -> list[str]:
+    """
+    日本語テキストをOpenJTalk音素ラベルのリストに変換する
+
+    Args:
+        text: 日本語テキスト
+
+    Returns:
+        音素ラベルのリスト
+    """
+    phonemes = pyopenjtalk.g2p(text)
+    return phonemes.split(" ") if phonemes else []
+
+
+def phoneme_labels_to_ipa(
+    phoneme_labels: str, epi: OpenJTalkLabelEpitran | None = None
+) -> str:
+    """
+    OpenJTalk音素ラベル列をIPA音声記号列に変換する
+
+    pauまたはsilラベルがある場合は、それらで分割して各部分を変換し、
+    スペースで結合して返す。
+
+    Args:
+        phoneme_labels: スペース区切りの音素ラベル列
+        epi: 変換に使うEpitran（省略時はデフォルトのマッピング、
+            別のマッピングで変換する場合はget_epitranで取得する）
+
+    Returns:
+        IPA音声記号列（pauまたはsilがあった場合はスペース区切り）
+    """
+    if epi is None:
+        epi = _get_epitran()
+    version = epi.version
+    cache = _segment_cache
+
+    # pauまたはsilで区切った範囲ごとに、キャッシュにないセグメントだけ
+    # ラベル境界を保ったままモーラ単位にまとめて一括変換する。同じ
+    # セグメントが繰り返し現れる場合は1回だけ変換して全ての位置に使う
+    phonemes = phoneme_labels.split()
+    ipa_segments: list[str | None] = []
+    misses: dict[tuple[str, ...], list[int]] = {}
+    for start, end in iter_silence_spans(phonemes):
+        segment = tuple(phonemes[start:end])
+        ipa = cache.get(version, segment)
+        if ipa is None:
+            misses.setdefault(segment, []).append(len(ipa_segments))
+        ipa_segments.append(ipa)
+
+    if misses:
+        results, errors = epi.transliterate_many(list(misses))
+        if errors:
+            raise errors[min(errors)]
+        for (segment, indices), ipa in zip(misses.items(), results):
+            for index in indices:
+                ipa_segments[index] = ipa
+            cache.put(version, segment, ipa)
+
+    return " ".join(ipa_segments)
+
+
+def split_by_silence_markers(phoneme_labels: str) -> list[str]:
+    """
+    音素ラベル列をpauまたはsilで分割する
+
+    Args:
+        phoneme_labels: スペース区切りの音素ラベル列
+
+    Returns:
+        pauまたはsilで分割されたセグメントのリスト
+    """
+    phonemes = phoneme_labels.split()
+    return [
+        " ".join(phonemes[start:end]) for start, end in iter_silence_spans(phonemes)
+    ]
+
+
+def iter_silence_spans(phonemes: Sequence[str]) -> Iterator[tuple[int, int]]:
+    """
+    音素ラベルのリストをpauまたはsilで区切った範囲を順に返す
+
+    空のセグメント（pau・silの連続や先頭・末尾）は返さない。
+
+    Args:
+        phonemes: 音素ラベルのリスト
+
+    Yields:
+        セグメントの(開始位置, 終了位置)（phonemes[start:end]がセグメント）
+    """
+    start = 0
+    for i, phoneme in enumerate(phonemes):
+        if phoneme == "pau" or phoneme == "sil":
+            if i > start:
+                yield start, i
+            start = i + 1
+    if len(phonemes) > start:
+        yield start, len(phonemes)
+
+
+def silence_spans(phonemes: Sequence[str]) -> list[tuple[int, int]]:
+    """
+    音素ラベルのリストをpauまたはsilで区切った範囲のリストを返す
+
+    Args:
+        phonemes: 音素ラベルのリスト
+
+    Returns:
+        セグメントの(開始位置, 終了位置)のリスト
+    """
+    return list(iter_silence_spans(phonemes))
+
+
+def text_to_ipa(text: str) -> str:
+    """
+    日本語テキストをIPA音声記号列に変換する
+
+    Args:
+        text: 日本語テキスト
+
+    Returns:
+        IPA音声記号列
+    """
+    phoneme_labels = text_to_phoneme_labels(text)
+    return phoneme_labels_to_ipa(phoneme_labels)
+
+
+# =============================================================================
+# コーパス変換
+# =============================================================================
+
+
+class UnknownLabelLog:
+    """
+    コーパス変換で未知ラベルを含んだ発話を記録する
+
+    phoneme_labels_to_ipa_corpusに渡すと、未知ラベルを含む発話があっても
+    例外を送出せずに記録し、残りの発話の変換を続ける。
+    """
+
+    def __init__(self):
+        self.num_utterances = 0
+        # (発話ID, [(ラベル位置, 未知ラベル), ...])
+        self.failures: list[tuple[str, list[tuple[int, str]]]] = []
+        # (発話ID, エラーメッセージ)（読み込みや特徴量の計算に失敗した発話）
+        self.errors: list[tuple[str, str]] = []
+
+    def add(self, utterance_id: str, unknown: list[tuple[int, str]]) -> None:
+        """未知ラベルを含んだ発話を記録する"""
+        self.failures.append((utterance_id, unknown))
+
+    def add_error(self, utterance_id: str, message: str) -> None:
+        """未知ラベル以外の理由で変換できなかった発話を記録する"""
+        self.errors.append((utterance_id, message))
+
+    def extend(self, other: "UnknownLabelLog") -> None:
+        """otherの記録を後ろに連結する"""
+        self.num_utterances += other.num_utterances
+        self.failures += other.failures
+        self.errors += other.errors
+
+    def label_counts(self) -> Counter[str]:
+        """未知ラベルごとの出現回数"""
+        return Counter(label for _, unknown in self.failures for _, label in unknown)
+
+    def write_report(self, report_file: str) -> None:
+        """
+        未知ラベルのレポートをタブ区切りで書き出す
+
+        Args:
+            report_file: 出力先のパス
+        """
+        with open(report_file, "w", encoding="utf-8") as f:
+            f.write(f"# utterances\t{self.num_utterances}\n")
+            f.write(f"# failed\t{len(self.failures)}\n")
+            f.write(f"# errors\t{len(self.errors)}\n")
+            f.write("# label\tcount\n")
+            f.writelines(
+                f"{label}\t{count}\n"
+                for label, count in self.label_counts().most_common()
+            )
+            f.write("# utterance_id\tposition:label\n")
+            failures = (
+                (utterance_id, " ".join(f"{pos}:{label}" for pos, label in unknown))
+                for utterance_id, unknown in self.failures
+            )
+            f.writelines(
+                f"{utterance_id}\t{positions}\n" for utterance_id, positions in failures
+            )
+            f.write("# utterance_id\terror\n")
+            f.writelines(
+                f"{utterance_id}\t{' '.join(message.split())}\n"
+                for utterance_id, message in self.errors
+            )
+
+
+def phoneme_labels_to_ipa_corpus(
+    utterances: Iterable[tuple[str, str]],
+    error_log: UnknownLabelLog,
+    epi: OpenJTalkLabelEpitran | None = None,
+) -> Iterator[tuple[str, str | None]]:
+    """
+    複数発話の音素ラベル列をIPA音声記号列に変換する
+
+    phoneme_labels_to_ipaと同じ変換を行うが、未知ラベルを含む発話は
+    error_logに記録してNoneを返し、残りの発話の変換を続ける。
+
+    Args:
+        utterances: (発話ID, スペース区切りの音素ラベル列)のイテラブル
+        error_log: 未知ラベルの記録先
+        epi: 変換に使うEpitran（省略時はデフォルトのマッピング）
+
+    Yields:
+        (発話ID, IPA音声記号列（未知ラベルを含む場合はNone）)
+    """
+    if epi is None:
+        epi = _get_epitran()
+    for utterance_id, phoneme_labels in utterances:
+        error_log.num_utterances += 1
+        phonemes = phoneme_labels.split()
+        spans = silence_spans(phonemes)
+        ipa_segments, errors = epi.transliterate_many(
+            [phonemes[start:end] for start, end in spans]
+        )
+        if not errors:
+            yield utterance_id, " ".join(ipa_segments)
+            continue
+
+        # 失敗したセグメントだけ再走査して未知ラベルの位置を求める
+        unknown = []
+        for index in sorted(errors):
+            start, end = spans[index]
+            positions = []
+            epi._map_labels(phonemes[start:end], {}, positions)
+            unknown.extend((start + pos, label) for pos, label in positions)
+        error_log.add(utterance_id, unknown)
+        yield utterance_id, None
+
+
+# =============================================================================
+# ベクトル化特徴量エンジン
+# =============================================================================
+
+# 後ろ2ラベルまでの文脈でIPAが変わる単独ラベル（撥音・促音）
+_CONTEXT_LABELS = ("N", "cl")
+
+# pau・silの行を埋める値（panphonの特徴量は+1/-1/0で、全て0の音素はない）
+_SILENCE_FEATURE_VALUE = 0
+
+# epitranのRulesは置換回数としてre.U（=32）を渡すため、1つのルールが
+# 1文字列に適用されるのは32箇所まで
+_RULE_SUB_LIMIT = 32
+
+
+def _ipa_features(ipa: str) -> np.ndarray:
+    """
+    IPA音声記号列のpanphon特徴量を(セグメント数, 特徴量数)のint8配列で返す
+
+    空白などpanphonのセグメントにならない文字は無視される。
+    """
+    ft = get_feature_table()
+    rows = [seg.numeric() for seg in ft.word_fts(ipa)]
+    return np.array(rows, dtype=np.int8).reshape(len(rows), len(ft.names))
+
+
+def _expand_rule_pattern(pattern: str, limit: int = 4096) -> list[str] | None:
+    """
+    リテラル・グループ・選択・^・$だけからなる正規表現がマッチする文字列を列挙する
+
+    Returns:
+        マッチする文字列のリスト（^・$は文字として含む。それ以外の構文を
+        含む場合や、文字列がlimitを超える場合はNone）
+    """
+    pos = 0
+
+    def alternation() -> list[str]:
+        nonlocal pos
+        alternatives = sequence()
+        while pos < len(pattern) and pattern[pos] == "|":
+            pos += 1
+            alternatives += sequence()
+        return alternatives
+
+    def sequence() -> list[str]:
+        nonlocal pos
+        result = [""]
+        while pos < len(pattern) and pattern[pos] not in "|)":
+            if pattern[pos] == "(":
+                pos += 1
+                inner = alternation()
+                if pos >= len(pattern) or pattern[pos] != ")":
+                    raise ValueError(pattern)
+            elif pattern[pos] in ".[]{}*+?\\":
+                raise ValueError(pattern)
+            else:
+                inner = [pattern[pos]]
+            pos += 1
+            result = [a + b for a in result for b in inner]
+            if len(result) > limit:
+                raise ValueError(pattern)
+        return result
+
+    try:
+        alternatives = alternation()
+    except ValueError:
+        return None
+    if pos != len(pattern):
+        return None
+    return list(dict.fromkeys(alternatives))
+
+
+def _anchored_alternatives(
+    pattern: str, anchor: str, at_start: bool
+) -> list[tuple[str, bool]] | None:
+    """_expand_rule_patternの文字列を(リテラル, 端に固定されているか)にする"""
+    alternatives = _expand_rule_pattern(pattern)
+    if alternatives is None:
+        return None
+    result = []
+    for alternative in alternatives:
+        anchored = (
+            alternative.startswith(anchor) if at_start else alternative.endswith(anchor)
+        )
+        literal = alternative[1:] if anchored and at_start else alternative
+        literal = literal[:-1] if anchored and not at_start else literal
+        if "^" in literal or "$" in literal:
+            return None
+        result.append((literal, anchored))
+    return result
+
+
+def _context_rest(string: str, rest: str, anchored: bool, left: bool) -> str | None:
+    """
+    文脈のリテラルの残りrestを、書き換え対象に近い側から文字列stringに当てる
+
+    Returns:
+        stringの外側でマッチさせる必要がある残り（端に固定されていない""は
+        マッチが確定したことを表す）。マッチしえない場合はNone
+    """
+    if string.endswith(rest) if left else string.startswith(rest):
+        return "" if not anchored or len(string) == len(rest) else None
+    if rest.endswith(string) if left else rest.startswith(string):
+        return rest[: len(rest) - len(string)] if left else rest[len(string) :]
+    return None
+
+
+def _context_links(
+    label: str,
+    rest: str,
+    anchored: bool,
+    strings: Mapping[str, Mapping[str, tuple]],
+    neighbours: Mapping[str, list[str | None]],
+    left: bool,
+    allowed: frozenset | None = None,
+    distance: int = 1,
+) -> set[tuple[int, str | None]] | None:
+    """
+    文脈の残りrestがlabelの隣のラベルにマッチしうるかを調べる
+
+    Args:
+        label: 文脈を探し始めるラベル
+        rest: マッチさせる文脈の残り
+        anchored: 文脈が発話の端に固定されているか
+        strings: ラベル → その時点でとりうる文字列 → その文字列になりうる
+            (左, 右)の隣のラベルの集合（Noneは制約なし）
+        neighbours: ラベル → 文脈の側に隣接しうるラベル（Noneは発話の端）
+        left: 左の文脈か
+        allowed: labelの文字列が文脈の側に許す隣のラベル（Noneは制約なし）
+
+    Returns:
+        マッチに関わりうる(labelからの距離, ラベル（Noneは発話の端）)の集合
+        （マッチしえない場合はNone）
+    """
+    links: set[tuple[int, str | None]] = set()
+    for neighbour in neighbours[label]:
+        if allowed is not None and neighbour not in allowed:
+            continue
+        if neighbour is None:
+            if rest == "" and anchored:
+                links.add((distance, None))
+            continue
+        for string, (lefts, rights) in strings[neighbour].items():
+            # labelと隣接するときにはとりえない文字列は飛ばす
+            facing = rights if left else lefts
+            if facing is not None and label not in facing:
+                continue
+            remaining = _context_rest(string, rest, anchored, left)
+            if remaining is None:
+                continue
+            if remaining == "" and not anchored:
+                links.add((distance, neighbour))
+                continue
+            inner = _context_links(
+                neighbour,
+                remaining,
+                anchored,
+                strings,
+                neighbours,
+                left,
+                lefts if left else rights,
+                distance + 1,
+            )
+            if inner is not None:
+                links.add((distance, neighbour))
+                links |= inner
+    return links or None
+
+
+def _merge_allowed(a: frozenset | None, b: frozenset | None) -> frozenset | None:
+    """隣のラベルの制約の和（どちらかが制約なしなら制約なし）"""
+    return None if a is None or b is None else a | b
+
+
+def _intersect_allowed(a: frozenset | None, b: frozenset | None) -> frozenset | None:
+    """隣のラベルの制約の積（制約なしのものは無視する）"""
+    if a is None:
+        return b
+    return a if b is None else a & b
+
+
+def _check_table_rules(
+    ipa_map: Mapping[str, str],
+    standalone: list[str],
+    consonants: list[str],
+    follows: dict[str, list[str | None]],
+    fields: list[tuple[str, ...]],
+) -> tuple[list[str], list[tuple[list[str], int]]]:
     """
-    OpenJTalk音素ラベルからIPAへ変換するEpitran
+    ポストプロセスのルールがLabelFeatureEngineのテーブルで再現できるか検査する
 
-    SimpleEpitranを継承し、以下を修正:
-    - 大文字小文字を区別（regex.Iフラグ削除、.lower()削除）
-    - カスタムCSVファイルを使用
+    テーブルは、各ラベルのIPAが前の1ラベル、子音ラベルなら後続の母音、
+    N・clなら後ろ2ラベルまでで決まるとして作る。ルールを記述順にたどり、
+    各ラベルがその時点でとりうる文字列と、その文字列が何ラベル先までの文脈で
+    決まりうるか（左右の到達距離）を保守的に見積もって、この範囲に収まることを
+    確かめる。書き換え対象は1文字に限り、隣のラベルの並びはfollows（子音の
+    後は母音）に従うものだけを考える。見積もりは上限のため、再現できるルールを
+    扱えないと判定することはある（その場合は参照実装で変換する）。
+    変換結果の等価性はverify・fuzzのスクリプトで確かめる。
+
+    Returns:
+        (書き換えが起きうるラベル（1つのルールが1セグメントで置換するのは
+         このラベルの数まで）,
+         文脈の文字を消費して近くの書き換えを妨げうるルールごとの
+         (書き換えが起きうるラベル, その間のラベル数がこれ以下だと妨げうる距離))
+
+    Raises:
+        ValueError: テーブルでは再現できないルールがある場合
     """
+    labels = standalone + consonants
+    # ラベル → とりうる文字列 → その文字列になりうる(左, 右)の隣のラベル
+    strings: dict[str, dict[str, tuple]] = {
+        label: {ipa_map[label]: (None, None)} for label in standalone
+    }
+    for consonant in consonants:
+        vowels: dict[str, set[str]] = defaultdict(set)
+        for vowel in follows[consonant]:
+            mora, vowel_ipa = ipa_map[consonant + vowel], ipa_map[vowel]
+            if len(mora) <= len(vowel_ipa) or not mora.endswith(vowel_ipa):
+                raise ValueError(
+                    f"Mora {consonant + vowel} ({mora}) does not split into "
+                    f"{consonant} and {vowel} ({vowel_ipa})"
+                )
+            vowels[mora[: -len(vowel_ipa)]].add(vowel)
+        strings[consonant] = {s: (None, frozenset(vs)) for s, vs in vowels.items()}
+    neighbours = {
+        True: {
+            label: [None] + [p for p in labels if label in follows[p]]
+            for label in labels
+        },
+        False: follows,
+    }
+    # ラベル → 文字列が(左, 右)の何ラベル先までの文脈で決まりうるか
+    # （子音ラベルの文字列は後続の母音で決まる）
+    reach = {label: (0, int(label in consonants)) for label in labels}
+
+    counted: set[str] = set()
+    overlaps: list[tuple[list[str], int]] = []
+    for rule_fields in fields:
+        if rule_fields[0] != "sub":
+            raise ValueError(f"Metathesis rule is not supported: {rule_fields}")
+        _, a, b, X, Y = rule_fields
+        rule = f"{a} -> {b or 0} / {X} _ {Y}"
+        targets = _expand_rule_pattern(a)
+        xs = _anchored_alternatives(X, "^", at_start=True)
+        ys = _anchored_alternatives(Y, "$", at_start=False)
+        if targets is None or xs is None or ys is None or not b:
+            raise ValueError(f"Rule pattern is not supported: {rule}")
+        if any(len(t) != 1 or t in "^$" for t in targets):
+            raise ValueError(f"Rule target is not a single character: {rule}")
+
+        updates: dict[str, dict[str, tuple]] = defaultdict(dict)
+        new_reach = dict(reach)
+        fired: set[str] = set()
+        span = [0, 0]
+        for label in labels:
+            for s, (lefts, rights) in strings[label].items():
+                hits = []
+                for p, char in enumerate(s):
+                    if char not in targets:
+                        continue
+                    # 左右の文脈ごとに(ラベル内でマッチしうるか, 関わる隣のラベル)
+                    sides = []
+                    for own, alternatives, left, allowed in (
+                        (s[:p], xs, True, lefts),
+                        (s[p + 1 :], ys, False, rights),
+                    ):
+                        inside = False
+                        links: set[tuple[int, str | None]] = set()
+                        for literal, anchored in alternatives:
+                            rest = _context_rest(own, literal, anchored, left)
+                            if rest == "" and not anchored:
+                                inside = True
+                            elif rest is not None:
+                                links |= (
+                                    _context_links(
+                                        label,
+                                        rest,
+                                        anchored,
+                                        strings,
+                                        neighbours[left],
+                                        left,
+                                        allowed,
+                                    )
+                                    or set()
+                                )
+                        sides.append((inside, links))
+                    if all(inside or links for inside, links in sides):
+                        hits.append((p, sides))
+                if len(hits) > 1:
+                    raise ValueError(f"Rule may rewrite label {label} twice: {rule}")
+
+                for p, sides in hits:
+                    fired.add(label)
+                    # 書き換え後の文字列は、文脈がラベル内でマッチしない限り
+                    # 隣がマッチしうるラベルのときにだけ現れる
+                    requirements = [
+                        None if inside else frozenset(n for d, n in links if d == 1)
+                        for inside, links in sides
+                    ]
+                    new = s[:p] + b + s[p + 1 :]
+                    constraint = (
+                        _intersect_allowed(lefts, requirements[0]),
+                        _intersect_allowed(rights, requirements[1]),
+                    )
+                    old = updates[label].get(new, strings[label].get(new))
+                    if old is not None:
+                        constraint = (
+                            _merge_allowed(old[0], constraint[0]),
+                            _merge_allowed(old[1], constraint[1]),
+                        )
+                    updates[label][new] = constraint
+
+                    # 隣のラベルの文字列が決まる文脈の分だけ到達距離が延びる
+                    left_reach, right_reach = new_reach[label]
+                    (_, left_links), (_, right_links) = sides
+                    for distance, other in left_links:
+                        other_left, other_right = reach.get(other, (0, 0))
+                        left_reach = max(left_reach, distance + other_left)
+                        right_reach = max(right_reach, other_right - distance)
+                        span[0] = max(span[0], distance)
+                    for distance, other in right_links:
+                        other_left, other_right = reach.get(other, (0, 0))
+                        right_reach = max(right_reach, distance + other_right)
+                        left_reach = max(left_reach, other_left - distance)
+                        span[1] = max(span[1], distance)
+                    new_reach[label] = (left_reach, right_reach)
+        for label, new_strings in updates.items():
+            strings[label].update(new_strings)
+        reach = new_reach
+        counted |= fired
+
+        # マッチの範囲（文脈を含む）が重なりうるルールは、先のマッチが文脈を
+        # 消費して後のマッチを妨げることがある
+        fulls = {x + t + y for x, _ in xs for t in targets for y, _ in ys}
+        prefixes = {f[:k] for f in fulls for k in range(1, len(f) + 1)}
+        overlap = any(
+            f[d:] in prefixes
+            or any(f[d : d + k] in fulls for k in range(1, len(f) - d))
+            for f in fulls
+            for d in range(1, len(f))
+        )
+        if overlap and fired and sum(span) > 0:
+            overlaps.append((sorted(fired), sum(span)))
 
-    def __init__(self, map_file: str, post_file: str | None = None, **kwargs):
+    for label, (left_reach, right_reach) in reach.items():
+        limit = 2 if label in _CONTEXT_LABELS else int(label in consonants)
+        if left_reach > 1 or right_reach > limit:
+            raise ValueError(
+                f"Label {label} depends on context outside the table "
+                f"(left {left_reach}, right {right_reach})"
+            )
+    return sorted(counted), overlaps
+
+
+class LabelFeatureEngine:
+    """
+    音素ラベルIDのテーブル参照でpanphon特徴量を求めるエンジン
+
+    ポストプロセスのルールが局所的なら、各ラベルのIPAセグメントは
+    (前のラベル, ラベル, 次のラベル, 次の次のラベル)で決まる。その組ごとの
+    セグメントを参照実装（OpenJTalkLabelEpitran）で変換したテーブルを引き、
+    発話をラベルID配列にしてNumPyのインデックス参照で特徴量行列を作る。
+    テーブルは入力に現れた組だけを最初の参照時に変換して埋めるため、構築は
+    すぐに終わる。ラベルごとのセグメント数（kwのように2つになるものがある）も
+    テーブルに持つため、結果はIPA音声記号列から求めた特徴量と行単位で一致する。
+
+    1発話ずつのfeaturesも参照実装より速いが、NumPyの呼び出しの固定費が
+    大半を占めるため、多数の発話はfeatures_manyでまとめて求める方が速い。
+
+    この前提が成り立つかは構築時に_check_table_rulesでルールを検査し、
+    成り立たないルールがあればテーブルを使わずに全て参照実装で変換する。
+    テーブルでは再現できない次のセグメントだけは参照実装で変換する:
+    - テーブルにない組み合わせ（未知ラベルや、母音が続かない子音など）
+    - 文脈を置換範囲に含むルールが近い位置で2回書き換えうる並び（「N 母音 N」
+      など。先の置換が文脈を消費して、後の置換が起きないことがある）
+    - 置換回数が_RULE_SUB_LIMITを超えうる数の、書き換えが起きうるラベル
+      （N・clなど）を含むセグメント
+    """
+
+    # 境界（無音・発話の端）のID
+    PAD = 0
+
+    def __init__(self, epi: OpenJTalkLabelEpitran):
         """
         Args:
-            map_file: マッピングCSVファイルのパス（必須）
-            post_file: ポストプロセッサルールファイルのパス（任意）
+            epi: 参照実装のEpitran
         """
-        self._custom_map_file = map_file
-        self._custom_post_file = post_file
+        self.epi = epi
+        self.version = epi.version
+        self.feature_names = list(get_feature_table().names)
+
+        # マッピングのキーはそのまま1ラベルになるもの（母音・N・cl）と、
+        # 子音ラベルと後続ラベルを結合したもの（モーラ）
+        ipa_map = epi._ipa_map
+        morae = {
+            key
+            for key in ipa_map
+            if any(
+                key[:i] not in ipa_map and key[i:] in ipa_map
+                for i in range(1, len(key))
+            )
+        }
+        standalone = sorted(set(ipa_map) - morae)
+        follows: dict[str, list[str]] = defaultdict(list)
+        for key in sorted(morae):
+            for v in standalone:
+                if key.endswith(v) and key[: -len(v)] not in ipa_map:
+                    follows[key[: -len(v)]].append(v)
+        consonants = sorted(follows)
+
+        self.labels = standalone + consonants
+        if len(self.labels) + 2 > 256:
+            raise ValueError(f"Too many labels for uint8 ids: {len(self.labels)}")
+        self.ids = {label: i + 1 for i, label in enumerate(self.labels)}
+        self.unk_id = len(self.labels) + 1
+        num_ids = self.unk_id + 1
+
+        # encodeで引くID（pau・silはPAD）
+        self._encode_ids = {**self.ids, **dict.fromkeys(_SILENCE_LABELS, self.PAD)}
+
+        for label in standalone:
+            follows[label] = [None] + standalone + consonants
+        follows = dict(follows)
+        processor = epi.postprocessor if epi.postproc else None
+        fields = (
+            processor.rules._fields if isinstance(processor, _CustomProcessor) else []
+        )
+        try:
+            counted, overlaps = _check_table_rules(
+                ipa_map, standalone, consonants, follows, fields
+            )
+        except ValueError as e:
+            # テーブルを作らず、全てのセグメントを参照実装で変換する
+            warnings.warn(
+                f"Postprocess rules are not supported by the feature table; "
+                f"falling back to the reference implementation: {e}"
+            )
+            counted, overlaps = [], []
+            supported = False
+        else:
+            supported = True
+        # 置換回数が_RULE_SUB_LIMITに届きうるかを数えるラベル
+        self._counted = self._id_mask(counted, num_ids)
+        reaches: dict[tuple[str, ...], int] = {}
+        for fired, reach in overlaps:
+            reaches[tuple(fired)] = max(reaches.get(tuple(fired), 0), reach)
+        self._overlaps = [
+            (self._id_mask(fired, num_ids), reach) for fired, reach in reaches.items()
+        ]
+
+        self._supported = supported
+        self._follows = follows
+        self._consonants = frozenset(consonants)
+        # IDごとのラベル（PADと未知ラベルはNone）
+        self._id_labels = [None, *self.labels, None]
+        # 各ラベルのポストプロセス前のセグメント数（ルールはセグメントを
+        # 1対1で書き換えるので、ポストプロセス後も変わらない）
+        self._seg_counts = {
+            key: len(get_feature_table().ipa_segs(ipa))
+            for key, ipa in epi._ipa_map.items()
+        }
 
-        # 親のコンストラクタ呼び出し
-        # 'dummy-Latn'は存在しないが、後でg2pを上書きするので問題ない
-        super().__init__("dummy-Latn", preproc=False, postproc=False, **kwargs)
+        # (前, 対象, 次, 次の次)のラベルID → 特徴量のグループ+1（0は未変換、
+        # -1はテーブルにない組み合わせ）。使われた組み合わせだけを最初の
+        # 参照時に変換して埋める（np.zerosはページを書き込むまで確保しない）
+        self._table = np.zeros((num_ids,) * 4, dtype=np.int16)
+        self._groups: dict[tuple[str, ...], int] = {}
+        self._group_rows: list[np.ndarray] = []
+        self._set_groups([])
+        self._fill_lock = threading.Lock()
+
+    def __getstate__(self):
+        """pickle用の状態（テーブルは埋めた要素だけを持つ）"""
+        state = self.__dict__.copy()
+        del state["_fill_lock"]
+        filled = np.nonzero(self._table)
+        state["_table"] = (self._table.shape, filled, self._table[filled])
+        return state
+
+    def __setstate__(self, state):
+        shape, filled, values = state["_table"]
+        state["_table"] = np.zeros(shape, dtype=np.int16)
+        state["_table"][filled] = values
+        self.__dict__.update(state)
+        self._fill_lock = threading.Lock()
+
+    def _id_mask(self, labels: Iterable[str], num_ids: int) -> np.ndarray:
+        """ラベルIDで引くと、labelsのラベルでTrueになる配列"""
+        mask = np.zeros(num_ids, dtype=bool)
+        mask[[self.ids[label] for label in labels]] = True
+        return mask
+
+    def _set_groups(self, new_groups: list[tuple[str, ...]]) -> None:
+        """
+        特徴量のグループを追加し、グループごとの配列を作り直す
 
-        # カスタムpostprocessorを設定
-        if post_file:
-            self.postprocessor = _CustomProcessor(post_file)
-            self.postproc = True
+        配列は1つのタプルにまとめて差し替えるため、_lookupはテーブルを
+        引いた後に読んだタプルで、そのテーブルの値のグループを全て引ける。
+        """
+        for group in new_groups:
+            if group not in self._groups:
+                self._groups[group] = len(self._groups)
+                self._group_rows.append(_ipa_features("".join(group)))
+        groups = list(self._groups)
+        # グループごとのIPAと、その特徴量の行の範囲（末尾は空のグループ（-1）の分）
+        group_ipa = np.array(
+            [unicodedata.normalize("NFC", "".join(g)) for g in groups] + [""],
+            dtype=object,
+        )
+        group_len = np.array([len(group) for group in groups] + [0], dtype=np.intp)
+        features = np.concatenate(
+            self._group_rows or [np.zeros((0, len(self.feature_names)), dtype=np.int8)]
+        )
+        self._group_arrays = (
+            group_ipa,
+            group_len,
+            np.cumsum(group_len) - group_len,
+            features,
+        )
 
-    def _load_g2p_map(self, code: str, rev: bool):
-        """カスタムファイルからマッピングを読み込む（大文字小文字を区別）"""
-        g2p = defaultdict(list)
-        if not os.path.exists(self._custom_map_file):
-            return g2p
+    def _window(self, key: tuple[int, ...]) -> tuple[tuple, list[str] | None, int]:
+        """
+        テーブルの添字の組を、値を共有する範囲と変換するラベル列にする
 
-        with open(self._custom_map_file, "r", encoding="utf-8") as f:
-            reader = csv.reader(f)
-            next(reader)  # ヘッダー(Orth,Phon)をスキップ
-            for row in reader:
-                if len(row) < 2:
-                    continue
-                graph, phon = row[0], row[1]
-                graph = unicodedata.normalize("NFD", graph)
-                phon = unicodedata.normalize("NFD", phon)
-                if not self.tones:
-                    phon = regex.sub("[˩˨˧˦˥]", "", phon)
-                g2p[graph].append(phon)
-        return g2p
+        Returns:
+            (値を共有するテーブルの範囲（Noneはその次元の全て）, 参照実装で
+             変換するラベル列（テーブルにない組み合わせならNone）,
+             ラベル列中の対象ラベルの位置)
+        """
+        prev_id, cur_id, nxt_id, nxt2_id = (int(i) for i in key)
+        prev, cur, nxt, nxt2 = (self._id_labels[i] for i in key)
+        follows = self._follows
+        if cur in self._consonants:
+            index = (prev_id, cur_id, nxt_id, None)
+        elif cur not in _CONTEXT_LABELS or nxt_id == self.PAD:
+            index = (prev_id, cur_id, nxt_id if cur in _CONTEXT_LABELS else None, None)
+        else:
+            index = (prev_id, cur_id, nxt_id, nxt2_id)
+
+        head = [] if prev is None else [prev]
+        if (
+            cur is None
+            or (prev is None and prev_id != self.PAD)
+            or (prev is not None and cur not in follows[prev])
+            or not self._supported
+        ):
+            return index, None, 0
+        if cur in self._consonants:
+            if nxt not in follows[cur]:
+                return index, None, 0
+            return index, head + [cur, nxt], len(head)
+        if cur not in _CONTEXT_LABELS or nxt_id == self.PAD:
+            return index, head + [cur], len(head)
+        if nxt is None or (nxt2 is None and nxt2_id != self.PAD):
+            return index, None, 0
+        tail = [nxt]
+        if nxt2 is not None:
+            if nxt2 not in follows[nxt]:
+                return index, None, 0
+            tail.append(nxt2)
+            # 子音で終わる場合は後続の母音を補う
+            if nxt2 in self._consonants:
+                tail.append(follows[nxt2][0])
+        elif None not in follows[nxt]:
+            return index, None, 0
+        return index, head + [cur] + tail, len(head)
+
+    def _fill(self, keys: np.ndarray) -> None:
+        """
+        テーブルの未変換の要素を、文脈ごとのIPAセグメントを参照実装で変換して埋める
 
-    def _construct_regex(self, g2p_keys):
-        """正規表現を構築（大文字小文字を区別、regex.Iなし）"""
-        graphemes = sorted(g2p_keys, key=len, reverse=True)
-        if not graphemes:
-            return regex.compile(r"(.)")  # フォールバック
-        return regex.compile(f"({'|'.join(regex.escape(g) for g in graphemes)})")
+        Args:
+            keys: (要素数, 4)の添字の配列
+        """
+        with self._fill_lock:
+            keys = keys[self._table[tuple(keys.T)] == 0]
+            windows: dict[tuple, tuple[list[str] | None, int]] = {}
+            for key in np.unique(keys, axis=0):
+                index, window, position = self._window(tuple(key))
+                windows.setdefault(index, (window, position))
+            valid = [(i, w, p) for i, (w, p) in windows.items() if w is not None]
+            # テーブルを埋める変換はprofile_postprocess_rulesの計測に含めない
+            postprocessor = self.epi.postprocessor
+            if isinstance(postprocessor, _CustomProcessor):
+                paused = postprocessor.pause_profiling()
+            else:
+                paused = contextlib.nullcontext()
+            with paused:
+                results, _ = self.epi.transliterate_many([w for _, w, _ in valid])
+
+            values: dict[tuple, tuple[str, ...] | None] = dict.fromkeys(windows)
+            num_segs = self._num_segs
+            for (index, window, position), ipa in zip(valid, results):
+                if ipa is None:
+                    continue
+                segs = get_feature_table().ipa_segs(ipa)
+                counts = [
+                    num_segs(label, nxt)
+                    for label, nxt in zip(window, window[1:] + [None])
+                ]
+                if sum(counts) != len(segs) or unicodedata.normalize(
+                    "NFD", "".join(segs)
+                ) != unicodedata.normalize("NFD", ipa):
+                    continue
+                start = sum(counts[:position])
+                values[index] = tuple(segs[start : start + counts[position]])
+            # グループの配列を差し替えてから、それを指す値をテーブルに書く
+            self._set_groups([group for group in values.values() if group])
+            for index, group in values.items():
+                table_index = tuple(slice(None) if i is None else i for i in index)
+                self._table[table_index] = (
+                    -1 if group is None else self._groups[group] + 1
+                )
+
+    def _num_segs(self, label: str, nxt: str | None) -> int:
+        """ラベルのIPAセグメント数（子音ラベルは後続ラベルとのモーラから求める）"""
+        if label in self._consonants:
+            return self._seg_counts[label + nxt] - self._seg_counts[nxt]
+        return self._seg_counts[label]
+
+    def encode(self, labels: Sequence[str]) -> np.ndarray:
+        """
+        音素ラベルのリストをuint8のラベルID配列にする
 
-    def general_trans(
-        self, text: str, filter_func, normpunc: bool = False, ligatures: bool = False
-    ) -> str:
+        pau・silはPAD、マッピングにないラベルはunk_idになる。
         """
-        変換処理（大文字小文字を区別、.lower()なし）
+        ids, unk_id = self._encode_ids, self.unk_id
+        return np.array([ids.get(label, unk_id) for label in labels], dtype=np.uint8)
 
-        親クラスのgeneral_transをオーバーライドし、
-        text.lower()を削除して大文字小文字を区別する。
+    def features(self, labels: Sequence[str]) -> np.ndarray:
         """
-        # .lower()を削除（これが重要な変更点）
-        text = unicodedata.normalize("NFD", text)
+        音素ラベルのリストのpanphon特徴量を求める
 
-        # strip_diacriticsはダミー言語なのでスキップ可能
-        # text = self.strip_diacritics.process(text)
+        Args:
+            labels: 音素ラベルのリスト（pau・silを含んでよい）
 
-        if self.preproc:
-            text = self.preprocessor.process(text)
+        Returns:
+            IPAセグメントごとの特徴量（(セグメント数, 特徴量数)のint8配列）
 
-        tr_list = []
-        while text:
-            m = self.regexp.match(text)
-            if m:
-                source = m.group(0)
-                try:
-                    target = self.g2p[source][0]
-                except (KeyError, IndexError):
-                    target = source
-                tr_list.append((target, True))
-                text = text[len(source) :]
-            else:
-                tr_list.append((text[0], False))
-                self.nils[text[0]] += 1
-                text = text[1:]
+        Raises:
+            ValueError: 未知の音素ラベルを含む場合
+        """
+        return self._lookup(labels)[0]
 
-        text = "".join([s for (s, _) in filter(filter_func, tr_list)])
+    def features_many(self, sequences: Sequence[Sequence[str]]) -> list[np.ndarray]:
+        """
+        複数の音素ラベルのリストの特徴量をまとめて求める
 
-        if self.postproc:
-            text = self.postprocessor.process(text)
+        pauで区切って1つのラベル列にしてからテーブル参照するため、短い発話を
+        featuresで1件ずつ求めるよりNumPyの呼び出し回数が少なくて済む。
 
-        if ligatures or self.ligatures:
-            from epitran.ligaturize import ligaturize
+        Args:
+            sequences: 音素ラベルのリストのシーケンス
 
-            text = ligaturize(text)
+        Returns:
+            各リストの特徴量（featuresの戻り値と同じ）のリスト
 
-        if normpunc:
-            text = self.puncnorm.norm(text)
+        Raises:
+            ValueError: 未知の音素ラベルを含む場合
+        """
+        if not sequences:
+            return []
+        labels: list[str] = []
+        boundaries = []
+        for sequence in sequences:
+            labels.extend(sequence)
+            boundaries.append(len(labels))
+            labels.append(_SILENCE_LABELS[0])
+        features, row_starts, _ = self._lookup(labels)
+        return np.split(features, row_starts[boundaries[:-1]])
+
+    def label_features(
+        self, labels: Sequence[str], silence_value: int = _SILENCE_FEATURE_VALUE
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        音素ラベルのリストの特徴量を、ラベルと行が1対1になるように求める
 
-        return unicodedata.normalize("NFC", text)
+        IPA文字列は作らずにテーブル参照の結果から直接並べる。
 
-    def transliterate(
-        self, text: str, normpunc: bool = False, ligatures: bool = False
-    ) -> str:
+        Args:
+            labels: 音素ラベルのリスト（pau・silを含んでよい）
+            silence_value: pau・silの行を埋める値
+
+        Returns:
+            (特徴量（(ラベル数, 特徴量数)のint8配列で、i行目がi番目のラベル）,
+             pau・sil以外のラベルでTrueになるマスク)
+
+        Raises:
+            ValueError: 未知の音素ラベルを含む場合、または特徴量が1行に
+                ならないラベル（kwなど）を含む場合
         """
-        音素ラベル列をIPAに変換（未知文字の検証付き）
+        features, row_starts, _ = self._lookup(labels)
+        return _label_rows(labels, features, row_starts, silence_value)
+
+    def frame_features(
+        self,
+        labels: Sequence[str],
+        frame_counts: np.ndarray,
+        silence_value: int = _SILENCE_FEATURE_VALUE,
+    ) -> np.ndarray:
         """
-        self.nils.clear()
-        result = super().transliterate(text, normpunc=normpunc, ligatures=ligatures)
-        unknown_chars = {
-            char: count for char, count in self.nils.items() if char not in (" ",)
-        }
-        if unknown_chars:
-            char_list = ", ".join(
-                f"'{char}' ({count}回)" for char, count in unknown_chars.items()
+        音素ラベルのリストの特徴量を、ラベルごとのフレーム数だけ並べる
+
+        kwのように特徴量が複数行になるラベルは、そのラベルのフレームを
+        行数で（なるべく等しく）分けて各行に割り当てる。フレーム数が0の
+        ラベルは、他のラベルと同じく1フレームも出力されない。
+
+        Args:
+            labels: 音素ラベルのリスト（pau・silを含んでよい）
+            frame_counts: ラベルごとのフレーム数
+            silence_value: pau・silのフレームを埋める値
+
+        Returns:
+            フレームごとの特徴量（(総フレーム数, 特徴量数)のint8配列）
+
+        Raises:
+            ValueError: 未知の音素ラベルを含む場合、フレーム数が負の場合、
+                または1フレーム以上あるが特徴量の行数より少ないラベルがあり、
+                一部の行を出力できない場合
+        """
+        features, row_starts, _ = self._lookup(labels)
+        frame_counts = np.asarray(frame_counts, dtype=np.int64)
+        if len(frame_counts) != len(labels):
+            raise ValueError(
+                f"Length mismatch: {len(labels)} labels, {len(frame_counts)} frame counts"
             )
+        if (frame_counts < 0).any():
+            raise ValueError("Frame counts must not be negative")
+        num_rows = np.diff(row_starts)
+        short = np.flatnonzero((frame_counts > 0) & (frame_counts < num_rows))
+        if len(short):
+            i = short[0]
             raise ValueError(
-                f"Unknown phoneme label(s) detected: {char_list}\n"
-                f"Input: {text}\n"
-                f"Mapping file: {self._custom_map_file}"
+                f"Too few frames at label {i}: label={labels[i]}, "
+                f"frames={frame_counts[i]}, feature_rows={num_rows[i]}"
             )
-        return result
 
+        # pau・silは末尾に足した無音の行を1行持つものとして、行ごとのフレーム数を求める
+        silence_row = np.full((1, features.shape[1]), silence_value, dtype=np.int8)
+        table = np.concatenate((features, silence_row))
+        units = np.maximum(num_rows, 1)
+        unit_label = np.repeat(np.arange(len(labels)), units)
+        unit_start = np.cumsum(units) - units
+        k = np.arange(len(unit_label)) - unit_start[unit_label]
+        counts = frame_counts[unit_label]
+        parts = units[unit_label]
+        unit_frames = (counts * (k + 1)) // parts - (counts * k) // parts
+        unit_rows = np.where(
+            num_rows[unit_label] > 0, row_starts[unit_label] + k, len(features)
+        )
+        return table[np.repeat(unit_rows, unit_frames)]
 
-class _CustomProcessor:
-    """カスタムルールファイル用プロセッサ"""
+    def align(self, labels: Sequence[str]) -> "LabelAlignment":
+        """
+        音素ラベルのリストを変換し、ラベルごとのIPAの範囲と特徴量の行を求める
 
-    def __init__(self, rule_file: str):
-        self.rules = Rules([rule_file])
+        Args:
+            labels: 音素ラベルのリスト（pau・silを含んでよい）
 
-    def process(self, word: str) -> str:
-        return self.rules.apply(word)
+        Returns:
+            変換結果（ipaはphoneme_labels_to_ipaと同じ文字列）
 
+        Raises:
+            ValueError: 未知の音素ラベルを含む場合
+        """
+        features, row_starts, label_ipa = self._lookup(labels)
+
+        # セグメントはスペースで区切るため、前にセグメントがあるセグメントの
+        # 先頭ラベルの前に1文字入る
+        lengths = np.fromiter(map(len, label_ipa), dtype=np.intp, count=len(labels))
+        voiced = lengths > 0
+        first = voiced & ~np.concatenate(([False], voiced[:-1]))
+        space = first & (np.cumsum(voiced) > 1)
+        ends = np.cumsum(lengths + space)
+        spans = np.stack((ends - lengths, ends), axis=1)
+        ipa = " ".join(
+            "".join(label_ipa[start:end]) for start, end in iter_silence_spans(labels)
+        )
+        return LabelAlignment(list(labels), ipa, spans, row_starts, features)
 
-# =============================================================================
-# 変換関数
-# =============================================================================
+    def _lookup(
+        self, labels: Sequence[str]
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        特徴量と、ラベルごとの特徴量の先頭行とIPAを求める
 
-# デフォルトのファイルパス
-_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-_MAP_FILE = os.path.join(_BASE_DIR, "hiho_data", "openjtalk_to_ipa.csv")
-_POST_FILE = os.path.join(_BASE_DIR, "hiho_data", "openjtalk_postprocess.txt")
+        Returns:
+            (特徴量, ラベルごとの先頭行（長さはラベル数+1で、末尾は総行数）,
+             ラベルごとのIPA（pau・silは空文字列）のobject配列)
+        """
+        encode_ids, unk_id, pad = self._encode_ids, self.unk_id, self.PAD
+        padded = np.array(
+            [pad, *(encode_ids.get(label, unk_id) for label in labels), pad, pad],
+            dtype=np.intp,
+        )
+        n = len(labels)
+        prev, cur, nxt, nxt2 = padded[:n], padded[1:-2], padded[2:-1], padded[3:]
+        voiced = cur != self.PAD
+        entries = self._table[prev, cur, nxt, nxt2]
+        missing = voiced & (entries == 0)
+        if missing.any():
+            self._fill(np.stack((prev, cur, nxt, nxt2), axis=1)[missing])
+            entries = self._table[prev, cur, nxt, nxt2]
+        group_ipa, group_len, group_start, group_features = self._group_arrays
+        groups = entries.astype(np.intp) - 1
+
+        # 参照実装で変換するセグメントのラベル
+        segment = np.cumsum(~voiced)
+        bad = voiced & (groups < 0)
+        counted = self._counted[cur]
+        if np.count_nonzero(counted) > _RULE_SUB_LIMIT:
+            counts = np.bincount(segment[counted], minlength=segment[-1] + 1)
+            bad |= counts[segment] > _RULE_SUB_LIMIT
+        for mask, reach in self._overlaps:
+            hits = np.flatnonzero(mask[cur])
+            if len(hits) < 2:
+                continue
+            close = (np.diff(hits) <= reach) & (segment[hits[1:]] == segment[hits[:-1]])
+            bad[hits[1:][close]] = True
+        if bad.any():
+            segment_bad = np.zeros(segment[-1] + 1, dtype=bool)
+            segment_bad[segment[bad]] = True
+            fallback = voiced & segment_bad[segment]
+        else:
+            fallback = bad
+
+        # ラベルごとの行の範囲をつなげて特徴量の行を集める
+        # （pau・silと参照実装で変換するラベルは空のグループ（-1）にする）
+        groups = np.where(voiced & ~fallback, groups, -1)
+        lens = group_len[groups]
+        ends = np.cumsum(lens)
+        starts = np.concatenate((ends - lens, ends[-1:] if n else [0]))
+        rows = np.repeat(group_start[groups] - starts[:-1], lens)
+        features = group_features[rows + np.arange(len(rows))]
+        label_ipa = group_ipa[groups]
+        if not fallback.any():
+            return features, starts, label_ipa
+
+        pieces = []
+        done = 0
+        shift = np.zeros(n + 1, dtype=np.intp)
+        for index in np.unique(segment[fallback]):
+            positions = np.flatnonzero(fallback & (segment == index))
+            at = starts[positions[0]]
+            reference, counts, ipas = self._reference_segment(
+                [labels[i] for i in positions]
+            )
+            pieces.append(features[done:at])
+            pieces.append(reference)
+            done = at
+            shift[positions[0] + 1 : positions[-1] + 2] += np.cumsum(counts)
+            shift[positions[-1] + 2 :] += len(reference)
+            label_ipa[positions] = ipas
+        pieces.append(features[done:])
+        return np.concatenate(pieces), starts + shift, label_ipa
+
+    def _reference_segment(
+        self, labels: list[str]
+    ) -> tuple[np.ndarray, list[int], list[str]]:
+        """
+        1セグメントを参照実装で変換する
 
-# グローバルインスタンス（遅延初期化）
-_epitran_instance: OpenJTalkLabelEpitran | None = None
+        Returns:
+            (特徴量, ラベルごとのセグメント数, ラベルごとのIPA)
+
+        Raises:
+            ValueError: 未知の音素ラベルを含む場合、またはIPAのセグメントを
+                ラベルに割り当てられない場合
+        """
+        ipa = self.epi.transliterate_labels(labels)
+        segs = get_feature_table().ipa_segs(ipa)
+
+        # OpenJTalkLabelEpitran._map_labelsと同じ単位でラベルにセグメントを
+        # 割り当てる（結合したモーラを分けられない場合は子音ラベルに寄せる）
+        seg_counts = self._seg_counts
+        counts = []
+        i = 0
+        while i < len(labels):
+            label = labels[i]
+            mora = label + labels[i + 1] if i + 1 < len(labels) else None
+            if label not in seg_counts and mora in seg_counts:
+                nxt = seg_counts.get(labels[i + 1], 0)
+                if seg_counts[mora] <= nxt:
+                    nxt = 0
+                counts += [seg_counts[mora] - nxt, nxt]
+                i += 2
+            else:
+                counts.append(seg_counts[label])
+                i += 1
+        if sum(counts) != len(segs):
+            raise ValueError(
+                f"Cannot align IPA segments to labels: "
+                f"expected {sum(counts)} segments, got {len(segs)}\n"
+                f"Phoneme labels: {labels}\n"
+                f"Feature segments: {segs}"
+            )
+        ends = np.cumsum(counts)
+        ipas = [
+            unicodedata.normalize("NFC", "".join(segs[end - count : end]))
+            for count, end in zip(counts, ends)
+        ]
+        return _ipa_features(ipa), counts, ipas
 
-# panphonのFeatureTable（特徴量ベクトル取得用）
-_FT = panphon.FeatureTable()
 
-# XSampaインスタンス（IPA→X-SAMPA変換用）
-_XS = XSampa()
+class LabelAlignment:
+    """
+    音素ラベルごとのIPAの範囲と特徴量の行を持つ変換結果
 
+    ラベルiのIPAはipa[ipa_spans[i, 0]:ipa_spans[i, 1]]、特徴量は
+    features[feature_rows[i]:feature_rows[i + 1]]。pau・silは空の範囲になる。
+    """
 
-def _get_epitran() -> OpenJTalkLabelEpitran:
-    """Epitranインスタンスを取得（シングルトン）"""
-    global _epitran_instance
-    if _epitran_instance is None:
-        _epitran_instance = OpenJTalkLabelEpitran(_MAP_FILE, post_file=_POST_FILE)
-    return _epitran_instance
+    def __init__(
+        self,
+        labels: list[str],
+        ipa: str,
+        ipa_spans: np.ndarray,
+        feature_rows: np.ndarray,
+        features: np.ndarray,
+    ):
+        """
+        Args:
+            labels: 音素ラベルのリスト
+            ipa: IPA音声記号列（セグメントはスペース区切り）
+            ipa_spans: ラベルごとのIPAの(開始, 終了)位置（(ラベル数, 2)の配列）
+            feature_rows: ラベルごとの特徴量の先頭行（長さはラベル数+1）
+            features: IPAセグメントごとの特徴量
+        """
+        self.labels = labels
+        self.ipa = ipa
+        self.ipa_spans = ipa_spans
+        self.feature_rows = feature_rows
+        self.features = features
+
+    def label_ipa(self, index: int) -> str:
+        """ラベルindexのIPA"""
+        start, end = self.ipa_spans[index]
+        return self.ipa[start:end]
+
+    def num_rows(self) -> np.ndarray:
+        """ラベルごとの特徴量の行数"""
+        return np.diff(self.feature_rows)
+
+    def label_features(
+        self, silence_value: int = _SILENCE_FEATURE_VALUE
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        i行目がi番目のラベルになる特徴量とマスクを返す
 
+        LabelFeatureEngine.label_featuresと同じ。
+        """
+        return _label_rows(self.labels, self.features, self.feature_rows, silence_value)
 
-def read_lab_file(lab_file: str) -> str:
-    """
-    labファイルから音素ラベル列を読み込む
 
-    Args:
-        lab_file: labファイルのパス
+def _label_rows(
+    labels: Sequence[str],
+    features: np.ndarray,
+    feature_rows: np.ndarray,
+    silence_value: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    IPAセグメントごとの特徴量を、ラベルごとに1行の配列に並べ直す
 
     Returns:
-        スペース区切りの音素ラベル列
+        (ラベルごとの特徴量, pau・sil以外のラベルでTrueになるマスク)
     """
-    from pathlib import Path
+    num_rows = np.diff(feature_rows)
+    mask = num_rows > 0
+    invalid = np.flatnonzero(mask & (num_rows != 1))
+    if len(invalid):
+        i = invalid[0]
+        raise ValueError(
+            f"Length mismatch at label {i}: "
+            f"label={labels[i]}, feature_count={num_rows[i]}\n"
+            f"Phoneme labels: {list(labels)}"
+        )
+    rows = np.full((len(labels), features.shape[1]), silence_value, dtype=np.int8)
+    rows[mask] = features[feature_rows[:-1][mask]]
+    return rows, mask
 
-    labels = []
-    with Path(lab_file).open(encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            parts = line.split()
-            if len(parts) >= 3:
-                label = parts[2]
-                labels.append(label)
-    return " ".join(labels)
 
+# Epitranのversionごとに直近に使ったLabelFeatureEngine（Epitranのプールと
+# 同じ数まで保持し、マッピングを切り替えるたびに作り直さないようにする）
+_label_feature_engines: OrderedDict[str, LabelFeatureEngine] = OrderedDict()
+_label_feature_lock = threading.Lock()
 
-def text_to_phoneme_labels(text: str) -> str:
+
+def get_label_feature_engine(
+    epi: OpenJTalkLabelEpitran | None = None,
+) -> LabelFeatureEngine:
     """
-    日本語テキストをOpenJTalk音素ラベル列に変換する
+    Epitranに対応するLabelFeatureEngineを取得する
+
+    versionが同じEpitranには同じエンジンを返す。保持するエンジン数は
+    configure_epitran_poolで設定したプールの上限に合わせる。
 
     Args:
-        text: 日本語テキスト
+        epi: 参照実装のEpitran（省略時はデフォルトのマッピング）
+    """
+    if epi is None:
+        epi = _get_epitran()
+    with _label_feature_lock:
+        engine = _label_feature_engines.get(epi.version)
+        if engine is None:
+            engine = LabelFeatureEngine(epi)
+            _label_feature_engines[epi.version] = engine
+        _label_feature_engines.move_to_end(epi.version)
+        while len(_label_feature_engines) > max(_epitran_pool.maxsize, 1):
+            _label_feature_engines.popitem(last=False)
+    return engine
+
+
+def install_instances(
+    feature_table: panphon.FeatureTable,
+    xsampa: XSampa,
+    epi: OpenJTalkLabelEpitran,
+    engine: LabelFeatureEngine | None = None,
+) -> None:
+    """
+    別のプロセスで作ったインスタンスを、このプロセスのデフォルトのインスタンスにする
+
+    spawnしたワーカーで、親プロセスから受け取ったインスタンスを構築し直さずに
+    使うためのもの。
+
+    Args:
+        feature_table: panphonのFeatureTable
+        xsampa: XSampaインスタンス
+        epi: デフォルトのマッピングのEpitran
+        engine: epiに対応するLabelFeatureEngine（省略時は必要になったときに作る）
+    """
+    global _feature_table, _xsampa, _epitran_instance
+    with _resource_lock:
+        _feature_table, _xsampa = feature_table, xsampa
+    with _epitran_lock:
+        _epitran_instance = epi
+    if engine is not None:
+        with _label_feature_lock:
+            _label_feature_engines[engine.version] = engine
+
+
+def phoneme_labels_to_features(
+    phoneme_labels: str, epi: OpenJTalkLabelEpitran | None = None
+) -> np.ndarray:
+    """
+    OpenJTalk音素ラベル列のpanphon特徴量をLabelFeatureEngineで求める
+
+    phoneme_labels_to_features_referenceと同じ結果をテーブル参照で求める。
+
+    Args:
+        phoneme_labels: スペース区切りの音素ラベル列
+        epi: 変換に使うEpitran（省略時はデフォルトのマッピング）
 
     Returns:
-        スペース区切りの音素ラベル列
+        pau・sil以外のラベルごとの特徴量（(ラベル数, 特徴量数)のint8配列）
     """
-    return pyopenjtalk.g2p(text)
+    return get_label_feature_engine(epi).features(phoneme_labels.split())
 
 
-def text_to_phoneme_list(text: str) -> list[str]:
+def phoneme_labels_to_alignment(
+    phoneme_labels: str, epi: OpenJTalkLabelEpitran | None = None
+) -> LabelAlignment:
     """
-    日本語テキストをOpenJTalk音素ラベルのリストに変換する
+    OpenJTalk音素ラベル列を変換し、ラベルごとのIPAの範囲と特徴量の行を求める
 
     Args:
-        text: 日本語テキスト
+        phoneme_labels: スペース区切りの音素ラベル列
+        epi: 変換に使うEpitran（省略時はデフォルトのマッピング）
 
     Returns:
-        音素ラベルのリスト
+        変換結果（ipaはphoneme_labels_to_ipaと同じ文字列）
     """
-    phonemes = pyopenjtalk.g2p(text)
-    return phonemes.split(" ") if phonemes else []
+    return get_label_feature_engine(epi).align(phoneme_labels.split())
 
 
-def phoneme_labels_to_ipa(phoneme_labels: str) -> str:
+def phoneme_labels_to_label_features(
+    phoneme_labels: str,
+    epi: OpenJTalkLabelEpitran | None = None,
+    silence_value: int = _SILENCE_FEATURE_VALUE,
+) -> tuple[np.ndarray, np.ndarray]:
     """
-    OpenJTalk音素ラベル列をIPA音声記号列に変換する
+    OpenJTalk音素ラベル列の特徴量を、i行目がi番目のラベルになるように求める
 
-    pauまたはsilラベルがある場合は、それらで分割して各部分を変換し、
-    スペースで結合して返す。
+    pau・silも行を持つため、labファイルのi行目の音素の特徴量をそのまま
+    i行目で参照できる。
 
     Args:
         phoneme_labels: スペース区切りの音素ラベル列
+        epi: 変換に使うEpitran（省略時はデフォルトのマッピング）
+        silence_value: pau・silの行を埋める値（既定の0は全特徴量が
+            未指定の行で、どの音素の特徴量とも重ならない）
 
     Returns:
-        IPA音声記号列（pauまたはsilがあった場合はスペース区切り）
-    """
-    # pauまたはsilで分割
-    segments = split_by_silence_markers(phoneme_labels)
+        (特徴量（(ラベル数, 特徴量数)のint8配列）,
+         pau・sil以外のラベルでTrueになるマスク)
 
-    # 各セグメントを変換
-    epi = _get_epitran()
-    ipa_segments = []
-    for segment in segments:
-        # スペースを削除してモーラ単位の文字列にする
-        labels_no_space = segment.replace(" ", "")
-        if labels_no_space:  # 空でない場合のみ変換
-            ipa = epi.transliterate(labels_no_space)
-            ipa_segments.append(ipa)
-
-    return " ".join(ipa_segments)
+    Raises:
+        ValueError: 未知の音素ラベルを含む場合、または特徴量が1行に
+            ならないラベル（kwなど）を含む場合
+    """
+    return get_label_feature_engine(epi).label_features(
+        phoneme_labels.split(), silence_value
+    )
 
 
-def split_by_silence_markers(phoneme_labels: str) -> list[str]:
+def frame_positions(labels: Sequence[str], frame_counts: np.ndarray) -> np.ndarray:
     """
-    音素ラベル列をpauまたはsilで分割する
+    各フレームの音素の、pau・silで区切ったセグメントの中での位置を求める
 
     Args:
-        phoneme_labels: スペース区切りの音素ラベル列
+        labels: 音素ラベルのリスト（pau・silを含んでよい）
+        frame_counts: ラベルごとのフレーム数
 
     Returns:
-        pauまたはsilで分割されたセグメントのリスト
+        (総フレーム数, 2)のfloat32配列。0列目はセグメントの先頭からの位置、
+        1列目は末尾からの位置で、どちらも音素の中心で測った0〜1の値
+        （セグメントのj番目（0始まり）の音素は(j + 0.5) / セグメントの音素数）。
+        pau・silのフレームはどちらの列も0
+    """
+    frame_counts = np.asarray(frame_counts, dtype=np.int64)
+    if len(frame_counts) != len(labels):
+        raise ValueError(
+            f"Length mismatch: {len(labels)} labels, {len(frame_counts)} frame counts"
+        )
+    label_positions = np.zeros((len(labels), 2), dtype=np.float32)
+    for start, end in silence_spans(labels):
+        forward = (np.arange(end - start) + 0.5) / (end - start)
+        label_positions[start:end, 0] = forward
+        label_positions[start:end, 1] = 1 - forward
+    return np.repeat(label_positions, frame_counts, axis=0)
+
+
+def lab_timing_to_frame_features(
+    timing: LabTiming,
+    frame_period: float,
+    epi: OpenJTalkLabelEpitran | None = None,
+    silence_value: int = _SILENCE_FEATURE_VALUE,
+    positions: bool = False,
+) -> tuple[np.ndarray, np.ndarray | None]:
     """
-    phonemes = phoneme_labels.split(" ")
-    segments = []
-    current_segment = []
+    labファイルの音素ラベルと時刻から、フレームごとの特徴量を求める
 
-    for phoneme in phonemes:
-        if phoneme == "pau" or phoneme == "sil":
-            if current_segment:
-                segments.append(" ".join(current_segment))
-                current_segment = []
-        else:
-            current_segment.append(phoneme)
+    各ラベルのフレーム数はlab_reader.htk_to_framesで丸めた開始・終了フレームの差で、
+    1フレーム目は最初のラベルの開始フレームになる。
+
+    Args:
+        timing: labファイルの音素ラベルと時刻
+        frame_period: フレーム周期（秒）
+        epi: 変換に使うEpitran（省略時はデフォルトのマッピング）
+        silence_value: pau・silのフレームを埋める値
+        positions: Trueの場合、セグメントの中での各フレームの音素の位置も求める
 
-    # 最後のセグメントを追加
-    if current_segment:
-        segments.append(" ".join(current_segment))
+    Returns:
+        (フレームごとの特徴量（(総フレーム数, 特徴量数)のint8配列）,
+         frame_positionsの位置（positionsがFalseの場合はNone）)
 
-    return segments
+    Raises:
+        ValueError: 未知の音素ラベルを含む場合、終了時刻が開始時刻より前の
+            ラベルがある場合、またはkwなど特徴量が複数行になるラベルの
+            フレーム数が行数より少ない場合
+    """
+    frame_counts = timing.frame_durations(frame_period)
+    labels = timing.labels.tolist()
+    features = get_label_feature_engine(epi).frame_features(
+        labels, frame_counts, silence_value
+    )
+    return features, frame_positions(labels, frame_counts) if positions else None
 
 
-def text_to_ipa(text: str) -> str:
+def phoneme_labels_to_features_reference(
+    phoneme_labels: str, epi: OpenJTalkLabelEpitran | None = None
+) -> np.ndarray:
     """
-    日本語テキストをIPA音声記号列に変換する
+    OpenJTalk音素ラベル列のpanphon特徴量をIPA音声記号列から求める（参照実装）
 
     Args:
-        text: 日本語テキスト
+        phoneme_labels: スペース区切りの音素ラベル列
+        epi: 変換に使うEpitran（省略時はデフォルトのマッピング）
 
     Returns:
-        IPA音声記号列
+        IPAセグメントごとの特徴量（(セグメント数, 特徴量数)のint8配列）
     """
-    phoneme_labels = text_to_phoneme_labels(text)
-    return phoneme_labels_to_ipa(phoneme_labels)
+    return _ipa_features(phoneme_labels_to_ipa(phoneme_labels, epi))
 
 
 # =============================================================================
@@ -367,46 +2714,28 @@ def show_examples() -> None:
     print("  - 撥音は環境により変化（ɴ, m, n, ŋ等）")
 
 
-def _validate_phoneme_feature_length(phoneme_str: str, ipa: str) -> None:
+def _validate_phoneme_feature_length(alignment: LabelAlignment) -> None:
     """
-    音素数とpanphon特徴量列の長さが一致するか検証する
+    音素ごとにpanphon特徴量が1行ずつ対応しているか検証する
 
     Args:
-        phoneme_str: スペース区切りの音素ラベル列
-        ipa: IPA音声記号列（スペース区切りの場合がある）
+        alignment: phoneme_labels_to_alignmentの変換結果
 
     Raises:
-        ValueError: 音素数と特徴量の長さが一致しない場合
+        ValueError: 特徴量が1行にならない音素がある場合
     """
-    segments = split_by_silence_markers(phoneme_str)
-
-    ipa_segments = ipa.split(" ") if " " in ipa else [ipa]
-
-    if len(segments) != len(ipa_segments):
+    num_rows = alignment.num_rows()
+    for i, label in enumerate(alignment.labels):
+        if label in _SILENCE_LABELS or num_rows[i] == 1:
+            continue
         raise ValueError(
-            f"Number of segments mismatch: "
-            f"phoneme segments={len(segments)}, IPA segments={len(ipa_segments)}\n"
-            f"Phoneme: {phoneme_str}\n"
-            f"IPA: {ipa}"
+            f"Length mismatch at label {i}: "
+            f"label={label}, feature_count={num_rows[i]}\n"
+            f"Phoneme labels: {alignment.labels}\n"
+            f"IPA: {alignment.ipa}\n"
+            f"Label IPA: {alignment.label_ipa(i)}"
         )
 
-    for i, (phoneme_seg, ipa_seg) in enumerate(zip(segments, ipa_segments)):
-        phoneme_labels = phoneme_seg.split()
-        phoneme_count = len([p for p in phoneme_labels if p not in ("pau", "sil")])
-
-        seg_objs = _FT.word_fts(ipa_seg)
-        feature_count = len(seg_objs)
-
-        if phoneme_count != feature_count:
-            raise ValueError(
-                f"Length mismatch in segment {i + 1}: "
-                f"phoneme_count={phoneme_count}, feature_count={feature_count}\n"
-                f"Phoneme segment: {phoneme_seg}\n"
-                f"IPA segment: {ipa_seg}\n"
-                f"Phoneme labels: {phoneme_labels}\n"
-                f"Feature segments: {_FT.ipa_segs(ipa_seg)}"
-            )
-
 
 def show_mapping_debug() -> None:
     """マッピングの詳細デバッグ情報を表示"""
@@ -458,32 +2787,34 @@ def analyze_phoneme_labels_detail(
 
     print(f"OpenJTalk:    {phoneme_str}")
 
-    # IPA変換
-    ipa = phoneme_labels_to_ipa(phoneme_str)
+    # IPA変換（ラベルごとのIPAの範囲と特徴量の行も求める）
+    alignment = phoneme_labels_to_alignment(phoneme_str)
+    ipa = alignment.ipa
     print(f"IPA:          {ipa}")
 
     # X-SAMPA変換
-    xsampa = _XS.ipa2xs(ipa)
+    xsampa = get_xsampa().ipa2xs(ipa)
     print(f"X-SAMPA:      {xsampa}")
     print()
 
     # 音素数と特徴量の長さ検証
-    _validate_phoneme_feature_length(phoneme_str, ipa)
+    _validate_phoneme_feature_length(alignment)
 
-    # IPA全体のセグメント分析
+    # 音素ごとのセグメント分析
     print("IPAセグメント分析:")
-    seg_objs = _FT.word_fts(ipa)
-    ipa_segs = _FT.ipa_segs(ipa)
-
-    if seg_objs and ipa_segs:
-        print(f"  セグメント数: {len(seg_objs)}")
-        print(f"  {'IPA':<10} {'X-SAMPA':<12} {'特徴量ベクトル'}")
+    if len(alignment.features):
+        print(f"  セグメント数: {len(alignment.features)}")
+        print(f"  {'音素':<6} {'IPA':<10} {'X-SAMPA':<12} {'特徴量ベクトル'}")
         print("  " + "-" * 66)
 
-        for seg_str, seg_obj in zip(ipa_segs, seg_objs):
-            seg_xsampa = _XS.ipa2xs(seg_str)
-            vec = seg_obj.numeric()
-            print(f"  {seg_str:<10} {seg_xsampa:<12} {vec}")
+        rows = alignment.feature_rows
+        for i, label in enumerate(alignment.labels):
+            if label in _SILENCE_LABELS:
+                continue
+            seg_str = alignment.label_ipa(i)
+            seg_xsampa = get_xsampa().ipa2xs(seg_str)
+            for vec in alignment.features[rows[i] : rows[i + 1]]:
+                print(f"  {label:<6} {seg_str:<10} {seg_xsampa:<12} {vec.tolist()}")
     else:
         print("  セグメント情報なし")
 
@@ -560,7 +2891,6 @@ def main():
         type=str,
         help="音素ラベルを読み込むlabファイルのパス",
     )
-
     args = parser.parse_args()
 
     # textとlabは排他的
@@ -582,7 +2912,7 @@ def main():
             print()
 
             ipa = phoneme_labels_to_ipa(phoneme_str)
-            xsampa = _XS.ipa2xs(ipa)
+            xsampa = get_xsampa().ipa2xs(ipa)
             print(f"labファイル:  {source_label}")
             print(f"OpenJTalk:    {phoneme_str}")
             print(f"IPA:          {ipa}")
@@ -628,7 +2958,7 @@ def main():
             # 基本的な変換結果
             phonemes = text_to_phoneme_labels(text)
             ipa = phoneme_labels_to_ipa(phonemes)
-            xsampa = _XS.ipa2xs(ipa)
+            xsampa = get_xsampa().ipa2xs(ipa)
             print(f"テキスト:     {text}")
             print(f"OpenJTalk:    {phonemes}")
             print(f"IPA:          {ipa}")
@@ -690,8 +3020,8 @@ def main():
                 print("-" * 50)
                 epi = _get_epitran()
                 for i, segment in enumerate(segments):
-                    labels_no_space = segment.replace(" ", "")
-                    ipa = epi.transliterate(labels_no_space) if labels_no_space else ""
+                    labels = segment.split()
+                    ipa = epi.transliterate_labels(labels) if labels else ""
                     print(f"セグメント{i + 1}:")
                     print(f"  OpenJTalk: {segment}")
                     print(f"  IPA: {ipa}")
@@ -706,4 +3036,10 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    # このファイルを直接実行すると、クラスや関数は__main__のものになり、
+    # スナップショットのpickleにも__main__として記録される。インポートした
+    # ときと同じcheck_epitran_openjtalkのものとして記録・読み込みされるよう、
+    # モジュールとしてインポートし直したmainを実行する
+    import check_epitran_openjtalk
+
+    check_epitran_openjtalk.main()
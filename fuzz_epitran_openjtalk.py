@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+OpenJTalk音素ラベルのIPA変換の差分ファジング
+
+マッピングCSVのキーを音素ラベルに分けた単位（verify_epitran_openjtalk.pyと同じ）を
+ランダムに並べ、pau・silを挟んだ長い発話を作る。撥音の同化・促音の重子音化・
+口蓋化などの文脈ルールが働くよう、N・clや同じ並びの繰り返しを多めに混ぜる。
+各発話を参照と検査対象で変換し、結果が異なった発話は、単位を削っても
+異なるままの最小の発話に縮めて報告する。
+
+参照:
+    発話をpau・silで分け、各セグメントを参照パイプライン（verify_epitran_openjtalk
+    のReferencePipeline。SimpleEpitranと同じ正規表現とRules.applyの手順）で
+    変換してスペースでつなぐ。検査対象と変換処理を共有しないため、
+    transliterate_manyや_map_labelsの誤りも見つけられる。
+
+検査対象:
+- labels: セグメントごとのOpenJTalkLabelEpitran.transliterate_labels
+- batch: 全発話のセグメントをまとめたOpenJTalkLabelEpitran.transliterate_many
+- ipa: セグメントキャッシュなしのphoneme_labels_to_ipa
+- cache: セグメントキャッシュありのphoneme_labels_to_ipa（2回目の呼び出し）
+- features: LabelFeatureEngine（参照のIPAから求めた特徴量と比較）
+
+発話は(シード, タスク番号)から決まる乱数で作るため、ワーカープロセス数や
+実行順によらず同じ発話列になり、報告されたタスクだけを再実行できる。
+"""
+
+import argparse
+import os
+import random
+import time
+from collections.abc import Callable, Iterable, Sequence
+from itertools import chain
+from multiprocessing import Pool
+
+from check_epitran_openjtalk import (
+    _CONTEXT_LABELS,
+    _SEGMENT_CACHE_SIZE,
+    _SILENCE_LABELS,
+    OpenJTalkLabelEpitran,
+    _get_epitran,
+    configure_segment_cache,
+    iter_silence_spans,
+    phoneme_labels_to_ipa,
+)
+from verify_epitran_openjtalk import (
+    ReferencePipeline,
+    Unit,
+    _outputs,
+    _same,
+    make_candidates,
+    mora_units,
+)
+
+# 1タスクあたりの発話数の既定値
+_TASK_SIZE = 1000
+
+# =============================================================================
+# 発話の生成
+# =============================================================================
+
+
+class UtteranceGenerator:
+    """文脈ルールが働きやすい、ランダムな音素ラベルの発話を作る"""
+
+    def __init__(self, units: Sequence[Unit], max_units: int):
+        """
+        Args:
+            units: 並べる単位
+            max_units: 1発話の最大の単位数
+        """
+        self.units = list(units)
+        self.context_units = [u for u in self.units if u[0] in _CONTEXT_LABELS]
+        self.silence_units = [(label,) for label in _SILENCE_LABELS]
+        self.max_units = max_units
+
+    def __call__(self, rng: random.Random) -> list[Unit]:
+        """1発話分の単位のリストを返す"""
+        num_units = rng.randint(1, self.max_units)
+        utterance: list[Unit] = []
+        while len(utterance) < num_units:
+            r = rng.random()
+            if r < 0.02:
+                # 短い並びの繰り返し（ルールの置換回数の上限や、文脈が
+                # 重なる並びを作る）
+                chunk = [rng.choice(self.units + self.context_units) for _ in range(2)]
+                utterance.extend(chunk * rng.randint(2, 40))
+            elif r < 0.07:
+                utterance.append(rng.choice(self.silence_units))
+            elif r < 0.3 and self.context_units:
+                utterance.append(rng.choice(self.context_units))
+            else:
+                utterance.append(rng.choice(self.units))
+        return utterance
+
+
+# =============================================================================
+# 検査対象
+# =============================================================================
+
+
+def _per_segment(
+    convert: Callable[[list[list[str]]], list[str | None]],
+) -> Callable[[list[list[str]], list[str | None]], list]:
+    """セグメント単位の変換関数から、発話単位の検査対象を作る"""
+
+    def run(utterances, expected):
+        segments = [
+            [u[start:end] for start, end in iter_silence_spans(u)] for u in utterances
+        ]
+        outputs = iter(convert(list(chain.from_iterable(segments))))
+        actual = []
+        for utterance_segments in segments:
+            ipa = [next(outputs) for _ in utterance_segments]
+            actual.append(None if None in ipa else " ".join(ipa))
+        return list(zip(actual, expected))
+
+    return run
+
+
+def make_fuzz_candidates(
+    epi: OpenJTalkLabelEpitran, names: Iterable[str]
+) -> dict[str, Callable[[list[list[str]], list[str | None]], list]]:
+    """
+    検査対象の変換関数を作る（verify_epitran_openjtalk.make_candidatesと同じ形式）
+
+    Args:
+        epi: 検査対象のEpitran
+        names: 検査対象の名前（labels, batch, ipa, cache, features）
+    """
+
+    def uncached(utterances, expected):
+        def convert(labels):
+            return phoneme_labels_to_ipa(" ".join(labels), epi)
+
+        configure_segment_cache(0)
+        try:
+            return list(zip(_outputs(convert, utterances), expected))
+        finally:
+            configure_segment_cache(_SEGMENT_CACHE_SIZE)
+
+    def cache(utterances, expected):
+        def convert(labels):
+            phoneme_labels_to_ipa(" ".join(labels), epi)
+            return phoneme_labels_to_ipa(" ".join(labels), epi)
+
+        return list(zip(_outputs(convert, utterances), expected))
+
+    candidates = {
+        "labels": _per_segment(
+            lambda segments: _outputs(epi.transliterate_labels, segments)
+        ),
+        "batch": _per_segment(lambda segments: epi.transliterate_many(segments)[0]),
+        "ipa": uncached,
+        "cache": cache,
+        **make_candidates(epi, ["features"]),
+    }
+    return {name: candidates[name] for name in names}
+
+
+# =============================================================================
+# ファジング
+# =============================================================================
+
+# ワーカープロセスの状態（_init_workerで設定する）
+_pipeline: ReferencePipeline | None = None
+_candidates: dict = {}
+_generator: UtteranceGenerator | None = None
+
+
+def _init_worker(names: list[str], max_units: int) -> None:
+    global _pipeline, _candidates, _generator
+    epi = _get_epitran()
+    _pipeline = ReferencePipeline(epi)
+    _candidates = make_fuzz_candidates(epi, names)
+    _generator = UtteranceGenerator(mora_units(epi), max_units)
+
+
+def _reference_utterance(labels: list[str]) -> str | None:
+    """1発話をpau・silで分け、各セグメントを参照パイプラインで変換する"""
+    segments: list[list[str]] = [[]]
+    for label in labels:
+        if label in _SILENCE_LABELS:
+            segments.append([])
+        else:
+            segments[-1].append(label)
+    ipa = [_pipeline(segment) for segment in segments if segment]
+    return None if None in ipa else " ".join(ipa)
+
+
+def _reference(utterances: list[list[str]]) -> list[str | None]:
+    """参照パイプラインで変換する"""
+    return [_reference_utterance(labels) for labels in utterances]
+
+
+def _fails(name: str, units: Sequence[Unit]) -> bool:
+    labels = list(chain.from_iterable(units))
+    expected = _reference([labels])
+    actual, expected_output = _candidates[name]([labels], expected)[0]
+    return not _same(actual, expected_output)
+
+
+def shrink(fails: Callable[[tuple[Unit, ...]], bool], units: Sequence[Unit]):
+    """
+    結果が異なる発話から単位を削り、どの単位を1つ削っても一致するようになる
+    最小の発話を求める（半分ずつから1単位ずつまで、削る幅を縮めていく）
+
+    Args:
+        fails: 単位のタプルで結果が異なるかを返す関数
+        units: 結果が異なった発話の単位
+
+    Returns:
+        最小の発話の単位のタプル
+    """
+    units = tuple(units)
+    chunk = max(len(units) // 2, 1)
+    while True:
+        removed = False
+        i = 0
+        while i < len(units) and len(units) > 1:
+            shorter = units[:i] + units[i + chunk :]
+            if shorter and fails(shorter):
+                units = shorter
+                removed = True
+            else:
+                i += chunk
+        if not removed:
+            if chunk == 1:
+                return units
+            chunk //= 2
+
+
+def _fuzz_task(task: tuple[int, int, int]):
+    """
+    1タスク分の発話を作って検査する
+
+    Returns:
+        (タスク番号, 検査した発話数, [(検査対象の名前, 最小の発話)])
+    """
+    seed, index, num_cases = task
+    rng = random.Random(f"{seed}:{index}")
+    units_list = [_generator(rng) for _ in range(num_cases)]
+    utterances = [list(chain.from_iterable(units)) for units in units_list]
+    expected = _reference(utterances)
+
+    failures = set()
+    for name, candidate in _candidates.items():
+        for units, (a, e) in zip(units_list, candidate(utterances, expected)):
+            if not _same(a, e):
+                failures.add(
+                    (name, shrink(lambda u, name=name: _fails(name, u), units))
+                )
+    return index, num_cases, sorted(failures)
+
+
+def fuzz(
+    seed: int,
+    num_cases: int,
+    names: list[str],
+    max_units: int,
+    task_size: int = _TASK_SIZE,
+    start_task: int = 0,
+    processes: int | None = None,
+) -> dict[tuple[str, tuple[Unit, ...]], int]:
+    """
+    ランダムな発話で検査対象を参照と比較し、進捗を表示する
+
+    Args:
+        seed: 乱数のシード
+        num_cases: 発話数
+        names: 検査対象の名前
+        max_units: 1発話の最大の単位数
+        task_size: 1タスクの発話数
+        start_task: 最初のタスク番号（報告されたタスクの再実行用）
+        processes: ワーカープロセス数（省略時はCPU数）
+
+    Returns:
+        {(検査対象の名前, 最小の発話): 最初に見つかったタスク番号}
+    """
+    num_tasks = -(-num_cases // task_size)
+    tasks = [
+        (seed, start_task + i, min(task_size, num_cases - i * task_size))
+        for i in range(num_tasks)
+    ]
+
+    failures: dict[tuple[str, tuple[Unit, ...]], int] = {}
+    start = time.perf_counter()
+    last_report = start
+    done = 0
+    initargs = (names, max_units)
+    with Pool(processes, initializer=_init_worker, initargs=initargs) as pool:
+        for index, count, found in pool.imap_unordered(_fuzz_task, tasks):
+            done += count
+            for failure in found:
+                failures[failure] = min(failures.get(failure, index), index)
+            now = time.perf_counter()
+            if now - last_report >= 10 or done == num_cases:
+                last_report = now
+                print(
+                    f"{done:>12} cases {done / (now - start):>10.1f} cases/s "
+                    f"{len(failures):>6} failures"
+                )
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="OpenJTalk音素ラベルのIPA変換の差分ファジング"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+    parser.add_argument("--cases", type=int, default=100_000, help="発話数")
+    parser.add_argument("--max-units", type=int, default=64, help="1発話の最大の単位数")
+    parser.add_argument(
+        "--candidates",
+        nargs="+",
+        default=["labels", "batch", "ipa", "cache", "features"],
+        choices=["labels", "batch", "ipa", "cache", "features"],
+        help="検査対象",
+    )
+    parser.add_argument(
+        "--task-size", type=int, default=_TASK_SIZE, help="1タスクの発話数"
+    )
+    parser.add_argument(
+        "--start-task",
+        type=int,
+        default=0,
+        help="最初のタスク番号（報告されたタスクの再実行用）",
+    )
+    parser.add_argument(
+        "--processes", type=int, default=os.cpu_count(), help="ワーカープロセス数"
+    )
+    args = parser.parse_args()
+
+    failures = fuzz(
+        args.seed,
+        args.cases,
+        args.candidates,
+        args.max_units,
+        args.task_size,
+        args.start_task,
+        args.processes,
+    )
+    print()
+    if not failures:
+        print("全ての発話で参照と一致しました")
+        return
+    print(f"結果が異なる最小の発話: {len(failures)}")
+    for (name, units), index in sorted(failures.items(), key=lambda f: f[1]):
+        labels = " ".join(chain.from_iterable(units))
+        print(f"[{name}] {labels}")
+        print(
+            f"    再実行: --seed {args.seed} --start-task {index} --cases "
+            f"{args.task_size} --task-size {args.task_size} --max-units "
+            f"{args.max_units}"
+        )
+    raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
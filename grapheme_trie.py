@@ -0,0 +1,92 @@
+"""
+グラフィームの最長一致マッチングを行うトライ
+
+SimpleEpitranの_construct_regexは、マッピングCSVの全グラフィームを長さ降順に
+並べた選択（a|b|c|...）の正規表現を作るため、各位置でマッピング行数に比例した
+試行が走る。GraphemeTrieは同じ最長一致の結果を、1ステップあたり
+O(最長グラフィーム長)で返す。
+
+match()はregexのPatternと同じ呼び出し方・戻り値（group(0), start(), end()）を
+持つため、_construct_regexの戻り値としてそのまま差し替えられる。
+"""
+
+from collections.abc import Iterable
+
+# 終端ノードを表すキー（1文字の遷移キーとは衝突しない）
+_END = ""
+
+
+class GraphemeMatch:
+    """GraphemeTrie.matchの結果（regexのMatchと同じアクセス方法を持つ）"""
+
+    __slots__ = ("endpos", "pos", "string")
+
+    def __init__(self, string: str, pos: int, endpos: int):
+        self.string = string
+        self.pos = pos
+        self.endpos = endpos
+
+    def group(self, index: int = 0) -> str:
+        if index not in (0, 1):
+            raise IndexError("no such group")
+        return self.string[self.pos : self.endpos]
+
+    def start(self) -> int:
+        return self.pos
+
+    def end(self) -> int:
+        return self.endpos
+
+
+class GraphemeTrie:
+    """グラフィームの最長一致マッチャー"""
+
+    def __init__(self, graphemes: Iterable[str], ignore_case: bool = False):
+        """
+        Args:
+            graphemes: マッチ対象のグラフィーム（空文字列は無視）
+            ignore_case: Trueの場合、小文字化して比較する（regex.I相当）
+        """
+        self._ignore_case = ignore_case
+        self._root: dict = {}
+        self.max_length = 0
+
+        for grapheme in graphemes:
+            if not grapheme:
+                continue
+            node = self._root
+            for char in grapheme:
+                if ignore_case:
+                    char = char.lower()
+                node = node.setdefault(char, {})
+            node[_END] = True
+            self.max_length = max(self.max_length, len(grapheme))
+
+    def match(self, text: str, pos: int = 0) -> GraphemeMatch | None:
+        """
+        textのpos位置から始まる最長のグラフィームを返す
+
+        Args:
+            text: 入力文字列
+            pos: マッチングを開始する位置
+
+        Returns:
+            マッチ結果（どのグラフィームにもマッチしない場合はNone）
+        """
+        node = self._root
+        end = -1
+        i = pos
+        length = len(text)
+        while i < length:
+            char = text[i]
+            if self._ignore_case:
+                char = char.lower()
+            node = node.get(char)
+            if node is None:
+                break
+            i += 1
+            if _END in node:
+                end = i
+        if end < 0:
+            return None
+        return GraphemeMatch(text, pos, end)
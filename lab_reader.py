@@ -0,0 +1,454 @@
+"""
+labファイル（HTK形式の音素ラベルと時刻）の読み込み
+
+音素ラベルと開始・終了時刻を配列として読むLabTiming・read_lab_timing、
+HTSフルコンテキストラベルから現在の音素・アクセントを取り出す
+read_full_context_lab、多数のlabファイルをまとめて読むread_lab_files、
+展開せずにアーカイブ内のlabファイルを順に読むiter_lab_archiveを持つ。
+
+音素ラベル列だけを読むread_lab_fileと、読み込んだラベルの変換は
+check_epitran_openjtalk.pyにある。
+"""
+
+import gzip
+import os
+import tarfile
+import zipfile
+from collections.abc import Iterator, Sequence
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from check_epitran_openjtalk import LabelFeatureEngine
+
+# labファイルの時刻（HTKの100ns単位）の1秒あたりの値
+_HTK_TIME_UNITS_PER_SECOND = 10_000_000
+
+
+def htk_to_seconds(times: np.ndarray) -> np.ndarray:
+    """HTKの100ns単位の時刻の配列を秒（float64）にする"""
+    return np.asarray(times, dtype=np.int64) / _HTK_TIME_UNITS_PER_SECOND
+
+
+def htk_to_frames(times: np.ndarray, frame_period: float) -> np.ndarray:
+    """
+    HTKの100ns単位の時刻の配列を、最も近いフレームの境界（int64）にする
+
+    開始・終了時刻の両方を境界として丸めるため、隣り合うラベルのフレームは
+    重ならず、フレーム数の合計は最後の終了時刻のフレームと一致する。
+
+    Args:
+        times: 時刻の配列
+        frame_period: フレーム周期（秒）
+
+    Returns:
+        フレーム番号の配列
+    """
+    frame_units = frame_period * _HTK_TIME_UNITS_PER_SECOND
+    return np.rint(np.asarray(times, dtype=np.int64) / frame_units).astype(np.int64)
+
+
+class LabTiming:
+    """
+    1つのlabファイルの音素ラベルと開始・終了時刻（同じ長さの配列）
+
+    時刻はlabファイルの値（HTKの100ns単位）のまま持つ。
+    """
+
+    def __init__(self, labels: np.ndarray, starts: np.ndarray, ends: np.ndarray):
+        """
+        Args:
+            labels: 音素ラベル（strの配列）
+            starts: 開始時刻（int64の配列）
+            ends: 終了時刻（int64の配列）
+        """
+        self.labels = labels
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def phoneme_labels(self) -> str:
+        """音素ラベル列（read_lab_fileと同じ）"""
+        return " ".join(self.labels.tolist())
+
+    def durations(self) -> np.ndarray:
+        """各ラベルの長さ（HTKの100ns単位）"""
+        return self.ends - self.starts
+
+    def seconds(self) -> tuple[np.ndarray, np.ndarray]:
+        """(開始時刻, 終了時刻)を秒にしたもの"""
+        return htk_to_seconds(self.starts), htk_to_seconds(self.ends)
+
+    def frames(self, frame_period: float) -> tuple[np.ndarray, np.ndarray]:
+        """
+        (開始フレーム, 終了フレーム)を求める（終了フレームは含まない）
+
+        Args:
+            frame_period: フレーム周期（秒）
+        """
+        return (
+            htk_to_frames(self.starts, frame_period),
+            htk_to_frames(self.ends, frame_period),
+        )
+
+    def frame_durations(self, frame_period: float) -> np.ndarray:
+        """
+        各ラベルのフレーム数を求める
+
+        Args:
+            frame_period: フレーム周期（秒）
+        """
+        starts, ends = self.frames(frame_period)
+        return ends - starts
+
+
+def read_lab_timing(lab_file: str) -> LabTiming:
+    """
+    labファイルの音素ラベルと開始・終了時刻を読み込む
+
+    ファイルは1回のreadで読み、ラベルと時刻をそれぞれまとめて配列にする。
+    3列未満の行を飛ばす点はread_lab_fileと同じ。
+
+    Args:
+        lab_file: labファイルのパス
+
+    Returns:
+        音素ラベルと時刻
+
+    Raises:
+        ValueError: 時刻が整数でない行がある場合
+    """
+    with open(lab_file, "rb") as f:
+        return _lab_timing(_split_lab_lines(f.read()))
+
+
+def _lab_timing(tokens: list[bytes], full_context: bool = False) -> LabTiming:
+    """_split_lab_linesのトークン列からLabTimingを作る"""
+    labels = tokens[2::3]
+    if full_context:
+        labels = _full_context_phonemes(labels)
+    return LabTiming(
+        np.array([label.decode("utf-8") for label in labels], dtype=str),
+        _parse_times(tokens[0::3]),
+        _parse_times(tokens[1::3]),
+    )
+
+
+# HTSフルコンテキストラベルのアクセント（A:a1+a2+a3）が未定義（xx）の場合の値
+_ACCENT_MISSING = np.iinfo(np.int16).min
+
+
+def _full_context_phonemes(contexts: list[bytes]) -> list[bytes]:
+    """
+    HTSフルコンテキストラベル（p1^p2-p3+p4=p5/A:...）から現在の音素（p3）を取り出す
+
+    p1・p2は音素かxxで「-」を含まないため、最初の「-」から次の「+」までがp3になる。
+
+    Raises:
+        ValueError: 「-p3+」の欄がないラベル（モノフォンのラベルなど）がある場合
+    """
+    fields = [c.partition(b"-")[2].partition(b"+") for c in contexts]
+    for context, (phoneme, plus, _) in zip(contexts, fields):
+        if not phoneme or not plus:
+            raise ValueError(
+                "フルコンテキストラベルに音素の欄（-p3+）がありません: "
+                f"{context.decode('utf-8', 'replace')}"
+            )
+    return [phoneme for phoneme, _, _ in fields]
+
+
+def _full_context_accents(contexts: list[bytes]) -> np.ndarray:
+    """
+    HTSフルコンテキストラベルのアクセントの欄（/A:a1+a2+a3/）を取り出す
+
+    全ラベルの欄を「+」でつないでから、1回の変換で整数にする。
+
+    Returns:
+        (ラベル数, 3)のint16配列（a1: アクセント核からの位置、a2・a3: アクセント句
+        の先頭・末尾からのモーラ位置。xxは_ACCENT_MISSING）
+
+    Raises:
+        ValueError: アクセントの欄が3つの整数（またはxx）でないラベルがある場合
+    """
+    if not contexts:
+        return np.zeros((0, 3), dtype=np.int16)
+    fields = b"+".join(c.partition(b"/A:")[2].partition(b"/")[0] for c in contexts)
+    fields = fields.replace(b"xx", str(_ACCENT_MISSING).encode())
+    try:
+        values = np.fromstring(fields, dtype=np.int64, sep="+")
+    except ValueError as e:
+        raise ValueError("フルコンテキストラベルのアクセントの欄が不正です") from e
+    if len(values) != 3 * len(contexts):
+        raise ValueError("フルコンテキストラベルのアクセントの欄が不正です")
+    return values.reshape(-1, 3).astype(np.int16)
+
+
+def read_full_context_lab(
+    lab_file: str, accent: bool = False
+) -> tuple[LabTiming, np.ndarray | None]:
+    """
+    HTSフルコンテキストラベルのlabファイルから、音素ラベルと時刻を読み込む
+
+    各行のラベルから現在の音素（p3）だけを取り出すため、戻り値のLabTimingは
+    モノフォンのlabファイルをread_lab_timingで読んだものと同じように使える。
+    pyopenjtalk.extract_fullcontextの出力のように時刻がなくラベルだけの
+    ファイルも読み、その場合の開始・終了時刻は全て0になる。
+
+    Args:
+        lab_file: labファイルのパス
+        accent: Trueの場合、アクセントの欄（A:a1+a2+a3）も読み込む
+
+    Returns:
+        (音素ラベルと時刻, (ラベル数, 3)のアクセントの配列
+         （accentがFalseの場合はNone）)
+
+    Raises:
+        ValueError: 時刻が整数でない行がある場合、時刻のある行とない行が
+            混在している場合、音素の欄（-p3+）がないラベル（モノフォンの
+            labファイルなど）がある場合、またはアクセントの欄が不正な場合
+    """
+    with open(lab_file, "rb") as f:
+        tokens = _split_lab_lines(f.read(), full_context=True)
+    timing = _lab_timing(tokens, full_context=True)
+    return timing, _full_context_accents(tokens[2::3]) if accent else None
+
+
+class LabCorpus:
+    """
+    複数のlabファイルの音素ラベルと時刻をまとめて持つ
+
+    全ファイルのラベルを連結した配列と、ファイルごとの範囲（offsets）で持つ。
+    i番目のファイルの要素は[offsets[i], offsets[i + 1])。ラベルはvocabularyの
+    添字（label_ids）で、時刻はlabファイルの値（HTKの100ns単位）のまま持つ。
+    """
+
+    def __init__(
+        self,
+        files: list[str],
+        vocabulary: np.ndarray,
+        label_ids: np.ndarray,
+        starts: np.ndarray,
+        ends: np.ndarray,
+        offsets: np.ndarray,
+    ):
+        """
+        Args:
+            files: labファイルのパス
+            vocabulary: 出現した音素ラベル（昇順）
+            label_ids: 全ファイルの音素ラベルのvocabulary上の添字
+            starts: 全ファイルの開始時刻
+            ends: 全ファイルの終了時刻
+            offsets: ファイルごとの先頭の位置（長さはファイル数+1）
+        """
+        self.files = files
+        self.vocabulary = vocabulary
+        self.label_ids = label_ids
+        self.starts = starts
+        self.ends = ends
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def _range(self, index: int) -> slice:
+        return slice(self.offsets[index], self.offsets[index + 1])
+
+    def ids(self, index: int) -> np.ndarray:
+        """index番目のファイルの音素ラベルの添字"""
+        return self.label_ids[self._range(index)]
+
+    def times(self, index: int) -> tuple[np.ndarray, np.ndarray]:
+        """index番目のファイルの(開始時刻, 終了時刻)"""
+        r = self._range(index)
+        return self.starts[r], self.ends[r]
+
+    def labels(self, index: int) -> list[str]:
+        """index番目のファイルの音素ラベルのリスト"""
+        return self.vocabulary[self.ids(index)].tolist()
+
+    def phoneme_labels(self, index: int) -> str:
+        """index番目のファイルの音素ラベル列（read_lab_fileと同じ）"""
+        return " ".join(self.labels(index))
+
+    def timing(self, index: int) -> LabTiming:
+        """index番目のファイルの音素ラベルと時刻（read_lab_timingと同じ）"""
+        r = self._range(index)
+        return LabTiming(
+            self.vocabulary[self.label_ids[r]], self.starts[r], self.ends[r]
+        )
+
+    def encode(self, engine: "LabelFeatureEngine") -> np.ndarray:
+        """全ファイルの音素ラベルをLabelFeatureEngineのラベルIDにする"""
+        return engine.encode(self.vocabulary.tolist())[self.label_ids]
+
+
+def list_lab_files(source: str | Sequence[str]) -> list[str]:
+    """
+    labファイルのパスのリストを返す
+
+    Args:
+        source: ディレクトリ（サブディレクトリを含む*.labを名前順に返す）、
+            1つのlabファイルのパス、またはlabファイルのパスのシーケンス
+
+    Returns:
+        labファイルのパスのリスト
+    """
+    if isinstance(source, str):
+        if os.path.isdir(source):
+            return sorted(str(p) for p in Path(source).rglob("*.lab"))
+        return [source]
+    return list(source)
+
+
+def _split_lab_lines(data: bytes, full_context: bool = False) -> list[bytes]:
+    """
+    labファイルの内容を(開始時刻, 終了時刻, ラベル)の順のトークン列にする
+
+    read_lab_fileと同じく3列未満の行は飛ばし、4列目以降は無視する。
+    full_contextがTrueの場合は、pyopenjtalk.extract_fullcontextの出力のように
+    全ての行がラベルだけのファイルも読み、開始・終了時刻を0とする。
+
+    Raises:
+        ValueError: full_contextがTrueで、時刻のある行とラベルだけの行が
+            混在している場合
+    """
+    tokens = data.split()
+    if len(tokens) % 3 == 0:
+        starts, ends = tokens[0::3], tokens[1::3]
+        if b"".join(starts).isdigit() and b"".join(ends).isdigit():
+            return tokens
+    # 列数の揃っていない行があるファイルは1行ずつ分ける
+    tokens = []
+    label_only = []
+    for line in data.splitlines():
+        parts = line.split()
+        if len(parts) >= 3:
+            tokens += parts[:3]
+        elif len(parts) == 1 and full_context:
+            label_only.append(parts[0])
+    if label_only:
+        if tokens:
+            raise ValueError(
+                "フルコンテキストラベルのlabファイルに時刻のある行とない行が混在しています"
+            )
+        tokens = [token for label in label_only for token in (b"0", b"0", label)]
+    return tokens
+
+
+def _parse_times(tokens: list[bytes]) -> np.ndarray:
+    """時刻のトークン列を1回の変換でint64の配列にする"""
+    if not tokens:
+        return np.zeros(0, dtype=np.int64)
+    try:
+        return np.fromstring(b" ".join(tokens), dtype=np.int64, sep=" ")
+    except ValueError as e:
+        raise ValueError("labファイルの時刻が整数ではありません") from e
+
+
+def read_lab_files(
+    source: str | Sequence[str], full_context: bool = False
+) -> LabCorpus:
+    """
+    複数のlabファイルの音素ラベルと時刻をまとめて読み込む
+
+    各ファイルは1回のreadで読んでまとめて空白で分け、全ファイルのトークンを
+    連結してから、時刻の数値変換とラベルの添字付けを1回ずつまとめて行う。
+
+    Args:
+        source: labファイルのディレクトリ（サブディレクトリも含めて*.labを
+            名前順に読む）、labファイルのパス、またはそのリスト
+        full_context: Trueの場合、HTSフルコンテキストラベルのlabファイルとして
+            現在の音素（p3）を読み込む（read_full_context_labと同じく、
+            ラベルだけのファイルも時刻を0として読む）
+
+    Returns:
+        読み込んだラベルと時刻
+
+    Raises:
+        ValueError: 時刻が整数でない行がある場合、またはfull_contextがTrueで
+            音素の欄（-p3+）がないラベル（モノフォンのlabファイルなど）がある場合
+    """
+    files = list_lab_files(source)
+    tokens: list[bytes] = []
+    offsets = [0]
+    for lab_file in files:
+        with open(lab_file, "rb") as f:
+            tokens += _split_lab_lines(f.read(), full_context)
+        offsets.append(len(tokens) // 3)
+    labels = tokens[2::3]
+    if full_context:
+        labels = _full_context_phonemes(labels)
+
+    # ラベルの種類は少ないため、np.uniqueで並べ替えるより辞書で添字を引く方が速い
+    vocabulary = sorted(set(labels))
+    label_index = {label: i for i, label in enumerate(vocabulary)}
+    id_dtype = np.min_scalar_type(max(len(vocabulary) - 1, 0))
+    return LabCorpus(
+        files,
+        np.array([label.decode("utf-8") for label in vocabulary], dtype=str),
+        np.fromiter(map(label_index.__getitem__, labels), id_dtype, len(labels)),
+        _parse_times(tokens[0::3]),
+        _parse_times(tokens[1::3]),
+        np.array(offsets, dtype=np.int64),
+    )
+
+
+def iter_lab_archive(
+    archive: str, full_context: bool = False
+) -> Iterator[tuple[str, LabTiming]]:
+    """
+    tar（gzip・bz2・xz圧縮を含む）またはzipのアーカイブ内のlabファイルを順に読む
+
+    gzip圧縮した1つのlabファイル（.lab.gz）も、.gzを除いた名前の
+    1ファイルだけのアーカイブとして読む。
+
+    展開せずにメンバーを1つずつメモリ上で読むため、一時ファイルは作らず、
+    使うメモリはアーカイブの大きさによらず1ファイル分になる。tarは先頭から
+    ストリームとして読むため、パイプなどシークできない入力にも使える。
+
+    Args:
+        archive: アーカイブのパス
+        full_context: Trueの場合、HTSフルコンテキストラベルのlabファイルとして
+            現在の音素（p3）を読み込む（read_full_context_labと同じく、
+            ラベルだけのファイルも時刻を0として読む）
+
+    Yields:
+        (アーカイブ内のパス, 音素ラベルと時刻)（アーカイブに格納された順）
+
+    Raises:
+        ValueError: 時刻が整数でない行がある場合、full_contextがTrueで
+            音素の欄（-p3+）がないラベル（モノフォンのlabファイルなど）がある場合、
+            またはarchiveが対応する形式でない場合
+    """
+    if archive.endswith(".lab.gz"):
+        with gzip.open(archive, "rb") as f:
+            tokens = _split_lab_lines(f.read(), full_context)
+        name = os.path.basename(archive).removesuffix(".gz")
+        yield name, _lab_timing(tokens, full_context)
+        return
+
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or not info.filename.endswith(".lab"):
+                    continue
+                tokens = _split_lab_lines(zf.read(info), full_context)
+                yield info.filename, _lab_timing(tokens, full_context)
+        return
+
+    try:
+        with tarfile.open(archive, mode="r|*") as tf:
+            for member in tf:
+                if not member.isfile() or not member.name.endswith(".lab"):
+                    continue
+                tokens = _split_lab_lines(tf.extractfile(member).read(), full_context)
+                yield member.name, _lab_timing(tokens, full_context)
+    except tarfile.ReadError as e:
+        raise ValueError(
+            f"labファイルのアーカイブとして読めません: {archive}"
+            "（対応形式: tar・tar.gz・tar.bz2・tar.xz・zip・lab.gz）"
+        ) from e
@@ -0,0 +1,94 @@
+import csv
+import os
+
+import numpy as np
+
+from batch_epitran_openjtalk import convert_lab_files, run_batch
+from check_epitran_openjtalk import get_label_feature_engine, phoneme_labels_to_ipa
+
+# (ファイル名, 音素ラベル列)。bad.labは未知ラベルxxを含む
+_UTTERANCES = [
+    ("000.lab", "sil k o N n i ch i w a sil"),
+    ("001.lab", "sil s a N p o pau s a N p o sil"),
+    ("002.lab", "sil h a xx i sil"),
+    ("003.lab", "sil kw a sil"),
+    ("004.lab", "sil k a cl p a sil"),
+    ("005.lab", "sil a N N a sil"),
+    ("006.lab", "sil e N sil"),
+]
+
+
+def _write_labs(directory) -> list[str]:
+    files = []
+    for name, labels in _UTTERANCES:
+        lab_file = directory / name
+        lines = [
+            f"{i * 500000} {(i + 1) * 500000} {label}\n"
+            for i, label in enumerate(labels.split())
+        ]
+        lab_file.write_text("".join(lines), encoding="utf-8")
+        files.append(os.fspath(lab_file))
+    return files
+
+
+def test_convert_lab_files_in_order_with_processes(tmp_path):
+    files = _write_labs(tmp_path)
+    results = list(convert_lab_files(files, True, processes=2, chunk_size=2))
+    assert len(results) == 4
+
+    rows = [row for result in results for row in result.rows]
+    features = [x for result in results for x in result.features]
+    assert [row[0] for row in rows] == files
+    engine = get_label_feature_engine()
+    for (lab_file, labels, ipa, xsampa), row_features, (name, expected) in zip(
+        rows, features, _UTTERANCES
+    ):
+        assert labels == expected
+        if name == "002.lab":
+            assert (ipa, xsampa) == ("", "")
+            assert row_features.shape == (0, len(engine.feature_names))
+        else:
+            assert ipa == phoneme_labels_to_ipa(expected)
+            assert xsampa
+            np.testing.assert_array_equal(
+                row_features, engine.features(expected.split())
+            )
+
+    failures = [f for result in results for f in result.error_log.failures]
+    assert failures == [(files[2], [(3, "xx")])]
+    assert sum(result.error_log.num_utterances for result in results) == len(files)
+
+
+def test_run_batch_writes_rows_and_feature_offsets(tmp_path):
+    files = _write_labs(tmp_path)
+    output = tmp_path / "out.tsv"
+    features_file = tmp_path / "features.npz"
+    report_file = tmp_path / "report.tsv"
+    error_log = run_batch(
+        files,
+        os.fspath(output),
+        os.fspath(features_file),
+        os.fspath(report_file),
+        processes=2,
+        chunk_size=3,
+    )
+    assert [utterance_id for utterance_id, _ in error_log.failures] == [files[2]]
+
+    with output.open(encoding="utf-8") as f:
+        rows = list(csv.reader(f, delimiter="\t"))
+    assert rows[0] == ["lab_file", "phoneme_labels", "ipa", "xsampa"]
+    assert [row[0] for row in rows[1:]] == files
+
+    engine = get_label_feature_engine()
+    with np.load(features_file) as npz:
+        offsets = npz["offsets"]
+        assert npz["files"].tolist() == files
+        assert len(offsets) == len(files) + 1
+        assert offsets[-1] == len(npz["features"])
+        for i, (name, labels) in enumerate(_UTTERANCES):
+            rows_i = npz["features"][offsets[i] : offsets[i + 1]]
+            if name == "002.lab":
+                assert len(rows_i) == 0
+            else:
+                np.testing.assert_array_equal(rows_i, engine.features(labels.split()))
+    assert f"{files[2]}\t3:xx" in report_file.read_text(encoding="utf-8")
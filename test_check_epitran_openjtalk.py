@@ -0,0 +1,459 @@
+import os
+import random
+import shutil
+import time
+import warnings
+
+import numpy as np
+import pytest
+from epitran.rules import Rules
+
+import check_epitran_openjtalk
+from check_epitran_openjtalk import (
+    _MAP_FILE,
+    _POST_FILE,
+    EpitranPool,
+    EpitranReloader,
+    LabelFeatureEngine,
+    OpenJTalkLabelEpitran,
+    SegmentIPACache,
+    _CompiledRules,
+    _get_epitran,
+    _ipa_features,
+    frame_positions,
+    get_epitran,
+    get_label_feature_engine,
+    lab_timing_to_frame_features,
+    phoneme_labels_to_ipa,
+    profile_postprocess_rules,
+    reload_epitran,
+)
+from lab_reader import htk_to_frames, read_lab_timing
+
+# 特徴量テーブルの検査に使う音素ラベル列（kw・gw、N・clの文脈、無声化母音、
+# pau・silの境界を含む）
+_FEATURE_UTTERANCES = [
+    "sil k o N n i ch i w a sil",
+    "s a N p o",
+    "s a N pau p o",
+    "a N N a",
+    "kw a k o",
+    "gw a i k o k u",
+    "k a cl p a",
+    "k a cl pau p a",
+    "r a N r i",
+    "sil z a N z o sil",
+    "h a sh I t o",
+    "e N",
+    "sil N sil",
+]
+
+
+def _reference_features(labels: str, epi: OpenJTalkLabelEpitran) -> np.ndarray:
+    """参照実装のIPAから求めた特徴量"""
+    return _ipa_features(phoneme_labels_to_ipa(labels, epi))
+
+
+def _random_utterances(epi: OpenJTalkLabelEpitran, count: int) -> list[str]:
+    """マッピングのキーを音素ラベルに分けて並べた発話（pauを含む）"""
+    engine = get_label_feature_engine(epi)
+    units = [label for label in engine.labels if label not in engine._consonants]
+    for consonant in sorted(engine._consonants):
+        units += [f"{consonant} {v}" for v in engine._follows[consonant]]
+    units.append("pau")
+    rng = random.Random(0)
+    return [
+        " ".join(rng.choice(units) for _ in range(rng.randint(1, 12)))
+        for _ in range(count)
+    ]
+
+
+def test_missing_post_file_raises(tmp_path):
+    missing = os.fspath(tmp_path / "missing.txt")
+    with pytest.raises(FileNotFoundError):
+        OpenJTalkLabelEpitran(_MAP_FILE, post_file=missing)
+    with pytest.raises(FileNotFoundError):
+        get_epitran(_MAP_FILE, missing)
+
+
+def test_missing_map_file_raises(tmp_path):
+    missing = os.fspath(tmp_path / "missing.csv")
+    with pytest.raises(FileNotFoundError):
+        OpenJTalkLabelEpitran(missing, post_file=_POST_FILE)
+
+
+def test_feature_table_matches_reference():
+    epi = _get_epitran()
+    engine = LabelFeatureEngine(epi)
+    utterances = _FEATURE_UTTERANCES + _random_utterances(epi, 300)
+    for labels in utterances:
+        np.testing.assert_array_equal(
+            engine.features(labels.split()), _reference_features(labels, epi), labels
+        )
+    for labels, features in zip(
+        utterances, engine.features_many([u.split() for u in utterances])
+    ):
+        np.testing.assert_array_equal(features, _reference_features(labels, epi))
+
+
+def test_feature_table_rows_of_two_segment_labels():
+    engine = LabelFeatureEngine(_get_epitran())
+    for labels, ipa in [("kw a", "kɰ"), ("gw a", "ɡɰ")]:
+        alignment = engine.align(labels.split())
+        assert alignment.num_rows().tolist() == [2, 1]
+        assert alignment.label_ipa(0) == ipa
+        with pytest.raises(ValueError):
+            engine.label_features(labels.split())
+
+
+def test_feature_table_silence_boundary():
+    engine = LabelFeatureEngine(_get_epitran())
+    # ɴ -> m / _ pはpauをまたがない
+    assert engine.align("s a N p o".split()).label_ipa(2) == "m"
+    alignment = engine.align("s a N pau p o".split())
+    assert alignment.ipa == "saɴ po"
+    assert alignment.label_ipa(2) == "ɴ"
+    assert alignment.num_rows().tolist() == [1, 1, 1, 0, 1, 1]
+
+
+def test_feature_table_long_segments_match_reference():
+    epi = _get_epitran()
+    engine = LabelFeatureEngine(epi)
+    # 1つのルールの置換回数の上限（32）を超える撥音と、連続する撥音
+    for labels in [" ".join(["s a N p o"] * 40), " ".join(["a"] + ["N"] * 40)]:
+        np.testing.assert_array_equal(
+            engine.features(labels.split()), _reference_features(labels, epi)
+        )
+
+
+def test_feature_table_falls_back_for_wide_context(tmp_path):
+    post_file = tmp_path / "post.txt"
+    shutil.copyfile(_POST_FILE, post_file)
+    with post_file.open("a", encoding="utf-8") as f:
+        # 母音の後ろの子音まで見るルールは(前, 対象, 次, 次の次)の窓に収まらない
+        f.write("\na -> e / _ k\n")
+    epi = OpenJTalkLabelEpitran(_MAP_FILE, post_file=os.fspath(post_file))
+    with pytest.warns(UserWarning, match="falling back"):
+        engine = LabelFeatureEngine(epi)
+    assert phoneme_labels_to_ipa("k a k a", epi) == "keka"
+    for labels in ["k a k a", "s a N k a", *_FEATURE_UTTERANCES]:
+        np.testing.assert_array_equal(
+            engine.features(labels.split()), _reference_features(labels, epi), labels
+        )
+
+
+# 手書きのlabファイル（1行目の開始時刻とフレーム境界はそろえていない）
+_TIMED_LAB = """\
+120000 1230000 sil
+1230000 1790000 kw
+1790000 2410000 a
+2410000 3000000 pau
+3000000 3520000 s
+3520000 4000000 a
+4000000 4480000 N
+4480000 5000000 sil
+"""
+
+
+def test_label_alignment_spans_and_rows():
+    engine = LabelFeatureEngine(_get_epitran())
+    labels = "sil kw a pau s a N sil".split()
+    alignment = engine.align(labels)
+    assert alignment.ipa == "kɰa saɴ"
+    label_ipa = ["", "kɰ", "a", "", "s", "a", "ɴ", ""]
+    assert [alignment.label_ipa(i) for i in range(len(labels))] == label_ipa
+    # 2つ目のセグメントの先頭（s）の前にはスペースが1文字入る
+    assert alignment.ipa_spans[:, 0].tolist() == [0, 0, 2, 3, 4, 5, 6, 7]
+    assert alignment.ipa_spans[:, 1].tolist() == [0, 2, 3, 3, 5, 6, 7, 7]
+    assert alignment.feature_rows.tolist() == [0, 0, 2, 3, 3, 4, 5, 6, 6]
+    np.testing.assert_array_equal(alignment.features, _ipa_features(alignment.ipa))
+    for i in range(len(labels)):
+        rows = alignment.features[
+            alignment.feature_rows[i] : alignment.feature_rows[i + 1]
+        ]
+        np.testing.assert_array_equal(rows, _ipa_features(alignment.label_ipa(i)))
+
+
+def test_label_features_keeps_silence_rows():
+    engine = LabelFeatureEngine(_get_epitran())
+    labels = "sil k a pau s a N sil".split()
+    for silence_value in [0, -1]:
+        rows, mask = engine.label_features(labels, silence_value)
+        assert rows.shape == (len(labels), len(engine.feature_names))
+        assert mask.tolist() == [False, True, True, False, True, True, True, False]
+        assert (rows[~mask] == silence_value).all()
+        np.testing.assert_array_equal(rows[mask], engine.features(labels))
+        alignment_rows, alignment_mask = engine.align(labels).label_features(
+            silence_value
+        )
+        np.testing.assert_array_equal(alignment_rows, rows)
+        np.testing.assert_array_equal(alignment_mask, mask)
+
+
+def test_frame_features_from_lab(tmp_path):
+    lab_file = tmp_path / "utt.lab"
+    lab_file.write_text(_TIMED_LAB)
+    timing = read_lab_timing(os.fspath(lab_file))
+    frame_period = 0.005
+    features, positions = lab_timing_to_frame_features(
+        timing, frame_period, positions=True
+    )
+
+    starts, ends = timing.frames(frame_period)
+    frame_counts = timing.frame_durations(frame_period)
+    total = (
+        htk_to_frames(timing.ends[-1:], frame_period)[0]
+        - htk_to_frames(timing.starts[:1], frame_period)[0]
+    )
+    assert starts[0] == 2
+    assert frame_counts.sum() == total == len(features) == len(positions)
+
+    engine = get_label_feature_engine()
+    labels = timing.labels.tolist()
+    alignment = engine.align(labels)
+    offsets = np.concatenate(([0], np.cumsum(frame_counts)))
+    for i, label in enumerate(labels):
+        frames = features[offsets[i] : offsets[i + 1]]
+        rows = alignment.features[
+            alignment.feature_rows[i] : alignment.feature_rows[i + 1]
+        ]
+        if label in ("pau", "sil"):
+            assert (frames == 0).all()
+            assert (positions[offsets[i] : offsets[i + 1]] == 0).all()
+        elif label == "kw":
+            # 2行の特徴量にフレームを前半・後半で分ける
+            half = frame_counts[i] // 2
+            assert (frames[:half] == rows[0]).all()
+            assert (frames[half:] == rows[1]).all()
+        else:
+            assert (frames == rows[0]).all()
+
+    label_positions = positions[offsets[:-1]]
+    np.testing.assert_allclose(label_positions[1:3, 0], [0.25, 0.75])
+    np.testing.assert_allclose(label_positions[4:7, 0], [1 / 6, 3 / 6, 5 / 6])
+    np.testing.assert_allclose(label_positions[4:7, 1], [5 / 6, 3 / 6, 1 / 6])
+    np.testing.assert_array_equal(positions, frame_positions(labels, frame_counts))
+
+
+def test_frame_features_rejects_bad_frame_counts():
+    engine = LabelFeatureEngine(_get_epitran())
+    labels = "sil kw a sil".split()
+    # 0フレームのラベルは出力しない
+    features = engine.frame_features(labels, [3, 0, 2, 0])
+    assert len(features) == 5
+    with pytest.raises(ValueError, match="Too few frames"):
+        engine.frame_features(labels, [3, 1, 2, 0])
+    with pytest.raises(ValueError, match="negative"):
+        engine.frame_features(labels, [3, 2, -1, 0])
+    with pytest.raises(ValueError, match="Length mismatch"):
+        engine.frame_features(labels, [3, 2, 2])
+
+
+# ポストプロセスのルールの文脈に現れる文字
+_RULE_ALPHABET = "aiɯeoɴʔɾzʑkɡsɕtdhçjɸɰpbɖmnɲʲ"
+
+
+def _rule_texts(count: int) -> list[str]:
+    rng = random.Random(0)
+    return [
+        "".join(rng.choice(_RULE_ALPHABET) for _ in range(rng.randint(0, 10)))
+        for _ in range(count)
+    ]
+
+
+def _assert_rules_match(rule_file: str, texts: list[str]) -> None:
+    rules = Rules([rule_file])
+    compiled = _CompiledRules([rule_file])
+    expected = [rules.apply(text) for text in texts]
+    assert [compiled.apply(text) for text in texts] == expected
+    assert compiled.apply_many(texts) == expected
+
+
+def test_compiled_rules_match_epitran():
+    texts = _rule_texts(2000)
+    # 1つのルールが32箇所を超えてマッチする文字列
+    texts += ["aɴp" * 40, "ʔk" * 40 + "ɾa", "aɴs" * 33]
+    _assert_rules_match(_POST_FILE, texts)
+
+
+def test_compiled_rules_batch_edges():
+    # 前後の要素とつなげると文脈がマッチする文字で始まる・終わる要素
+    texts = ["ɴ", "pa", "aɴ", "ka", "ʔ", "k", "ɾa", "ɴ", "ɾ", "", "iɴ", "sa", "ʔ"]
+    _assert_rules_match(_POST_FILE, texts)
+    # 長い要素と短い要素が混ざったバッチ（連結した文字列全体の置換回数は
+    # 上限を超えるが、各要素は超えない場合と超える場合）
+    _assert_rules_match(_POST_FILE, ["aɴp"] * 40)
+    _assert_rules_match(_POST_FILE, ["aɴp" * 40, "aɴp", "ɴ", "pa"])
+
+
+def test_compiled_rules_non_literal_patterns(tmp_path):
+    rule_file = tmp_path / "rules.txt"
+    rule_file.write_text(
+        "::v:: = a|i\n"
+        "ɴ -> m / _ [pb]\n"
+        "o -> u / . _ #\n"
+        "a -> e / # _ .\n"
+        "i -> e / (::v::) _ k\n",
+        encoding="utf-8",
+    )
+    texts = _rule_texts(1000) + ["o", "ako", "aik", "aɴ", "pa", "aɴp" * 40]
+    _assert_rules_match(os.fspath(rule_file), texts)
+    _assert_rules_match(os.fspath(rule_file), ["ak", "o", "ɴ", "b", "a", "ik"])
+
+
+def test_profile_postprocess_rules_excludes_table_fill():
+    epi = OpenJTalkLabelEpitran(_MAP_FILE, post_file=_POST_FILE)
+    engine = LabelFeatureEngine(epi)
+    labels = "s a N p o pau k a cl p a"
+    with profile_postprocess_rules(epi) as profile:
+        # テーブルを埋めるための変換は計測しない
+        engine.features(labels.split())
+        assert sum(profile.calls) == 0
+        assert phoneme_labels_to_ipa(labels, epi) == "sampo kappa"
+    assert sum(profile.calls) > 0
+    assert epi.postprocessor.profile is None
+
+
+def test_profile_postprocess_rules_requires_custom_postprocessor():
+    epi = OpenJTalkLabelEpitran(_MAP_FILE)
+    with pytest.raises(TypeError), profile_postprocess_rules(epi):
+        pass
+
+
+def test_segment_cache_lru_eviction():
+    cache = SegmentIPACache(2)
+    cache.put("v", ("a",), "a")
+    cache.put("v", ("i",), "i")
+    assert cache.get("v", ("a",)) == "a"
+    cache.put("v", ("u",), "ɯ")
+    assert cache.get("v", ("i",)) is None
+    assert cache.get("v", ("a",)) == "a"
+    assert cache.get("v", ("u",)) == "ɯ"
+    assert cache.stats()["evictions"] == 1
+    cache.resize(1)
+    assert cache.stats()["size"] == 1
+    assert cache.get("v", ("u",)) == "ɯ"
+
+
+def test_segment_cache_discard_and_restore_version():
+    cache = SegmentIPACache(10)
+    cache.put("old", ("a",), "a")
+    cache.put("new", ("a",), "e")
+    cache.discard_version("old")
+    assert cache.get("old", ("a",)) is None
+    assert cache.get("new", ("a",)) == "e"
+    # 破棄した後に古いインスタンスで変換を終えた呼び出しのputは無視する
+    cache.put("old", ("a",), "a")
+    assert cache.get("old", ("a",)) is None
+    cache.restore_version("old")
+    cache.put("old", ("a",), "a")
+    assert cache.get("old", ("a",)) == "a"
+
+
+def test_phoneme_labels_to_ipa_deduplicates_misses(monkeypatch):
+    monkeypatch.setattr(check_epitran_openjtalk, "_segment_cache", SegmentIPACache(100))
+    epi = OpenJTalkLabelEpitran(_MAP_FILE, post_file=_POST_FILE)
+    batches = []
+    transliterate_many = epi.transliterate_many
+
+    def record(items, *args, **kwargs):
+        items = list(items)
+        batches.append(items)
+        return transliterate_many(items, *args, **kwargs)
+
+    monkeypatch.setattr(epi, "transliterate_many", record)
+    labels = "sil h a i pau s o u pau h a i pau h a i sil"
+    assert phoneme_labels_to_ipa(labels, epi) == "hai soɯ hai hai"
+    assert batches == [[("h", "a", "i"), ("s", "o", "u")]]
+    assert phoneme_labels_to_ipa(labels, epi) == "hai soɯ hai hai"
+    assert len(batches) == 1
+
+
+@pytest.fixture
+def default_files(tmp_path, monkeypatch):
+    """デフォルトのマッピング・ルールファイルをtmp_pathのコピーに差し替える"""
+    map_file = tmp_path / "map.csv"
+    post_file = tmp_path / "post.txt"
+    shutil.copyfile(_MAP_FILE, map_file)
+    shutil.copyfile(_POST_FILE, post_file)
+    module = check_epitran_openjtalk
+    monkeypatch.setattr(module, "_MAP_FILE", os.fspath(map_file))
+    monkeypatch.setattr(module, "_POST_FILE", os.fspath(post_file))
+    monkeypatch.setattr(module, "_SNAPSHOT_DIR", os.fspath(tmp_path / "snapshots"))
+    monkeypatch.setattr(module, "_epitran_instance", None)
+    monkeypatch.setattr(module, "_epitran_pool", EpitranPool(4))
+    monkeypatch.setattr(module, "_segment_cache", SegmentIPACache(100))
+    return map_file, post_file
+
+
+def _edit_map(map_file, old: str, new: str) -> None:
+    text = map_file.read_text(encoding="utf-8")
+    assert old in text
+    map_file.write_text(text.replace(old, new), encoding="utf-8")
+
+
+def test_reload_epitran_applies_map_change(default_files):
+    map_file, _ = default_files
+    assert phoneme_labels_to_ipa("k a pau k a") == "ka ka"
+    old_version = _get_epitran().version
+    assert not reload_epitran()
+
+    _edit_map(map_file, "\nka,ka\n", "\nka,kʰa\n")
+    assert reload_epitran()
+    assert _get_epitran().version != old_version
+    # 古いversionのキャッシュにヒットせず、新しいマッピングで変換する
+    assert phoneme_labels_to_ipa("k a pau k a") == "kʰa kʰa"
+    assert check_epitran_openjtalk._segment_cache.get(old_version, ("k", "a")) is None
+
+
+def _wait_until(condition, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_epitran_reloader_keeps_old_engine_on_missing_file(default_files):
+    map_file, post_file = default_files
+    assert phoneme_labels_to_ipa("s a N p o") == "sampo"
+    # 監視スレッドの警告を記録できるよう、記録中にスレッドを開始する
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        reloader = EpitranReloader(interval=0.01).start()
+        try:
+            # 保存中のエディタのように、ルールファイルを一時的に消す
+            post_file.unlink()
+            _wait_until(lambda: caught)
+            assert phoneme_labels_to_ipa("s a N p o") == "sampo"
+
+            shutil.copyfile(_POST_FILE, post_file)
+            _edit_map(map_file, "\nka,ka\n", "\nka,kʰa\n")
+            _wait_until(lambda: reloader.reload_count)
+        finally:
+            reloader.stop()
+    assert "Failed to reload" in str(caught[0].message)
+    assert reloader.reload_count == 1
+    assert phoneme_labels_to_ipa("k a s a N p o") == "kʰasampo"
+
+
+def test_epitran_pool_keeps_configs_apart(default_files, tmp_path):
+    map_file, post_file = default_files
+    other_map = tmp_path / "other.csv"
+    shutil.copyfile(map_file, other_map)
+    _edit_map(other_map, "\nka,ka\n", "\nka,kʰa\n")
+
+    pool = check_epitran_openjtalk._epitran_pool
+    epi = pool.get(os.fspath(map_file), os.fspath(post_file))
+    other = pool.get(os.fspath(other_map), os.fspath(post_file))
+    assert epi.version != other.version
+    assert pool.get(os.fspath(map_file), os.fspath(post_file)) is epi
+    for _ in range(2):
+        assert phoneme_labels_to_ipa("k a", epi) == "ka"
+        assert phoneme_labels_to_ipa("k a", other) == "kʰa"
+
+    # 上限を超えて破棄したインスタンス（最も長く使われていないother）の
+    # 変換結果はキャッシュからも消える
+    pool.resize(1)
+    cache = check_epitran_openjtalk._segment_cache
+    assert pool.versions() == [epi.version]
+    assert cache.get(other.version, ("k", "a")) is None
+    assert cache.get(epi.version, ("k", "a")) == "ka"
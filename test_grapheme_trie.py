@@ -0,0 +1,102 @@
+import csv
+import os
+import random
+import re
+
+import pytest
+
+from grapheme_trie import GraphemeTrie
+
+_MAP_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "hiho_data", "openjtalk_to_ipa.csv"
+)
+
+# 共通の接頭辞を持つグラフィーム
+_OVERLAPPING = ["a", "ab", "abc", "abd", "b", "bc", "k", "ky", "kya", "cl", "c"]
+
+
+def _alternation(graphemes: list[str], flags: int = 0) -> re.Pattern:
+    """SimpleEpitranと同じ、長さ降順に並べた選択の正規表現"""
+    ordered = sorted(graphemes, key=len, reverse=True)
+    return re.compile("|".join(re.escape(g) for g in ordered), flags)
+
+
+def _assert_same_matches(
+    trie: GraphemeTrie, pattern: re.Pattern, texts: list[str]
+) -> None:
+    for text in texts:
+        for pos in range(len(text) + 1):
+            expected = pattern.match(text, pos)
+            actual = trie.match(text, pos)
+            if expected is None:
+                assert actual is None, (text, pos)
+                continue
+            assert actual is not None, (text, pos)
+            assert (actual.group(0), actual.start(), actual.end()) == (
+                expected.group(0),
+                expected.start(),
+                expected.end(),
+            ), (text, pos)
+
+
+def _random_texts(alphabet: str, count: int) -> list[str]:
+    rng = random.Random(0)
+    return [
+        "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 12)))
+        for _ in range(count)
+    ]
+
+
+def test_longest_match_with_overlapping_prefixes():
+    trie = GraphemeTrie(_OVERLAPPING)
+    texts = [
+        "abc",
+        "abd",
+        "abx",
+        "kyakya",
+        "kyo",
+        "clc",
+        *_random_texts("abcdkly", 500),
+    ]
+    _assert_same_matches(trie, _alternation(_OVERLAPPING), texts)
+
+
+def test_longest_match_with_mapping_keys():
+    with open(_MAP_FILE, encoding="utf-8") as f:
+        rows = list(csv.reader(f))
+    graphemes = [row[0] for row in rows[1:] if row]
+    trie = GraphemeTrie(graphemes)
+    rng = random.Random(0)
+    texts = [
+        "".join(rng.choice(graphemes) for _ in range(rng.randint(1, 8)))
+        for _ in range(300)
+    ]
+    texts += _random_texts("aiueoAIUEONklnrstwyhc", 300)
+    _assert_same_matches(trie, _alternation(graphemes), texts)
+
+
+def test_ignore_case():
+    graphemes = ["Ab", "abC", "B", "ky"]
+    trie = GraphemeTrie(graphemes, ignore_case=True)
+    texts = ["ABC", "aBc", "abd", "KY", "Kya", *_random_texts("aAbBcCkKyY", 500)]
+    _assert_same_matches(trie, _alternation(graphemes, re.IGNORECASE), texts)
+    assert GraphemeTrie(graphemes).match("ABC") is None
+
+
+def test_max_length():
+    assert GraphemeTrie(["a", "kya", "", "cl"]).max_length == 3
+    empty = GraphemeTrie(["", ""])
+    assert empty.max_length == 0
+    assert empty.match("a") is None
+
+
+def test_match_groups():
+    match = GraphemeTrie(_OVERLAPPING).match("xabcx", 1)
+    assert (match.group(), match.group(1), match.start(), match.end()) == (
+        "abc",
+        "abc",
+        1,
+        4,
+    )
+    with pytest.raises(IndexError):
+        match.group(2)
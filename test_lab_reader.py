@@ -0,0 +1,142 @@
+import gzip
+import os
+
+import numpy as np
+import pytest
+
+from lab_reader import (
+    _ACCENT_MISSING,
+    _full_context_accents,
+    _full_context_phonemes,
+    _split_lab_lines,
+    iter_lab_archive,
+    read_full_context_lab,
+    read_lab_files,
+    read_lab_timing,
+)
+
+
+def test_iter_lab_archive_reads_gzip_lab(tmp_path):
+    lab_file = tmp_path / "utt.lab.gz"
+    with gzip.open(lab_file, "wt") as f:
+        f.write("0 500000 sil\n500000 1000000 a\n1000000 1500000 sil\n")
+    [(name, timing)] = iter_lab_archive(os.fspath(lab_file))
+    assert name == "utt.lab"
+    assert list(timing.labels) == ["sil", "a", "sil"]
+    assert list(timing.ends) == [500000, 1000000, 1500000]
+
+
+def test_iter_lab_archive_rejects_unknown_format(tmp_path):
+    archive = tmp_path / "utt.lab.bz2"
+    archive.write_bytes(b"0 500000 sil\n")
+    with pytest.raises(ValueError, match="utt.lab.bz2"):
+        list(iter_lab_archive(os.fspath(archive)))
+
+
+_FULL_CONTEXT_LINES = [
+    "xx^xx-sil+k=o/A:xx+xx+xx/B:xx",
+    "xx^sil-k+o=N/A:-2+1+3/B:xx",
+    "sil^k-o+N=n/A:-2+1+3/B:xx",
+    "k^o-N+n=i/A:-1+2+2/B:xx",
+    "o^N-n+i=sil/A:0+3+1/B:xx",
+    "N^n-i+sil=xx/A:0+3+1/B:xx",
+    "n^i-sil+xx=xx/A:xx+xx+xx/B:xx",
+]
+
+
+def test_full_context_phonemes_reads_current_phoneme():
+    contexts = [line.encode() for line in _FULL_CONTEXT_LINES]
+    phonemes = _full_context_phonemes(contexts)
+    assert phonemes == [b"sil", b"k", b"o", b"N", b"n", b"i", b"sil"]
+
+
+def test_full_context_phonemes_rejects_mono_labels():
+    with pytest.raises(ValueError, match="音素の欄"):
+        _full_context_phonemes([b"sil", b"k", b"o"])
+
+
+def test_full_context_accents_shape():
+    contexts = [line.encode() for line in _FULL_CONTEXT_LINES]
+    accents = _full_context_accents(contexts)
+    assert accents.dtype == np.int16
+    assert accents.shape == (len(contexts), 3)
+    assert accents[1].tolist() == [-2, 1, 3]
+    assert accents[4].tolist() == [0, 3, 1]
+    assert (accents[[0, -1]] == _ACCENT_MISSING).all()
+    assert _full_context_accents([]).shape == (0, 3)
+
+
+def test_read_full_context_lab_without_times(tmp_path):
+    lab_file = tmp_path / "utt.lab"
+    lab_file.write_text("\n".join(_FULL_CONTEXT_LINES) + "\n")
+    timing, accents = read_full_context_lab(os.fspath(lab_file), accent=True)
+    assert timing.phoneme_labels() == "sil k o N n i sil"
+    assert not timing.starts.any() and not timing.ends.any()
+    assert accents.shape == (7, 3)
+
+
+def test_split_lab_lines_rejects_mixed_timed_lines():
+    data = b"0 500000 xx^xx-sil+k=o/A:xx+xx+xx\nxx^sil-k+o=N/A:-2+1+3\n"
+    with pytest.raises(ValueError, match="混在"):
+        _split_lab_lines(data, full_context=True)
+    # モノフォンのlabファイルとして読む場合、ラベルだけの行は飛ばす
+    assert _split_lab_lines(data) == [b"0", b"500000", b"xx^xx-sil+k=o/A:xx+xx+xx"]
+
+
+def test_read_lab_timing(tmp_path):
+    lab_file = tmp_path / "utt.lab"
+    lab_file.write_text("0 500000 sil\n500000 1200000 a\n\n1200000 2500000 sil extra\n")
+    timing = read_lab_timing(os.fspath(lab_file))
+    assert timing.phoneme_labels() == "sil a sil"
+    assert timing.starts.dtype == np.int64
+    assert timing.starts.tolist() == [0, 500000, 1200000]
+    assert timing.durations().tolist() == [500000, 700000, 1300000]
+    assert timing.frame_durations(0.005).tolist() == [10, 14, 26]
+
+
+def test_read_lab_timing_rejects_seconds(tmp_path):
+    lab_file = tmp_path / "utt.lab"
+    lab_file.write_text("0.0 0.05 sil\n0.05 0.12 a\n")
+    with pytest.raises(ValueError, match="整数"):
+        read_lab_timing(os.fspath(lab_file))
+
+
+def test_read_lab_files_offsets(tmp_path):
+    (tmp_path / "b").mkdir()
+    (tmp_path / "a.lab").write_text("0 500000 sil\n500000 1000000 a\n")
+    (tmp_path / "b" / "c.lab").write_text(
+        "0 300000 k\n300000 900000 i\n900000 1000000 N\n"
+    )
+    (tmp_path / "d.lab").write_text("")
+    corpus = read_lab_files(os.fspath(tmp_path))
+    assert corpus.files == [
+        os.fspath(tmp_path / name) for name in ["a.lab", "b/c.lab", "d.lab"]
+    ]
+    assert corpus.offsets.tolist() == [0, 2, 5, 5]
+    assert corpus.vocabulary.tolist() == ["N", "a", "i", "k", "sil"]
+    assert corpus.phoneme_labels(0) == "sil a"
+    assert corpus.phoneme_labels(1) == "k i N"
+    assert corpus.labels(2) == []
+    for i, lab_file in enumerate(corpus.files):
+        timing = read_lab_timing(lab_file)
+        assert corpus.timing(i).labels.tolist() == timing.labels.tolist()
+        starts, ends = corpus.times(i)
+        assert starts.tolist() == timing.starts.tolist()
+        assert ends.tolist() == timing.ends.tolist()
+
+
+def test_read_lab_files_full_context(tmp_path):
+    lab_file = tmp_path / "utt.lab"
+    lab_file.write_text(
+        "".join(
+            f"{i * 500000} {(i + 1) * 500000} {line}\n"
+            for i, line in enumerate(_FULL_CONTEXT_LINES)
+        )
+    )
+    corpus = read_lab_files(os.fspath(lab_file), full_context=True)
+    assert corpus.phoneme_labels(0) == "sil k o N n i sil"
+    assert corpus.times(0)[1][-1] == 3500000
+    mono_file = tmp_path / "mono.lab"
+    mono_file.write_text("0 500000 sil\n500000 1000000 a\n")
+    with pytest.raises(ValueError, match="音素の欄"):
+        read_lab_files(os.fspath(mono_file), full_context=True)
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""
+OpenJTalkLabelEpitranの高速な変換経路と参照パイプラインの等価性の網羅検査
+
+マッピングCSVのキー（無声化母音・N・clを含む）を音素ラベルに分けたものを
+1単位とし、長さkまでの全ての並びについて参照パイプラインと検査対象の
+変換結果を比較する。結果が異なった並びは、前後の単位を削っても異なるままの
+最小の並びにして報告する。
+
+参照パイプライン:
+    音素ラベルを結合した文字列に、キーを長さ降順に並べた選択の正規表現で
+    最長一致するキーのIPAを当て、epitranのRules.applyでポストプロセスする
+    （SimpleEpitranの変換と同じ手順）。
+
+検査対象:
+- labels: OpenJTalkLabelEpitran.transliterate_labels
+- batch: OpenJTalkLabelEpitran.transliterate_many
+- cache: phoneme_labels_to_ipa（セグメントキャッシュを通る）
+- features: LabelFeatureEngine（参照パイプラインのIPAから求めた特徴量と比較）
+
+並びの数は単位数（約300）のk乗になり、k=3で約2500万、k=4で約75億になる。
+既定では長さ--max-lengthまでの全ての並びを列挙するため、一致すれば
+その長さまでの等価性が示される。
+
+--full-lengthを--max-lengthより小さくすると、それより長い並びは
+ポストプロセスのルールから見て同じ振る舞いをする単位（先頭・末尾の文字に
+マッチするルールのパターンとセグメント数が同じもの）を代表1つにまとめて
+列挙する。これは抽出検査で、等価性の証明にはならない。特にfeaturesは
+ラベルごとのテーブルを引くため、代表以外の単位のテーブルの誤りは
+見つけられない。並びの端の単位は、外側の文字については文字列の先頭・
+末尾（#）を文脈に持つルールのパターンだけで比べる。
+"""
+
+import argparse
+import os
+import time
+import unicodedata
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from itertools import chain, islice, product
+from multiprocessing import Pool
+
+import numpy as np
+import regex
+from epitran.rules import Rules
+
+from check_epitran_openjtalk import (
+    OpenJTalkLabelEpitran,
+    _get_epitran,
+    _ipa_features,
+    get_feature_table,
+    get_label_feature_engine,
+    phoneme_labels_to_ipa,
+)
+
+# 1回の比較でまとめて変換する並びの数
+_BATCH_SIZE = 2048
+
+# 1単位（マッピングのキー1つ分の音素ラベル）
+Unit = tuple[str, ...]
+
+# =============================================================================
+# 参照パイプライン
+# =============================================================================
+
+
+class ReferencePipeline:
+    """SimpleEpitranと同じ手順でOpenJTalk音素ラベルをIPAに変換する"""
+
+    def __init__(self, epi: OpenJTalkLabelEpitran):
+        """
+        Args:
+            epi: マッピング・ルールファイルを取得するEpitran
+        """
+        self._ipa_map = epi._ipa_map
+        graphemes = sorted(self._ipa_map, key=len, reverse=True)
+        self._regexp = regex.compile(
+            f"({'|'.join(regex.escape(g) for g in graphemes)})"
+        )
+        post_file = epi._custom_post_file
+        self._rules = Rules([post_file]) if post_file else None
+
+    def __call__(self, labels: Sequence[str]) -> str | None:
+        """
+        音素ラベルのリストをIPAに変換する
+
+        Returns:
+            IPA音声記号列（マッピングにない文字を含む場合はNone）
+        """
+        text = unicodedata.normalize("NFD", "".join(labels))
+        pieces = []
+        pos = 0
+        while pos < len(text):
+            m = self._regexp.match(text, pos)
+            if m is None:
+                return None
+            pieces.append(self._ipa_map[m.group(0)])
+            pos = m.end()
+        text = "".join(pieces)
+        if self._rules is not None:
+            text = self._rules.apply(text)
+        return unicodedata.normalize("NFC", text)
+
+
+# =============================================================================
+# 検査対象
+# =============================================================================
+
+
+def _outputs(func: Callable[[Sequence[str]], object], sequences) -> list:
+    """各並びをfuncで変換する（ValueErrorはNoneにする）"""
+    results = []
+    for labels in sequences:
+        try:
+            results.append(func(labels))
+        except ValueError:
+            results.append(None)
+    return results
+
+
+def make_candidates(
+    epi: OpenJTalkLabelEpitran, names: Iterable[str]
+) -> dict[str, Callable[[list[list[str]], list[str | None]], list]]:
+    """
+    検査対象の変換関数を作る
+
+    各関数は(並びのリスト, 参照パイプラインのIPAのリスト)を受け取り、
+    (検査対象の結果, 参照の結果)の組のリストを返す。
+
+    Args:
+        epi: 検査対象のEpitran
+        names: 検査対象の名前（labels, batch, cache, features）
+    """
+
+    def labels(sequences, expected):
+        return list(zip(_outputs(epi.transliterate_labels, sequences), expected))
+
+    def batch(sequences, expected):
+        return list(zip(epi.transliterate_many(sequences)[0], expected))
+
+    def cache(sequences, expected):
+        def convert(labels):
+            return phoneme_labels_to_ipa(" ".join(labels), epi)
+
+        return list(zip(_outputs(convert, sequences), expected))
+
+    def features(sequences, expected):
+        engine = get_label_feature_engine(epi)
+        try:
+            actual = engine.features_many(sequences)
+        except ValueError:
+            actual = _outputs(engine.features, sequences)
+        return [
+            (a, None if e is None else _ipa_features(e))
+            for a, e in zip(actual, expected)
+        ]
+
+    candidates = {
+        "labels": labels,
+        "batch": batch,
+        "cache": cache,
+        "features": features,
+    }
+    return {name: candidates[name] for name in names}
+
+
+def _same(actual, expected) -> bool:
+    if actual is None or expected is None:
+        return actual is None and expected is None
+    if isinstance(expected, np.ndarray):
+        return actual.shape == expected.shape and bool((actual == expected).all())
+    return actual == expected
+
+
+# =============================================================================
+# 列挙する単位
+# =============================================================================
+
+
+def mora_units(epi: OpenJTalkLabelEpitran) -> list[Unit]:
+    """
+    マッピングのキーを音素ラベル（子音ラベルと後続ラベル）に分けた単位を返す
+
+    Returns:
+        単位のリスト（キーの昇順）
+    """
+    labels = get_label_feature_engine(epi).ids
+    units = []
+    for key in sorted(epi._ipa_map):
+        unit: Unit = (key,)
+        for i in range(1, len(key)):
+            if key[:i] in labels and key[i:] in labels and key not in labels:
+                unit = (key[:i], key[i:])
+                break
+        units.append(unit)
+    return units
+
+
+def _rule_patterns(
+    epi: OpenJTalkLabelEpitran,
+) -> tuple[list[str], list[str], list[str]]:
+    """
+    ポストプロセスのルールのパターンを返す
+
+    Returns:
+        (全パターン, 先頭（#）を左文脈に持つルールの書き換え対象,
+         末尾（#）を右文脈に持つルールの書き換え対象)
+    """
+    fields = [f[1:] for f in epi.postprocessor.rules._fields if f[0] == "sub"]
+    patterns = {p for a, _, X, Y in fields for p in (a, X, Y)} - {"", "^", "$"}
+    head = {a for a, _, X, _ in fields if X == "^"}
+    tail = {a for a, _, _, Y in fields if Y == "$"}
+    return sorted(patterns), sorted(head), sorted(tail)
+
+
+def unit_alphabets(epi: OpenJTalkLabelEpitran, length: int) -> list[list[Unit]]:
+    """
+    長さlengthの並びの各位置で列挙する代表の単位を返す
+
+    先頭・末尾の文字にマッチするパターンとセグメント数が同じ単位を
+    1つにまとめ、キーの昇順で最初の単位を代表にする。
+    """
+    if epi._custom_post_file:
+        patterns, head, tail = _rule_patterns(epi)
+    else:
+        patterns = head = tail = []
+
+    def starts(ipa: str, pats: list[str]) -> tuple[bool, ...]:
+        return tuple(regex.match(f"(?:{p})", ipa) is not None for p in pats)
+
+    def ends(ipa: str, pats: list[str]) -> tuple[bool, ...]:
+        return tuple(regex.search(f"(?:{p})$", ipa) is not None for p in pats)
+
+    ft = get_feature_table()
+    alphabets = []
+    for position in range(length):
+        left = head if position == 0 else patterns
+        right = tail if position == length - 1 else patterns
+        representatives: dict[tuple, Unit] = {}
+        for unit in mora_units(epi):
+            ipa = epi._ipa_map["".join(unit)]
+            key = (starts(ipa, left), ends(ipa, right), len(ft.ipa_segs(ipa)))
+            representatives.setdefault(key, unit)
+        alphabets.append(list(representatives.values()))
+    return alphabets
+
+
+# =============================================================================
+# 検査
+# =============================================================================
+
+# ワーカープロセスの状態（_init_workerで設定する）
+_reference: ReferencePipeline | None = None
+_candidates: dict = {}
+
+
+def _init_worker(names: list[str]) -> None:
+    global _reference, _candidates
+    epi = _get_epitran()
+    _reference = ReferencePipeline(epi)
+    _candidates = make_candidates(epi, names)
+
+
+def _differing(sequences: list[list[str]]) -> list[tuple[str, int]]:
+    """(検査対象の名前, 結果が異なった並びの位置)のリストを返す"""
+    expected = [_reference(labels) for labels in sequences]
+    differing = []
+    for name, candidate in _candidates.items():
+        for i, (a, e) in enumerate(candidate(sequences, expected)):
+            if not _same(a, e):
+                differing.append((name, i))
+    return differing
+
+
+def minimize(name: str, units: Sequence[Unit]) -> tuple[Unit, ...]:
+    """
+    結果が異なる並びから、前後の単位を削っても異なるままの最小の並びを求める
+
+    Args:
+        name: 検査対象の名前
+        units: 結果が異なった並び
+    """
+    units = tuple(units)
+    candidate = {name: _candidates[name]}
+    while len(units) > 1:
+        for shorter in (units[1:], units[:-1]):
+            labels = list(chain.from_iterable(shorter))
+            expected = [_reference(labels)]
+            (a, e) = candidate[name]([labels], expected)[0]
+            if not _same(a, e):
+                units = shorter
+                break
+        else:
+            break
+    return units
+
+
+def _batched(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _check_prefix(task: tuple[Unit, list[list[Unit]]]):
+    """
+    先頭の単位を固定した全ての並びを検査する
+
+    Returns:
+        (検査した並びの数, {(検査対象の名前, 最小の並び)})
+    """
+    prefix, rest = task
+    count = 0
+    failures = set()
+    for batch in _batched(product(*rest), _BATCH_SIZE):
+        units_list = [(prefix,) + units for units in batch]
+        sequences = [list(chain.from_iterable(units)) for units in units_list]
+        count += len(sequences)
+        for name, i in _differing(sequences):
+            failures.add((name, minimize(name, units_list[i])))
+    return count, failures
+
+
+def check_exhaustive(
+    max_length: int,
+    full_length: int | None,
+    names: list[str],
+    processes: int | None = None,
+) -> set[tuple[str, tuple[Unit, ...]]]:
+    """
+    長さmax_lengthまでの単位の並びを検査し、結果を表示する
+
+    Args:
+        max_length: 検査する並びの最大の長さ
+        full_length: 全ての単位を列挙する最大の長さ（省略時はmax_length）。
+            それより長い並びは代表の単位だけを並べる抽出検査になる
+        names: 検査対象の名前
+        processes: ワーカープロセス数（省略時はCPU数）
+
+    Returns:
+        {(検査対象の名前, 結果が異なる最小の並び)}
+    """
+    epi = _get_epitran()
+    if full_length is None:
+        full_length = max_length
+    failures = set()
+    print(
+        f"{'長さ':>6} {'列挙':>6} {'単位数':>16} {'並びの数':>14} "
+        f"{'時間[s]':>10} {'不一致':>8}"
+    )
+    print("-" * 70)
+    with Pool(processes, initializer=_init_worker, initargs=(names,)) as pool:
+        for length in range(1, max_length + 1):
+            if length <= full_length:
+                alphabets = [mora_units(epi)] * length
+            else:
+                alphabets = unit_alphabets(epi, length)
+            tasks = [(unit, alphabets[1:]) for unit in alphabets[0]]
+
+            start = time.perf_counter()
+            count = 0
+            found = set()
+            for n, task_failures in pool.imap_unordered(_check_prefix, tasks):
+                count += n
+                found |= task_failures
+            elapsed = time.perf_counter() - start
+
+            sizes = "x".join(str(len(a)) for a in alphabets)
+            mode = "全て" if length <= full_length else "抽出"
+            print(
+                f"{length:>6} {mode:>6} {sizes:>16} {count:>14} "
+                f"{elapsed:>10.1f} {len(found):>8}"
+            )
+            failures |= found
+    return failures
+
+
+def report_failures(failures: set[tuple[str, tuple[Unit, ...]]]) -> None:
+    """結果が異なる最小の並びを、参照と検査対象の結果とともに表示する"""
+    _init_worker(sorted({name for name, _ in failures}))
+    for name, units in sorted(failures, key=lambda f: (f[0], len(f[1]), f[1])):
+        labels = list(chain.from_iterable(units))
+        expected = _reference(labels)
+        actual, expected_output = _candidates[name]([labels], [expected])[0]
+        print(f"[{name}] {' '.join(labels)}")
+        print(f"    reference: {expected}")
+        if isinstance(expected_output, np.ndarray) and actual is not None:
+            # 特徴量は行数と最初に異なる行を表示する
+            rows = min(len(actual), len(expected_output))
+            diff = np.flatnonzero((actual[:rows] != expected_output[:rows]).any(1))
+            first = diff[0] if len(diff) else rows
+            actual = f"{len(actual)} rows (reference {len(expected_output)}), "
+            actual += f"first differing row {first}"
+        print(f"    {name}: {actual}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="高速な変換経路と参照パイプラインの等価性の網羅検査"
+    )
+    parser.add_argument(
+        "--max-length", type=int, default=3, help="検査する並びの最大の長さ"
+    )
+    parser.add_argument(
+        "--full-length",
+        type=int,
+        help="全ての単位を列挙する最大の長さ（省略時は--max-lengthと同じ。"
+        "それより長い並びは代表の単位だけを並べる抽出検査で、証明にはならない）",
+    )
+    parser.add_argument(
+        "--candidates",
+        nargs="+",
+        default=["labels", "batch", "cache", "features"],
+        choices=["labels", "batch", "cache", "features"],
+        help="検査対象",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="ワーカープロセス数",
+    )
+    args = parser.parse_args()
+
+    failures = check_exhaustive(
+        args.max_length, args.full_length, args.candidates, args.processes
+    )
+    print()
+    full_length = args.max_length if args.full_length is None else args.full_length
+    if full_length < args.max_length:
+        print(
+            f"注意: 長さ{full_length + 1}〜{args.max_length}は代表の単位だけを並べた"
+            "抽出検査で、全ての並びで一致することは示していません"
+            "（featuresでは代表以外の単位のテーブルの誤りを見つけられません）"
+        )
+    if not failures:
+        if full_length < args.max_length:
+            print(
+                f"長さ{full_length}までの全ての並びと、それより長い抽出した並びで"
+                "参照パイプラインと一致しました"
+            )
+        else:
+            print(
+                f"長さ{args.max_length}までの全ての並びで参照パイプラインと一致しました"
+            )
+        return
+    print(f"結果が異なる最小の並び: {len(failures)}")
+    report_failures(failures)
+    raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()